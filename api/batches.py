@@ -0,0 +1,685 @@
+"""
+Batch API：上传 JSONL 请求文件，由后台工作协程按并发上限逐条调用聊天接口，结果边完成边追加写入输出文件。
+已写入的结果即检查点，进程重启后跳过已完成的 custom_id 继续处理
+"""
+import asyncio
+import os
+import re
+import secrets
+import time
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator, Union
+
+from loguru import logger
+
+from api import fast_json, request_log
+from api.chat_stream import run, prepare_prompt
+from api.errors import UpstreamError, upstream_error_body
+from api.model_catalog import model_catalog, UnknownModelError
+from api.response_cache import response_cache
+from api.scheduler import scheduler, OverloadedError
+from api.token_counter import ContextLengthError
+from api.usage_ledger import usage_ledger, QuotaExceededError, ANONYMOUS
+
+try:
+    import fcntl
+except ImportError:  # Windows 下不支持，多 worker 时可能重复处理同一批次
+    fcntl = None
+
+BATCH_DIR = os.getenv("BATCH_DIR", os.path.join(".cache", "batches"))
+# 单个批次同时在途的请求数
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+# 批量请求在调度器中的优先级，低于交互请求的默认值 0
+BATCH_PRIORITY = int(os.getenv("BATCH_PRIORITY", -10))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 50000))
+FILES_MAX_BYTES = int(float(os.getenv("FILES_MAX_MB", 200)) * 1024 * 1024)
+# 结果写盘并更新状态文件的间隔（秒）
+CHECKPOINT_INTERVAL = 1.0
+# 没有新批次时重新扫描目录的间隔，用于接管其他 worker 退出后遗留的批次
+RESCAN_INTERVAL = 60.0
+# 上游限流且没有给出 retry-after 时暂停的秒数
+RATE_LIMIT_PAUSE = 5.0
+SUPPORTED_ENDPOINTS = ("/v1/chat/completions",)
+COMPLETION_WINDOWS = {"24h": 86400}
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def _new_id(prefix: str) -> str:
+    return prefix + secrets.token_hex(12)
+
+
+def _error_body(message: str, type_: str = "invalid_request_error", code: Optional[str] = None) -> Dict[str, Any]:
+    error = {"message": message, "type": type_}
+    if code:
+        error["code"] = code
+    return {"error": error}
+
+
+def parse_multipart(body: bytes, content_type: str) -> Dict[str, Tuple[Optional[str], bytes]]:
+    """解析 multipart/form-data 请求体，返回 字段名 -> (文件名, 内容)"""
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise ValueError("multipart boundary is missing")
+    delimiter = b"--" + match.group(1).encode("latin-1")
+    fields = {}
+    for part in body.split(delimiter)[1:]:
+        if part.startswith(b"--"):
+            break
+        head, sep, content = part.partition(b"\r\n\r\n")
+        if not sep:
+            continue
+        disposition = head.decode("utf-8", "replace")
+        name = re.search(r'\bname="([^"]*)"', disposition)
+        if not name:
+            continue
+        filename = re.search(r'\bfilename="([^"]*)"', disposition)
+        # 每个分段以 CRLF 结尾，随后才是下一个分隔符
+        fields[name.group(1)] = (filename.group(1) if filename else None, content[:-2])
+    return fields
+
+
+def _public(state: Dict[str, Any]) -> Dict[str, Any]:
+    """去掉内部字段（以下划线开头）后的 OpenAI 文件或批次对象"""
+    return {k: v for k, v in state.items() if not k.startswith("_")}
+
+
+def _visible(state: Dict[str, Any], owner: Optional[str]) -> bool:
+    """owner 为 None（管理员 key）时可以看到全部文件和批次，否则只能看到该 key 创建的"""
+    return owner is None or state.get("_api_key", ANONYMOUS) == owner
+
+
+class FileStore:
+    """上传文件与批次结果文件，内容和元数据分别保存在 <id>.jsonl 和 <id>.json 中；
+    元数据记录创建文件的 key，查询时按 key 过滤"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def content_path(self, file_id: str) -> str:
+        return os.path.join(self.directory, os.path.basename(file_id) + ".jsonl")
+
+    def _meta_path(self, file_id: str) -> str:
+        return os.path.join(self.directory, os.path.basename(file_id) + ".json")
+
+    def _read_meta(self, file_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._meta_path(file_id), "rb") as f:
+                return fast_json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta: Dict[str, Any]):
+        _write_atomic(self._meta_path(meta["id"]), fast_json.dumps(meta))
+
+    def _register(self, file_id: str, filename: str, purpose: str, owner: str) -> Dict[str, Any]:
+        meta = {
+            "id": file_id,
+            "object": "file",
+            "bytes": os.path.getsize(self.content_path(file_id)),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+            "_api_key": owner,
+        }
+        self._write_meta(meta)
+        return _public(meta)
+
+    async def create(self, filename: str, purpose: str, chunks: Union[bytes, AsyncIterator[bytes]],
+                     owner: str = ANONYMOUS) -> Dict[str, Any]:
+        """保存文件内容，chunks 为请求体流时边接收边写盘；超过 FILES_MAX_MB 时抛出 ValueError"""
+        if isinstance(chunks, bytes):
+            chunks = _iterate(chunks)
+        os.makedirs(self.directory, exist_ok=True)
+        file_id = _new_id("file-")
+        path = self.content_path(file_id)
+        size = 0
+        f = await asyncio.to_thread(open, path, "wb")
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > FILES_MAX_BYTES:
+                    raise ValueError(f"file exceeds the {FILES_MAX_BYTES // (1024 * 1024)} MB limit")
+                await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            f.close()
+            await asyncio.to_thread(_remove, path)
+            raise
+        f.close()
+        return await asyncio.to_thread(self._register, file_id, filename, purpose, owner)
+
+    async def register(self, file_id: str, filename: str, purpose: str, owner: str) -> Dict[str, Any]:
+        """为已经写好的内容文件（批次结果）创建元数据"""
+        return await asyncio.to_thread(self._register, file_id, filename, purpose, owner)
+
+    def _get(self, file_id: str, owner: Optional[str]) -> Optional[Dict[str, Any]]:
+        meta = self._read_meta(file_id)
+        return meta if meta is not None and _visible(meta, owner) else None
+
+    async def get(self, file_id: str, owner: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """owner 不是创建者时视为不存在"""
+        meta = await asyncio.to_thread(self._get, file_id, owner)
+        return _public(meta) if meta is not None else None
+
+    def _list(self, purpose: Optional[str], owner: Optional[str]) -> List[Dict[str, Any]]:
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        files = [self._read_meta(name[:-5]) for name in names if name.endswith(".json")]
+        files = [_public(f) for f in files
+                 if f is not None and (purpose is None or f["purpose"] == purpose) and _visible(f, owner)]
+        return sorted(files, key=lambda f: f["created_at"], reverse=True)
+
+    async def list(self, purpose: Optional[str] = None, owner: Optional[str] = None) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._list, purpose, owner)
+
+    def _delete(self, file_id: str, owner: Optional[str]) -> bool:
+        if self._get(file_id, owner) is None:
+            return False
+        _remove(self._meta_path(file_id))
+        _remove(self.content_path(file_id))
+        return True
+
+    async def delete(self, file_id: str, owner: Optional[str] = None) -> bool:
+        return await asyncio.to_thread(self._delete, file_id, owner)
+
+
+async def _iterate(data: bytes) -> AsyncIterator[bytes]:
+    yield data
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _append(path: str, lines: List[bytes]):
+    with open(path, "ab") as f:
+        f.write(b"".join(lines))
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _read_lines(f, count: int) -> List[bytes]:
+    lines = []
+    for line in f:
+        lines.append(line)
+        if len(lines) >= count:
+            break
+    return lines
+
+
+def _load_results(path: str) -> Tuple[set, int]:
+    """读取已写入的结果，返回 (custom_id 集合, 行数)；进程中断时可能留下不完整的最后一行，将其截掉"""
+    done = set()
+    try:
+        f = open(path, "rb+")
+    except FileNotFoundError:
+        return done, 0
+    with f:
+        end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            done.add(fast_json.loads(line)["custom_id"])
+            end += len(line)
+        f.truncate(end)
+    return done, len(done)
+
+
+def _validate_input(path: str, endpoint: str) -> Tuple[int, List[Dict[str, Any]]]:
+    """校验输入文件的每一行，返回 (请求数, 错误列表)；有错误时整个批次失败"""
+    errors = []
+    seen = set()
+    total = 0
+
+    def error(code: str, message: str, line: Optional[int] = None):
+        errors.append({"code": code, "message": message, "param": None, "line": line})
+
+    try:
+        f = open(path, "rb")
+    except OSError:
+        error("file_not_found", "Input file content is missing")
+        return 0, errors
+    with f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            total += 1
+            if len(errors) >= 100:
+                continue
+            try:
+                item = fast_json.loads(line)
+            except ValueError:
+                error("invalid_json_line", "This line is not parseable as valid JSON.", number)
+                continue
+            if not isinstance(item, dict):
+                error("invalid_request", "Each line must be a JSON object.", number)
+                continue
+            custom_id = item.get("custom_id")
+            if not isinstance(custom_id, str) or not custom_id:
+                error("missing_required_parameter", "custom_id is required.", number)
+            elif custom_id in seen:
+                error("duplicate_custom_id", "The custom_id for this request is a duplicate.", number)
+            seen.add(custom_id)
+            if item.get("method", "POST") != "POST":
+                error("invalid_method", "Only POST requests are supported.", number)
+            if item.get("url") != endpoint:
+                error("mismatched_endpoint", f"The url must match the batch endpoint {endpoint}.", number)
+            if not isinstance(item.get("body"), dict):
+                error("missing_required_parameter", "body must be a JSON object.", number)
+    if total == 0:
+        error("empty_file", "The input file contains no requests.")
+    elif total > BATCH_MAX_REQUESTS:
+        error("too_many_requests", f"A batch may contain at most {BATCH_MAX_REQUESTS} requests.")
+    return total, errors
+
+
+class BatchManager:
+    """批次按创建顺序逐个处理，每个批次内最多 BATCH_CONCURRENCY 个请求同时在途；
+    请求经由调度器（低优先级）和账号池发出，上游限流时整体暂停"""
+
+    def __init__(self, directory: str = BATCH_DIR):
+        self.directory = os.path.join(directory, "batches")
+        self.files = FileStore(os.path.join(directory, "files"))
+        # 当前进程正在处理的批次，查询时优先返回内存中的状态
+        self._active: Dict[str, Dict[str, Any]] = {}
+        self._stopping: Dict[str, str] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._resume_at = 0.0
+        self._stats = {"created": 0, "completed": 0, "failed": 0, "cancelled": 0, "expired": 0,
+                       "requests_succeeded": 0, "requests_failed": 0, "rate_limit_pauses": 0}
+
+    async def start(self):
+        """启动后台处理协程，未完成的批次从检查点继续"""
+        await asyncio.to_thread(os.makedirs, self.directory, exist_ok=True)
+        self._wakeup = asyncio.Event()
+        self._runner = asyncio.create_task(self._run())
+
+    async def close(self):
+        # 在途请求的结果不会写入，重启后重新处理
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+
+    def _path(self, batch_id: str, suffix: str = ".json") -> str:
+        """状态文件；.lock 为处理方持有的文件锁，.cancel 为取消标记"""
+        return os.path.join(self.directory, os.path.basename(batch_id) + suffix)
+
+    def _read_state(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(batch_id), "rb") as f:
+                return fast_json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    async def _save(self, state: Dict[str, Any]):
+        await asyncio.to_thread(_write_atomic, self._path(state["id"]), fast_json.dumps(state))
+
+    async def create(self, input_file_id: str, endpoint: str, completion_window: str = "24h",
+                     metadata: Optional[Dict[str, str]] = None, owner: str = ANONYMOUS,
+                     admin: bool = False, limit_key: str = "") -> Dict[str, Any]:
+        """owner 为创建批次的 key 名称，批次及其结果文件归该 key 所有；admin 可以使用其他 key 上传的输入文件。
+        limit_key 为创建者在调度器中的身份，批量请求与其交互请求共用并发和限流额度"""
+        if endpoint not in SUPPORTED_ENDPOINTS:
+            raise ValueError(f"Unsupported endpoint {endpoint}, supported: {', '.join(SUPPORTED_ENDPOINTS)}")
+        if completion_window not in COMPLETION_WINDOWS:
+            raise ValueError("completion_window must be 24h")
+        input_file = await self.files.get(input_file_id, None if admin else owner)
+        if input_file is None or input_file["purpose"] != "batch":
+            raise ValueError(f"No batch input file with id {input_file_id}")
+        now = int(time.time())
+        state = {
+            "id": _new_id("batch_"),
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": now + COMPLETION_WINDOWS[completion_window],
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+            # 结果文件的 id 在创建时确定，处理过程中直接追加写入对应的内容文件
+            "_output_file_id": _new_id("file-"),
+            "_error_file_id": _new_id("file-"),
+            # 用量计入创建批次的 key，只有该 key（和管理员 key）可以查看、取消
+            "_api_key": owner,
+            "_limit_key": limit_key,
+        }
+        await self._save(state)
+        self._stats["created"] += 1
+        self._wakeup.set()
+        return _public(state)
+
+    async def _get_state(self, batch_id: str, owner: Optional[str]) -> Optional[Dict[str, Any]]:
+        state = self._active.get(batch_id) or await asyncio.to_thread(self._read_state, batch_id)
+        return state if state is not None and _visible(state, owner) else None
+
+    async def get(self, batch_id: str, owner: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """owner 不是创建者时视为不存在"""
+        state = await self._get_state(batch_id, owner)
+        return _public(state) if state is not None else None
+
+    def _list_states(self) -> List[Dict[str, Any]]:
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        states = [self._read_state(name[:-5]) for name in names if name.endswith(".json")]
+        return sorted((s for s in states if s is not None), key=lambda s: s["created_at"])
+
+    async def list(self, limit: int = 20, after: Optional[str] = None,
+                   owner: Optional[str] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        """按创建时间倒序分页，返回 (批次列表, 是否还有更多)"""
+        states = [s for s in reversed(await asyncio.to_thread(self._list_states)) if _visible(s, owner)]
+        if after:
+            ids = [s["id"] for s in states]
+            states = states[ids.index(after) + 1:] if after in ids else []
+        states = [self._active.get(s["id"], s) for s in states]
+        return [_public(s) for s in states[:limit]], len(states) > limit
+
+    async def cancel(self, batch_id: str, owner: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """标记取消：处理该批次的进程在下一个检查点停止派发新请求，在途请求完成后结束"""
+        state = await self._get_state(batch_id, owner)
+        if state is None:
+            return None
+        if state["status"] in TERMINAL_STATUSES or state["status"] == "cancelling":
+            return _public(state)
+        # 标记文件让其他 worker 进程中的处理方也能感知
+        await asyncio.to_thread(_write_atomic, self._path(batch_id, ".cancel"), b"")
+        if batch_id in self._active:
+            self._stop(state, "cancelled")
+        state = dict(state, status="cancelling", cancelling_at=state["cancelling_at"] or int(time.time()))
+        return _public(state)
+
+    def _stop(self, state: Dict[str, Any], reason: str):
+        if state["id"] in self._stopping:
+            return
+        self._stopping[state["id"]] = reason
+        if reason == "cancelled":
+            state["status"] = "cancelling"
+            state["cancelling_at"] = int(time.time())
+
+    async def _run(self):
+        while True:
+            # 处理过程中新建的批次会再次置位，处理完当前批次后立即重新扫描
+            self._wakeup.clear()
+            try:
+                for state in await asyncio.to_thread(self._list_states):
+                    if state["status"] not in TERMINAL_STATUSES:
+                        await self._process_locked(state["id"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Batch runner failed: {}", e)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), RESCAN_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process_locked(self, batch_id: str):
+        """持有文件锁时处理批次，多个 worker 进程不会重复处理同一批次"""
+        fd = None
+        if fcntl is not None:
+            fd = await asyncio.to_thread(os.open, self._path(batch_id, ".lock"),
+                                         os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return
+        try:
+            # 获得锁后重新读取，其他进程可能已经处理完成
+            state = await asyncio.to_thread(self._read_state, batch_id)
+            if state is not None and state["status"] not in TERMINAL_STATUSES:
+                self._active[batch_id] = state
+                try:
+                    await self._process(state)
+                finally:
+                    self._active.pop(batch_id, None)
+                    self._stopping.pop(batch_id, None)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    async def _process(self, state: Dict[str, Any]):
+        batch_id = state["id"]
+        input_path = self.files.content_path(state["input_file_id"])
+        if await asyncio.to_thread(os.path.exists, self._path(batch_id, ".cancel")):
+            self._stop(state, "cancelled")
+        elif time.time() > state["expires_at"]:
+            self._stop(state, "expired")
+        elif state["status"] == "validating":
+            total, errors = await asyncio.to_thread(_validate_input, input_path, state["endpoint"])
+            if errors:
+                state.update(status="failed", failed_at=int(time.time()),
+                             errors={"object": "list", "data": errors})
+                state["request_counts"]["total"] = total
+                self._stats["failed"] += 1
+                await self._save(state)
+                return
+            state.update(status="in_progress", in_progress_at=int(time.time()))
+            state["request_counts"]["total"] = total
+            await self._save(state)
+
+        if batch_id not in self._stopping:
+            logger.info("Processing batch {} ({} requests)", batch_id, state["request_counts"]["total"])
+            try:
+                await self._run_requests(state, input_path)
+            except Exception as e:
+                logger.exception("Batch {} failed: {}", batch_id, e)
+                state.update(status="failed", failed_at=int(time.time()),
+                             errors={"object": "list", "data": [
+                                 {"code": "processing_error", "message": str(e), "param": None, "line": None}]})
+                self._stats["failed"] += 1
+                await self._save(state)
+                return
+
+        reason = self._stopping.get(batch_id)
+        now = int(time.time())
+        state.update(finalizing_at=state["finalizing_at"] or now)
+        # 取消或过期的批次同样返回已完成部分的结果
+        for key in ("output", "error"):
+            file_id = state[f"_{key}_file_id"]
+            if await asyncio.to_thread(_file_size, self.files.content_path(file_id)):
+                await self.files.register(file_id, f"{batch_id}_{key}.jsonl", "batch_output",
+                                          state.get("_api_key", ANONYMOUS))
+                state[f"{key}_file_id"] = file_id
+        if reason is None:
+            state.update(status="completed", completed_at=now)
+        else:
+            state.update({"status": reason, f"{reason}_at": now})
+        self._stats[state["status"]] += 1
+        await self._save(state)
+        logger.info("Batch {} {}: {}", batch_id, state["status"], state["request_counts"])
+
+    async def _run_requests(self, state: Dict[str, Any], input_path: str):
+        batch_id = state["id"]
+        output_path = self.files.content_path(state["_output_file_id"])
+        error_path = self.files.content_path(state["_error_file_id"])
+        done_ok, completed = await asyncio.to_thread(_load_results, output_path)
+        done_failed, failed = await asyncio.to_thread(_load_results, error_path)
+        done = done_ok | done_failed
+        state["request_counts"].update(completed=completed, failed=failed)
+        if done:
+            logger.info("Resuming batch {} from checkpoint: {} requests already done", batch_id, len(done))
+
+        queue: asyncio.Queue = asyncio.Queue(BATCH_CONCURRENCY * 2)
+        results: Dict[str, List[bytes]] = {"output": [], "error": []}
+        finished = asyncio.Event()
+
+        async def read():
+            f = await asyncio.to_thread(open, input_path, "rb")
+            try:
+                while batch_id not in self._stopping:
+                    lines = await asyncio.to_thread(_read_lines, f, 256)
+                    if not lines:
+                        break
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        item = fast_json.loads(line)
+                        if item["custom_id"] not in done:
+                            await queue.put((item["custom_id"], item["body"]))
+            finally:
+                f.close()
+                for _ in range(BATCH_CONCURRENCY):
+                    await queue.put(None)
+
+        async def work():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if batch_id in self._stopping:
+                    continue
+                custom_id, body = item
+                outcome = await self._execute(batch_id, body, state.get("_api_key", ANONYMOUS),
+                                              state.get("_limit_key") or "batch:" + batch_id)
+                if outcome is None:
+                    continue
+                status_code, response = outcome
+                record = {
+                    "id": _new_id("batch_req_"),
+                    "custom_id": custom_id,
+                    "response": {"status_code": status_code, "request_id": request_log.new_request_id(),
+                                 "body": response},
+                    "error": None,
+                }
+                results["output" if status_code == 200 else "error"].append(fast_json.dumps(record) + b"\n")
+
+        async def flush():
+            output, errors = results["output"], results["error"]
+            results["output"], results["error"] = [], []
+            if output:
+                await asyncio.to_thread(_append, output_path, output)
+            if errors:
+                await asyncio.to_thread(_append, error_path, errors)
+            counts = state["request_counts"]
+            counts["completed"] += len(output)
+            counts["failed"] += len(errors)
+            self._stats["requests_succeeded"] += len(output)
+            self._stats["requests_failed"] += len(errors)
+            await self._save(state)
+
+        async def checkpoint():
+            while not finished.is_set():
+                try:
+                    await asyncio.wait_for(finished.wait(), CHECKPOINT_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                if await asyncio.to_thread(os.path.exists, self._path(batch_id, ".cancel")):
+                    self._stop(state, "cancelled")
+                elif time.time() > state["expires_at"]:
+                    self._stop(state, "expired")
+                await flush()
+
+        checkpointer = asyncio.create_task(checkpoint())
+        tasks = [asyncio.create_task(read())] + [asyncio.create_task(work()) for _ in range(BATCH_CONCURRENCY)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            finished.set()
+            # 最后一次写入已完成的结果
+            await checkpointer
+
+    async def _wait_rate_limit(self):
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _pause(self, retry_after: Optional[float]):
+        self._stats["rate_limit_pauses"] += 1
+        self._resume_at = max(self._resume_at, time.monotonic() + (retry_after or RATE_LIMIT_PAUSE))
+
+    async def _execute(self, batch_id: str, body: Dict[str, Any], api_key_name: str,
+                       limit_key: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """执行一条请求，返回 (状态码, 响应体)；批次在等待限流期间被停止时返回 None（不写入结果）。
+        key 的配额用完后剩余请求以 429 写入错误文件"""
+        data = dict(body)
+        data["stream"] = False
+        data.pop("stream_options", None)
+        try:
+            data["model"] = model_catalog.resolve(data.get("model", "gpt-4"))
+            prompt = prepare_prompt(data)
+        except UnknownModelError as e:
+            return 404, _error_body(str(e), code="model_not_found")
+        except ContextLengthError as e:
+            return 400, _error_body(str(e), code="context_length_exceeded")
+        except ValueError as e:
+            return 400, _error_body(str(e))
+
+        key = usage_ledger.keys.find(api_key_name)
+        if key is not None:
+            try:
+                usage_ledger.check_quota(key)
+            except QuotaExceededError as e:
+                return 429, _error_body(str(e), "insufficient_quota", code="insufficient_quota")
+
+        while batch_id not in self._stopping:
+            await self._wait_rate_limit()
+            try:
+                await scheduler.acquire(limit_key, BATCH_PRIORITY)
+            except OverloadedError as e:
+                self._pause(e.retry_after)
+                continue
+            try:
+                if response_cache.enabled:
+                    content, _ = await response_cache.fetch(
+                        data, lambda d: run(d, prompt), normalized=prompt.normalized)
+                else:
+                    content = await run(data, prompt)
+                response = content if isinstance(content, dict) else fast_json.loads(content)
+                usage = response.get("usage") or {}
+                usage_ledger.record(api_key_name, usage.get("prompt_tokens", prompt.tokens),
+                                    usage.get("completion_tokens"))
+                return 200, response
+            except UpstreamError as e:
+                if e.status in (429, 503):
+                    # 账号全部限流或熔断打开：整个工作池暂停，该请求稍后重试
+                    self._pause(e.retry_after)
+                    continue
+                return upstream_error_body(e)
+            except Exception as e:
+                logger.exception("Batch request failed: {}", e)
+                return 500, _error_body(str(e), "server_error")
+            finally:
+                scheduler.release()
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["active"] = {batch_id: state["request_counts"] for batch_id, state in self._active.items()}
+        return stats
+
+
+batch_manager = BatchManager()
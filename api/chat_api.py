@@ -1,9 +1,28 @@
-from typing import List, Dict, Any, AsyncGenerator, Union
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, AsyncGenerator, Union, Optional
+import asyncio
+import os
+import re
 import time
-import json
+
 import aiohttp
-import async_lru
-from loguru import logger
+
+from api import fast_json, metrics, resilience
+from api.errors import UpstreamError, UpstreamTimeoutError
+from api.http_client import http_client
+from api.sse import SSERelay, PassthroughRelay, CompletionAggregator, StreamUsage
+from api.token_counter import token_counter
+from api.token_manager import copilot_tokens
+
+# 可指向本地的模拟上游（见 bench/mock_upstream.py）
+COPILOT_API_BASE = os.getenv("COPILOT_API_BASE", "https://api.githubcopilot.com").rstrip("/")
+COPILOT_CHAT_URL = f"{COPILOT_API_BASE}/chat/completions"
+COPILOT_EMBEDDINGS_URL = f"{COPILOT_API_BASE}/embeddings"
+COPILOT_MODELS_URL = f"{COPILOT_API_BASE}/models"
+_COMPLETION_TOKENS = re.compile(rb'"completion_tokens"\s*:\s*(\d+)')
+# 首字节超时由 asyncio.wait_for 单独控制，sock_read 即两次读取之间的空闲超时
+_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=resilience.CONNECT_TIMEOUT,
+                                 sock_read=resilience.IDLE_TIMEOUT)
 
 
 class ChatAPI:
@@ -12,161 +31,253 @@ class ChatAPI:
     def __init__(self, token):
         self.token = token
 
-    async def stream_chat(
-            self,
-            messages: List[Dict[str, str]],
-            model: str = "gpt-4",
-            temperature: float = 0.7,
-    ) -> AsyncGenerator[str, None]:
-        """将 GitHub Copilot API 转换为 OpenAI API 兼容的流式聊天接口"""
+    async def _headers(self, accept: str) -> Dict[str, str]:
+        start = time.perf_counter()
         # 首先获取 Copilot token
         copilot_token = await self.get_copilot_token()
+        metrics.AUTH_RESOLUTION.labels("copilot_token").observe(time.perf_counter() - start)
         if not copilot_token:
             raise ValueError("No Copilot token")
 
-        headers = {
+        return {
             "authorization": f"Bearer {copilot_token}",
             "accept-language": "en-US,en;q=0.9",
             "editor-plugin-version": "copilot-chat/0.25.2025021001",
             "openai-intent": "conversation-panel",
             "editor-version": "vscode/1.98.0-insider",
             "content-type": "application/json",
-            "accept": "text/event-stream",
+            "accept": accept,
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    url="https://api.githubcopilot.com/chat/completions",
-                    headers=headers,
-                    json={
-                        "messages": messages,
-                        "model": model,
-                        "temperature": temperature,
-                        "stream": True,
-                    }
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise ValueError(f"status code ：{response.status}，error message：{error_text}")
-
-                async for line in response.content:
-                    try:
-                        line = line.decode('utf-8').strip()
-                        if not line:
-                            continue
-
-                        if not line.startswith('data: '):
-                            continue
-
-                        data = line[6:].strip()
-                        if data == '[DONE]':
-                            yield 'data: [DONE]\n\n'
-                            break
-
-                        chunk = json.loads(data)
-                        if not chunk.get('choices'):
-                            continue
-
-                        content = chunk['choices'][0].get('delta', {}).get('content', '')
-                        if not content:
-                            continue
-
-                        response_chunk = {
-                            'id': f"chatcmpl-{int(time.time() * 1000)}",
-                            'object': 'chat.completion.chunk',
-                            'created': int(time.time()),
-                            'model': model,
-                            'choices': [
-                                {
-                                    'index': 0,
-                                    'delta': {'content': content},
-                                    'finish_reason': None
-                                }
-                            ]
-                        }
-                        yield f"data: {json.dumps(response_chunk)}\n\n"
-
-                    except Exception as e:
-                        continue
-
-    @async_lru.alru_cache(ttl=2 * 60 * 60)
+    @asynccontextmanager
+    async def _post(self, payload: Dict[str, Any], model: str, stream: bool, url: str = ""):
+        """发送补全（或 url 指定的其他）请求，非 200 时抛出 UpstreamError"""
+        start = time.perf_counter()
+        headers = await self._headers("text/event-stream" if stream else "application/json")
+        body = fast_json.dumps(payload)
+        if b'"image_url"' in body:
+            # 包含图片的请求需要声明 vision
+            headers["copilot-vision-request"] = "true"
+        session = http_client.get_session()
+        try:
+            response = await asyncio.wait_for(
+                session.post(url=url or COPILOT_CHAT_URL, headers=headers, data=body, timeout=_TIMEOUT),
+                resilience.FIRST_BYTE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise UpstreamTimeoutError("timed out waiting for upstream response")
+        except aiohttp.ClientConnectionError as e:
+            raise UpstreamError(502, f"upstream connection failed: {e}")
+        async with response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise UpstreamError(response.status, error_text,
+                                    UpstreamError.parse_retry_after(response.headers.get("retry-after")))
+            metrics.UPSTREAM_FIRST_BYTE.labels(model, "true" if stream else "false").observe(
+                time.perf_counter() - start)
+            try:
+                yield response, start
+            except (asyncio.CancelledError, GeneratorExit):
+                # 客户端断开：直接关闭上游连接，不再读取剩余的生成内容
+                response.close()
+                raise
+            except asyncio.TimeoutError:
+                # 读取响应体时超过空闲超时
+                raise UpstreamTimeoutError("upstream response stalled")
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError) as e:
+                raise UpstreamError(502, f"upstream response interrupted: {e}")
+
+    async def stream_chat(
+            self,
+            messages: List[Dict[str, str]],
+            model: str = "gpt-4",
+            temperature: float = 0.7,
+            prompt_tokens: Optional[int] = None,
+            usage: Optional[StreamUsage] = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """将 GitHub Copilot API 转换为 OpenAI API 兼容的流式聊天接口，逐个产出 SSE 事件字节；
+        给出 prompt_tokens 时，上游没有返回 usage 则在末尾补发一个估算的 usage 事件；
+        给出 usage 时，结束后写入上游的 usage 和输出文本"""
+        payload = {
+            "messages": messages,
+            "model": model,
+            "temperature": temperature,
+            "stream": True,
+        }
+        relay = SSERelay(model, track_usage=prompt_tokens is not None or usage is not None)
+        try:
+            async for event in self._stream(payload, model, relay):
+                yield event
+            if prompt_tokens is not None and relay.usage is None:
+                yield relay.build([], token_counter.estimate_usage(model, prompt_tokens, relay.completion_text))
+        finally:
+            if usage is not None:
+                usage.usage, usage.completion_text = relay.usage, relay.completion_text
+
+    async def stream_chat_raw(self, payload: Dict[str, Any],
+                              usage: Optional[StreamUsage] = None) -> AsyncGenerator[bytes, None]:
+        """透传模式：请求体原样转发，上游 SSE 事件原样返回"""
+        model = payload.get("model", "gpt-4")
+        relay = PassthroughRelay(track_usage=usage is not None)
+        try:
+            async for event in self._stream(payload, model, relay):
+                yield event
+        finally:
+            if usage is not None:
+                usage.usage, usage.completion_text = relay.usage, relay.completion_text
+
+    async def _stream(self, payload: Dict[str, Any], model: str,
+                      relay: Union[SSERelay, PassthroughRelay]) -> AsyncGenerator[bytes, None]:
+        async with self._post(payload, model, stream=True) as (response, start):
+            inter_chunk = metrics.INTER_CHUNK.labels(model)
+            chunks = 0
+            first_at = last_at = 0.0
+            async for line in response.content:
+                try:
+                    event = relay.feed(line)
+                except ValueError:
+                    # 跳过无法解析的行
+                    continue
+                if relay.done:
+                    break
+                if event is not None:
+                    now = time.perf_counter()
+                    if chunks:
+                        inter_chunk.observe(now - last_at)
+                    else:
+                        first_at = now
+                        metrics.FIRST_CHUNK.labels(model).observe(now - start)
+                    last_at = now
+                    chunks += 1
+                    yield event
+
+            if chunks > 1 and last_at > first_at:
+                metrics.OUTPUT_RATE.labels(model, "true").observe((chunks - 1) / (last_at - first_at))
+
     async def get_copilot_token(self) -> str:
         """获取 Copilot token"""
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                    url="https://api.github.com/copilot_internal/v2/token",
-                    headers={
-                        "Authorization": f"Bearer {self.token}",
-                        "Accept": "application/json",
-                        "User-Agent": "Mozilla/5.0",
-                    }
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise ValueError(
-                        f"Get token error, status code: {response.status}, error messaget Copilot: {error_text}")
-
-                data = await response.json()
-                token = data.get("token")
-                logger.info(f"Get Copilot token: {token}")
-                if not token:
-                    raise ValueError("No token")
-                return token
+        return await copilot_tokens.get_token(self.token)
 
     async def chat(
             self,
             messages: List[Dict[str, str]],
             model: str = "gpt-4",
             temperature: float = 0.7,
+            prompt_tokens: Optional[int] = None,
     ) -> Dict[str, Any]:
-        """非流式聊天接口，返回完整的响应"""
-        # 首先获取 Copilot token
-        copilot_token = await self.get_copilot_token()
-        if not copilot_token:
-            raise ValueError("No Copilot token")
-
-        headers = {
-            "authorization": f"Bearer {copilot_token}",
-            "accept-language": "en-US,en;q=0.9",
-            "editor-plugin-version": "copilot-chat/0.25.2025021001",
-            "openai-intent": "conversation-panel",
-            "editor-version": "vscode/1.98.0-insider",
-            "content-type": "application/json",
-            "accept": "application/json",
+        """非流式聊天接口，返回完整的响应；上游没有返回 usage 时按 prompt_tokens 估算"""
+        payload = {
+            "messages": messages,
+            "model": model,
+            "temperature": temperature,
+            "stream": False,
         }
+        async with self._post(payload, model, stream=False) as (response, start):
+            response_data = await response.json()
+            self._observe_output_rate(model, response_data.get("usage"), start)
+            choice = response_data.get("choices", [{}])[0]
+            usage = response_data.get("usage") or {}
+            if not usage and prompt_tokens is not None:
+                usage = token_counter.estimate_usage(
+                    model, prompt_tokens, choice.get("message", {}).get("content") or "")
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    url="https://api.githubcopilot.com/chat/completions",
-                    headers=headers,
-                    json={
-                        "messages": messages,
-                        "model": model,
-                        "temperature": temperature,
-                        "stream": False,
+            # 构造符合 OpenAI API 规范的响应格式
+            return {
+                "id": f"chatcmpl-{int(time.time() * 1000)}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": choice.get("message", {}).get("content", "")
+                        },
+                        "finish_reason": choice.get("finish_reason", "stop")
                     }
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise ValueError(f"status code：{response.status}，error message：{error_text}")
-
-                response_data = await response.json()
-                
-                # 构造符合 OpenAI API 规范的响应格式
-                return {
-                    "id": f"chatcmpl-{int(time.time() * 1000)}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": model,
-                    "choices": [
-                        {
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": response_data.get("choices", [{}])[0].get("message", {}).get("content", "")
-                            },
-                            "finish_reason": response_data.get("choices", [{}])[0].get("finish_reason", "stop")
-                        }
-                    ],
-                    "usage": response_data.get("usage", {})
-                }
+                ],
+                "usage": usage
+            }
+
+    async def chat_via_stream(
+            self,
+            messages: List[Dict[str, str]],
+            model: str = "gpt-4",
+            temperature: float = 0.7,
+            prompt_tokens: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """非流式聊天接口的流式实现：向上游发起流式请求并把增量合并为完整响应，
+        生成期间持续有数据到达，空闲超时能及早发现停滞的上游"""
+        payload = {
+            "messages": messages,
+            "model": model,
+            "temperature": temperature,
+            "stream": True,
+        }
+        aggregator = CompletionAggregator(model)
+        await self._aggregate(payload, model, aggregator)
+        usage = None
+        if prompt_tokens is not None and aggregator.usage is None:
+            usage = token_counter.estimate_usage(model, prompt_tokens, aggregator.completion_text)
+        return aggregator.result(usage)
+
+    async def chat_raw_via_stream(self, payload: Dict[str, Any], prompt_tokens: Optional[int] = None) -> bytes:
+        """透传模式下 chat_via_stream 的对应实现：payload 需已设置 stream=True，返回 chat.completion 字节"""
+        model = payload.get("model", "gpt-4")
+        aggregator = CompletionAggregator(model, keep_upstream_fields=True)
+        await self._aggregate(payload, model, aggregator)
+        usage = None
+        if prompt_tokens is not None and aggregator.usage is None:
+            usage = token_counter.estimate_usage(model, prompt_tokens, aggregator.completion_text)
+        return fast_json.dumps(aggregator.result(usage))
+
+    async def _aggregate(self, payload: Dict[str, Any], model: str, aggregator: CompletionAggregator):
+        async with self._post(payload, model, stream=True) as (response, start):
+            async for line in response.content:
+                try:
+                    aggregator.feed(line)
+                except UpstreamError:
+                    raise
+                except ValueError:
+                    # 跳过无法解析的行
+                    continue
+                if aggregator.done:
+                    break
+            if not aggregator.finished:
+                raise UpstreamError(502, "upstream stream ended before the completion finished")
+            self._observe_output_rate(model, aggregator.usage, start)
+
+    async def chat_raw(self, payload: Dict[str, Any]) -> bytes:
+        """透传模式：请求体原样转发，返回上游响应体原始字节"""
+        model = payload.get("model", "gpt-4")
+        async with self._post(payload, model, stream=False) as (response, start):
+            body = await response.read()
+            # 不解析整个响应体，只用正则取出 completion_tokens
+            match = _COMPLETION_TOKENS.search(body)
+            if match:
+                self._observe_output_rate(model, {"completion_tokens": int(match.group(1))}, start)
+            return body
+
+    async def embed(self, inputs: List[str], model: str, dimensions: Optional[int] = None) -> Dict[str, Any]:
+        """向量化接口，返回上游响应（data 按 index 对应 inputs）"""
+        payload: Dict[str, Any] = {"input": inputs, "model": model}
+        if dimensions:
+            payload["dimensions"] = dimensions
+        async with self._post(payload, model, stream=False, url=COPILOT_EMBEDDINGS_URL) as (response, _):
+            return fast_json.loads(await response.read())
+
+    async def list_models(self) -> List[Dict[str, Any]]:
+        """获取上游模型目录"""
+        session = http_client.get_session()
+        headers = await self._headers("application/json")
+        async with session.get(COPILOT_MODELS_URL, headers=headers, timeout=_TIMEOUT) as response:
+            if response.status != 200:
+                raise UpstreamError(response.status, await response.text())
+            return fast_json.loads(await response.read()).get("data", [])
+
+    @staticmethod
+    def _observe_output_rate(model: str, usage: Dict[str, Any], start: float):
+        completion_tokens = (usage or {}).get("completion_tokens")
+        elapsed = time.perf_counter() - start
+        if completion_tokens and elapsed > 0:
+            metrics.OUTPUT_RATE.labels(model, "false").observe(completion_tokens / elapsed)
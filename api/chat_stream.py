@@ -1,85 +1,286 @@
-from functools import cache
-from typing import Optional, AsyncGenerator, Dict, Any
-
-import async_lru
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional, AsyncGenerator, Dict, Any, List, Union, Callable, Awaitable
 
+from api import metrics, fast_json
 from api.chat_api import ChatAPI
-from auth.device_auth import DeviceAuth
-from auth.envs_auth import EnvsAuth
-from auth.hosts_auth import HostsAuth
+from api.errors import UpstreamError, CopilotTokenError
+from api.model_catalog import model_catalog
+from api.prefix_store import prefix_store
+from api.sse import StreamUsage
+from api.resilience import retry_policy, circuit_breakers, latency_tracker, sleep_backoff
+from api.token_counter import token_counter
+from api.token_manager import copilot_tokens
+from auth.account_pool import Account
+from auth.credential_provider import credential_provider
+
+# 透传模式：请求体原样转发（保留 tools、max_tokens、图片等字段），响应原样返回
+PASSTHROUGH = os.getenv("PASSTHROUGH", "false").lower() in ("1", "true", "yes")
+# 发送前在本地计算 prompt token 数并按模型上下文上限校验
+PROMPT_GUARD = os.getenv("PROMPT_GUARD", "true").lower() in ("1", "true", "yes")
+# 超出上限时的处理：none 直接拒绝，drop_oldest 丢弃最早的非 system 消息
+PROMPT_TRUNCATION = os.getenv("PROMPT_TRUNCATION", "none").lower()
+# 非流式请求也以流式向上游请求，边接收边合并为完整响应
+STREAM_AGGREGATE = os.getenv("STREAM_AGGREGATE", "false").lower() in ("1", "true", "yes")
 
 
 async def get_token() -> Optional[str]:
-    """获取认证令牌"""
-    auth_methods = [
-        EnvsAuth(),
-        HostsAuth(),
-        DeviceAuth(),
-    ]
-
-    for auth in auth_methods:
-        if token := await auth.get_token():
-            return token
+    """获取认证令牌（不会阻塞或触发交互式认证，未认证时请访问 /auth/device）"""
+    start = time.perf_counter()
+    token = await credential_provider.get_token()
+    metrics.AUTH_RESOLUTION.labels("credentials").observe(time.perf_counter() - start)
+    return token
+
+
+async def _acquire_account(excluded: set) -> Account:
+    """从账号池中选择账号"""
+    start = time.perf_counter()
+    pool = await credential_provider.get_pool()
+    account = pool.acquire(excluded)
+    metrics.AUTH_RESOLUTION.labels("credentials").observe(time.perf_counter() - start)
+    return account
+
+
+@dataclass
+class Prompt:
+    # 非透传模式下发送给上游的规范化消息
+    normalized: Optional[List[Dict[str, str]]]
+    # 本地估算的 prompt token 数，未开启 PROMPT_GUARD 时为 None
+    tokens: Optional[int]
+
+
+def normalize_message(msg: Dict[str, Any]) -> Dict[str, str]:
+    """规范化单条消息格式"""
+    if isinstance(msg.get("content"), list):
+        content = next((item["text"] for item in msg["content"] if isinstance(item, dict) and "text" in item), "")
+    else:
+        content = msg.get("content", "")
+    return {
+        "content": content,
+        "role": msg.get("role", "user")
+    }
+
+
+def normalize_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """规范化消息格式"""
+    return [normalize_message(msg) for msg in messages]
+
+
+def _on_account_error(account: Account, error: UpstreamError, excluded: set):
+    """根据上游错误处理当前账号：401 丢弃 Copilot token，429 或换取 token 失败时本请求不再使用该账号"""
+    if error.status == 401:
+        # Copilot token 失效，丢弃后重新获取
+        copilot_tokens.invalidate(account.oauth_token)
+    if error.status == 429 or isinstance(error, CopilotTokenError):
+        excluded.add(account.oauth_token)
+
+
+def _prepare_message(model: str, msg: Any):
+    """单条消息的校验、规范化和 token 计数，结果按对话前缀缓存"""
+    if not isinstance(msg, dict):
+        raise ValueError("each message must be an object")
+    if PASSTHROUGH and not msg.get("role"):
+        # 透传模式下的最小校验
+        raise ValueError("each message must be an object with a role")
+    normalized = None if PASSTHROUGH else normalize_message(msg)
+    tokens = token_counter.count_message(model, msg) if PROMPT_GUARD else None
+    return normalized, tokens
+
+
+def build_passthrough_payload(data: dict, stream: bool) -> Dict[str, Any]:
+    """透传模式：除 stream 外原样转发客户端请求体（消息已由 prepare_prompt 校验）"""
+    payload = dict(data)
+    payload["stream"] = stream
+    if not stream:
+        payload.pop("stream_options", None)
+    return payload
+
+
+def _prompt_limit(model: str, max_tokens: Optional[int]) -> Optional[int]:
+    """模型允许的 prompt token 数，目录中没有该模型的上限信息时返回 None"""
+    capabilities = model_catalog.get_capabilities(model) or {}
+    if capabilities.get("max_prompt_tokens"):
+        return capabilities["max_prompt_tokens"]
+    if capabilities.get("context_window"):
+        return capabilities["context_window"] - (max_tokens or capabilities.get("max_output_tokens") or 0)
     return None
 
 
-async def run_stream(
-        data: dict
-) -> AsyncGenerator[str, None]:
-    """运行流式聊天，返回符合 OpenAI SSE 规范的数据流"""
-    token = await get_token()
-    if not token:
-        raise ValueError("未能获取有效的认证令牌")
-
-    chat = ChatAPI(token)
-    messages = data.get("messages", [])
-    model = data.get("model", "gpt-4")
-    temperature = data.get("temperature", 0.7)
-    if not messages:
+def prepare_prompt(data: dict) -> Prompt:
+    """校验并规范化消息，估算 prompt token 数并校验上下文上限；已处理过的对话前缀从 prefix_store 复用。
+    按 PROMPT_TRUNCATION 截断时会替换 data["messages"]，超出上限抛出 ContextLengthError"""
+    messages = data.get("messages")
+    if not messages or not isinstance(messages, list):
         raise ValueError("not found any message")
-    # 规范化消息格式
-    normalized_messages = []
-    for msg in messages:
-        if isinstance(msg.get("content"), list):
-            content = next((item["text"] for item in msg["content"] if isinstance(item, dict) and "text" in item), "")
-        else:
-            content = msg.get("content", "")
+    model = data.get("model", "gpt-4")
+    # 规范化结果与模型无关，token 数只与分词编码有关
+    namespace = token_counter.encoding_name(model) if PROMPT_GUARD else ""
+    items = prefix_store.prepare(namespace, messages, lambda m: _prepare_message(model, m)).items
+    normalized = None if PASSTHROUGH else [item[0] for item in items]
+    if not PROMPT_GUARD:
+        return Prompt(normalized, None)
 
-        normalized_messages.append({
-            "content": content,
-            "role": msg.get("role", "user")
-        })
+    extra_tokens = 0
+    if PASSTHROUGH and data.get("tools"):
+        extra_tokens = token_counter.count_text(model, fast_json.dumps(data["tools"]).decode("utf-8"))
+    keep, prompt_tokens = token_counter.fit(
+        model, messages, _prompt_limit(model, data.get("max_tokens")),
+        truncate=PROMPT_TRUNCATION == "drop_oldest", extra_tokens=extra_tokens,
+        counts=[item[1] for item in items])
+    if keep is not None:
+        data["messages"] = [messages[i] for i in keep]
+        if normalized is not None:
+            normalized = [normalized[i] for i in keep]
+    return Prompt(normalized, prompt_tokens)
 
-    async for chunk in chat.stream_chat(normalized_messages, model=model, temperature=temperature):
-        yield chunk
+
+async def run_stream(
+        data: dict,
+        prompt: Optional[Prompt] = None,
+        usage: Optional[StreamUsage] = None
+) -> AsyncGenerator[bytes, None]:
+    """运行流式聊天，返回符合 OpenAI SSE 规范的数据流；prompt 为调用方已经执行 prepare_prompt 的结果，
+    usage 用于在结束后取得上游的 usage 和输出文本"""
+    pool = await credential_provider.get_pool()
+    if prompt is None:
+        prompt = prepare_prompt(data)
+    if PASSTHROUGH:
+        payload = build_passthrough_payload(data, stream=True)
+        open_stream = lambda chat: chat.stream_chat_raw(payload, usage=usage)
+    else:
+        model = data.get("model", "gpt-4")
+        temperature = data.get("temperature", 0.7)
+        # 客户端请求 usage 时，上游没有返回则用本地估算值补齐
+        include_usage = bool((data.get("stream_options") or {}).get("include_usage"))
+        usage_prompt_tokens = prompt.tokens if include_usage else None
+        open_stream = lambda chat: chat.stream_chat(prompt.normalized, model=model, temperature=temperature,
+                                                    prompt_tokens=usage_prompt_tokens, usage=usage)
+
+    breaker = circuit_breakers.get(data.get("model", "gpt-4"))
+    breaker.check()
+    excluded = set()
+    attempt = 0
+    while True:
+        account = await _acquire_account(excluded)
+        chat = ChatAPI(account.oauth_token)
+        started = False
+        error = None
+        try:
+            async for chunk in open_stream(chat):
+                if not started:
+                    started = True
+                    breaker.record_success()
+                yield chunk
+            return
+        except UpstreamError as e:
+            error = e
+            _on_account_error(account, e, excluded)
+            breaker.record_failure(e)
+            # 已经开始输出后无法重试
+            if started or not retry_policy.should_retry(e, attempt):
+                raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            pool.release(account, error)
+        await sleep_backoff(error, attempt)
+        attempt += 1
 
 
 async def run(
-        data: dict
-) -> Dict[str, Any]:
-    """运行非流式聊天，返回完整的响应"""
-    token = await get_token()
-    if not token:
-        raise ValueError("未能获取有效的认证令牌")
-
-    chat = ChatAPI(token)
-    messages = data.get("messages", [])
+        data: dict,
+        prompt: Optional[Prompt] = None
+) -> Union[Dict[str, Any], bytes]:
+    """运行非流式聊天，返回完整的响应；透传模式下返回上游响应体字节（STREAM_AGGREGATE 时为合并后的响应）"""
+    if prompt is None:
+        prompt = prepare_prompt(data)
     model = data.get("model", "gpt-4")
     temperature = data.get("temperature", 0.7)
-    if not messages:
-        raise ValueError("not found any message")
-    
-    # 规范化消息格式
-    normalized_messages = []
-    for msg in messages:
-        if isinstance(msg.get("content"), list):
-            content = next((item["text"] for item in msg["content"] if isinstance(item, dict) and "text" in item), "")
-        else:
-            content = msg.get("content", "")
-
-        normalized_messages.append({
-            "content": content,
-            "role": msg.get("role", "user")
-        })
-
-    return await chat.chat(normalized_messages, model=model, temperature=temperature)
+    if PASSTHROUGH and STREAM_AGGREGATE:
+        payload = build_passthrough_payload(data, stream=True)
+        call = lambda chat: chat.chat_raw_via_stream(payload, prompt_tokens=prompt.tokens)
+    elif PASSTHROUGH:
+        payload = build_passthrough_payload(data, stream=False)
+        call = lambda chat: chat.chat_raw(payload)
+    elif STREAM_AGGREGATE:
+        call = lambda chat: chat.chat_via_stream(prompt.normalized, model=model, temperature=temperature,
+                                                 prompt_tokens=prompt.tokens)
+    else:
+        call = lambda chat: chat.chat(prompt.normalized, model=model, temperature=temperature,
+                                      prompt_tokens=prompt.tokens)
+
+    return await call_upstream(model, call)
+
+
+async def call_upstream(model: str, call: Callable[[ChatAPI], Awaitable[Any]]) -> Any:
+    """以账号池、重试、熔断和对冲策略执行一次非流式上游调用"""
+    pool = await credential_provider.get_pool()
+    breaker = circuit_breakers.get(model)
+    breaker.check()
+    excluded = set()
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            result = await _call_hedged(pool, model, call, excluded)
+        except UpstreamError as e:
+            breaker.record_failure(e)
+            if not retry_policy.should_retry(e, attempt):
+                raise
+            await sleep_backoff(e, attempt)
+            attempt += 1
+            continue
+        breaker.record_success()
+        latency_tracker.observe(model, time.perf_counter() - start)
+        return result
+
+
+async def _call_once(pool, call, excluded: set):
+    account = await _acquire_account(excluded)
+    error = None
+    try:
+        return await call(ChatAPI(account.oauth_token))
+    except UpstreamError as e:
+        error = e
+        _on_account_error(account, e, excluded)
+        raise
+    except asyncio.CancelledError:
+        # 对冲失败的一方或客户端断开时被取消，不计为账号的错误
+        raise
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        pool.release(account, error)
+
+
+async def _call_hedged(pool, model: str, call, excluded: set):
+    """耗时超过该模型近期的 p95 仍未返回时，用另一个账号发起对冲请求，取先成功的结果"""
+    delay = latency_tracker.hedge_delay(model)
+    if delay is None:
+        return await _call_once(pool, call, excluded)
+
+    primary = asyncio.create_task(_call_once(pool, call, excluded))
+    tasks = {primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            latency_tracker.hedged += 1
+            # 主请求的账号仍在途，按最少在途选择时自然会分到其他账号
+            tasks.add(asyncio.create_task(_call_once(pool, call, excluded)))
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        latency_tracker.hedge_wins += 1
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
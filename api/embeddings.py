@@ -0,0 +1,218 @@
+"""
+向量化接口：把并发的小请求在几毫秒的窗口内合并为上游批量请求，按内容哈希缓存向量
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import sys
+from array import array
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+from loguru import logger
+
+from api import fast_json, metrics
+from api.chat_stream import call_upstream
+
+DEFAULT_MODEL = "text-embedding-3-small"
+
+# 缓存中的向量同时保存小端 float32 字节（即 OpenAI encoding_format=base64 的格式）
+# 和上游原始浮点数组的 JSON，encoding_format=float 时原样输出上游的取值
+_BIG_ENDIAN = sys.byteorder == "big"
+
+
+def _pack(values: List[float]) -> bytes:
+    vector = array("f", values)
+    if _BIG_ENDIAN:
+        vector.byteswap()
+    return vector.tobytes()
+
+
+# (小端 float32 字节, 上游浮点数组的 JSON)
+Vector = Tuple[bytes, bytes]
+
+
+def _vector_size(vector: Vector) -> int:
+    return len(vector[0]) + len(vector[1])
+
+
+class VectorCache:
+    """LRU 向量缓存，按向量字节数限制内存；值为 ((float32 字节, 浮点数组 JSON), 估算的 token 数)"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, Tuple[Vector, float]]" = OrderedDict()
+        self._size = 0
+
+    def get(self, key: str) -> Optional[Tuple[Vector, float]]:
+        item = self._items.get(key)
+        if item is not None:
+            self._items.move_to_end(key)
+        return item
+
+    def set(self, key: str, vector: Vector, tokens: float):
+        if self.max_bytes <= 0:
+            return
+        old = self._items.pop(key, None)
+        if old is not None:
+            self._size -= _vector_size(old[0])
+        self._items[key] = (vector, tokens)
+        self._size += _vector_size(vector)
+        while self._size > self.max_bytes:
+            _, (evicted, _) = self._items.popitem(last=False)
+            self._size -= _vector_size(evicted)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._items), "bytes": self._size}
+
+
+class EmbeddingBatcher:
+    """按 (模型, 维度) 分组收集待向量化的文本，窗口到期或达到批大小时发出一次上游请求"""
+
+    def __init__(self):
+        self.window = float(os.getenv("EMBEDDINGS_BATCH_WINDOW_MS", 5)) / 1000
+        self.max_batch = int(os.getenv("EMBEDDINGS_MAX_BATCH", 64))
+        self.cache = VectorCache(int(float(os.getenv("EMBEDDINGS_CACHE_MAX_MB", 64)) * 1024 * 1024))
+        # 分组 -> {缓存键: 文本}，等待下一次 flush
+        self._pending: Dict[Tuple[str, int], "OrderedDict[str, str]"] = {}
+        self._timers: Dict[Tuple[str, int], asyncio.TimerHandle] = {}
+        # 缓存键 -> 结果 future，覆盖排队中和请求中的文本，相同文本只请求一次
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._tasks = set()
+        self._stats = {"inputs": 0, "hits": 0, "misses": 0, "coalesced": 0, "batches": 0, "errors": 0}
+
+    @staticmethod
+    def _key(model: str, dimensions: int, text: str) -> str:
+        digest = hashlib.sha256(f"{model}\0{dimensions}\0".encode("utf-8"))
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    async def embed(self, texts: List[str], model: str,
+                    dimensions: int = 0) -> Tuple[List[Vector], int]:
+        """返回每个文本的向量和估算的 prompt token 数"""
+        inputs = metrics.EMBEDDING_INPUTS
+        results: List[Union[Tuple[Vector, float], asyncio.Future]] = []
+        for text in texts:
+            key = self._key(model, dimensions, text)
+            cached = self.cache.get(key)
+            if cached is not None:
+                self._stats["hits"] += 1
+                inputs.labels(model, "hit").inc()
+                results.append(cached)
+                continue
+            future = self._inflight.get(key)
+            if future is not None:
+                self._stats["coalesced"] += 1
+                inputs.labels(model, "coalesced").inc()
+            else:
+                self._stats["misses"] += 1
+                inputs.labels(model, "miss").inc()
+                future = self._enqueue((model, dimensions), key, text)
+            results.append(future)
+        self._stats["inputs"] += len(texts)
+
+        pending = [item for item in results if isinstance(item, asyncio.Future)]
+        if pending:
+            # shield：单个请求取消时不影响共享同一文本的其他请求
+            await asyncio.gather(*(asyncio.shield(f) for f in pending))
+        resolved = [item.result() if isinstance(item, asyncio.Future) else item for item in results]
+        return [vector for vector, _ in resolved], round(sum(tokens for _, tokens in resolved))
+
+    def _enqueue(self, group: Tuple[str, int], key: str, text: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = self._inflight[key] = loop.create_future()
+        pending = self._pending.setdefault(group, OrderedDict())
+        pending[key] = text
+        if len(pending) >= self.max_batch:
+            self._start_flush(group)
+        elif group not in self._timers:
+            self._timers[group] = loop.call_later(self.window, self._start_flush, group)
+        return future
+
+    def _start_flush(self, group: Tuple[str, int]):
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(group, None)
+        if not batch:
+            return
+        task = asyncio.create_task(self._flush(group, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, group: Tuple[str, int], batch: "OrderedDict[str, str]"):
+        model, dimensions = group
+        keys = list(batch)
+        texts = list(batch.values())
+        self._stats["batches"] += 1
+        metrics.EMBEDDING_BATCH_SIZE.labels(model).observe(len(texts))
+        try:
+            response = await call_upstream(model, lambda chat: chat.embed(texts, model, dimensions))
+            data = sorted(response.get("data", []), key=lambda item: item.get("index", 0))
+            if len(data) != len(texts):
+                raise ValueError(f"embeddings response has {len(data)} items for {len(texts)} inputs")
+            # 上游只返回整批的 token 数，按文本长度分摊到每条输入
+            prompt_tokens = (response.get("usage") or {}).get("prompt_tokens", 0)
+            total_chars = sum(len(text) for text in texts) or 1
+            for key, text, item in zip(keys, texts, data):
+                vector = (_pack(item["embedding"]), fast_json.dumps(item["embedding"]))
+                tokens = prompt_tokens * len(text) / total_chars
+                self.cache.set(key, vector, tokens)
+                future = self._inflight.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_result((vector, tokens))
+        except BaseException as e:
+            self._stats["errors"] += 1
+            logger.warning("Embeddings batch of {} failed: {}", len(texts), e)
+            for key in keys:
+                future = self._inflight.pop(key, None)
+                if future is not None and not future.done():
+                    if isinstance(e, Exception):
+                        future.set_exception(e)
+                    else:
+                        future.cancel()
+            if not isinstance(e, Exception):
+                raise
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["avg_batch_size"] = round(stats["misses"] / stats["batches"], 2) if stats["batches"] else 0.0
+        stats["cache"] = self.cache.get_stats()
+        return stats
+
+
+embedding_batcher = EmbeddingBatcher()
+
+
+def parse_request(data: Dict[str, Any]) -> Tuple[List[str], str, int, str]:
+    """校验请求体，返回 (文本列表, 模型, 维度, 编码格式)"""
+    texts = data.get("input")
+    if isinstance(texts, str):
+        texts = [texts]
+    if not texts or not isinstance(texts, list) or not all(isinstance(t, str) and t for t in texts):
+        raise ValueError("input must be a non-empty string or a list of non-empty strings")
+    encoding_format = data.get("encoding_format") or "float"
+    if encoding_format not in ("float", "base64"):
+        raise ValueError("encoding_format must be 'float' or 'base64'")
+    dimensions = data.get("dimensions") or 0
+    if not isinstance(dimensions, int) or dimensions < 0:
+        raise ValueError("dimensions must be a positive integer")
+    return texts, data.get("model") or DEFAULT_MODEL, dimensions, encoding_format
+
+
+def build_response(vectors: List[Vector], model: str, prompt_tokens: int, encoding_format: str) -> bytes:
+    """base64 直接输出 float32 字节，避免把大批量向量序列化成冗长的浮点数组；
+    float 拼接缓存的上游浮点数组 JSON，取值与上游一致且不需要重新序列化"""
+    if encoding_format == "base64":
+        embeddings = [fast_json.dumps(base64.b64encode(packed).decode("ascii")) for packed, _ in vectors]
+    else:
+        embeddings = [floats for _, floats in vectors]
+    data = b",".join(
+        b'{"object":"embedding","index":%d,"embedding":%s}' % (i, embedding)
+        for i, embedding in enumerate(embeddings)
+    )
+    return (b'{"object":"list","data":[' + data + b'],"model":' + fast_json.dumps(model)
+            + b',"usage":' + fast_json.dumps({"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}) + b"}")
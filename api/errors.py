@@ -0,0 +1,60 @@
+"""
+上游错误类型
+"""
+from typing import Optional, Dict, Any, Tuple
+
+from api import fast_json
+
+
+class UpstreamError(ValueError):
+    """上游返回非 200 状态码"""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"status code：{status}，error message：{message}")
+        self.status = status
+        # 上游返回的原始错误内容，4xx 时原样转给客户端
+        self.message = message
+        self.retry_after = retry_after
+
+    @classmethod
+    def parse_retry_after(cls, value: Optional[str]) -> Optional[float]:
+        """解析 retry-after 头（仅支持秒数）"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            return None
+
+
+class CopilotTokenError(UpstreamError):
+    """用 OAuth token 换取 Copilot token 失败，通常意味着该账号不可用"""
+
+
+class UpstreamTimeoutError(UpstreamError):
+    """连接、等待首字节或读取响应时超时"""
+
+    def __init__(self, message: str):
+        super().__init__(504, message)
+
+
+class AccountsExhaustedError(UpstreamError):
+    """所有账号都处于冷却中，重试没有意义"""
+
+
+def upstream_error_body(error: UpstreamError) -> Tuple[int, Dict[str, Any]]:
+    """上游错误对应的 (状态码, 错误响应体)：4xx 的状态码和错误内容原样保留，
+    5xx 转为 502/500（熔断、超时保留 503/504）"""
+    if 400 <= error.status < 500:
+        try:
+            body = fast_json.loads(error.message)
+        except ValueError:
+            body = None
+        if isinstance(body, dict):
+            return error.status, body
+        error_type = "rate_limit_error" if error.status == 429 else "invalid_request_error"
+        return error.status, {"error": {"message": error.message, "type": error_type}}
+    if error.status in (503, 504):
+        # 熔断打开或上游超时
+        return error.status, {"error": {"message": str(error), "type": "upstream_unavailable"}}
+    return 502 if error.status == 502 else 500, {"error": {"message": str(error), "type": "server_error"}}
@@ -0,0 +1,53 @@
+"""
+JSON 编解码：优先使用 orjson / msgspec，未安装时退回标准库 json
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+
+    BACKEND = "orjson"
+
+    def dumps(obj: Any) -> bytes:
+        """序列化为 UTF-8 字节"""
+        return orjson.dumps(obj)
+
+    def loads(data: Union[bytes, str]) -> Any:
+        return orjson.loads(data)
+
+except ImportError:
+    try:
+        import msgspec
+
+        BACKEND = "msgspec"
+        _encoder = msgspec.json.Encoder()
+        _decoder = msgspec.json.Decoder()
+
+        def dumps(obj: Any) -> bytes:
+            """序列化为 UTF-8 字节"""
+            return _encoder.encode(obj)
+
+        def loads(data: Union[bytes, str]) -> Any:
+            try:
+                return _decoder.decode(data)
+            except msgspec.DecodeError as e:
+                # 与 json / orjson 保持一致，解析失败统一抛出 ValueError
+                raise ValueError(str(e)) from e
+
+    except ImportError:
+        BACKEND = "json"
+
+        def dumps(obj: Any) -> bytes:
+            """序列化为 UTF-8 字节"""
+            return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+        def loads(data: Union[bytes, str]) -> Any:
+            return json.loads(data)
+
+
+def ensure_bytes(obj: Any) -> bytes:
+    """已经是序列化结果（例如透传的上游响应体）时原样返回"""
+    if isinstance(obj, (bytes, bytearray)):
+        return bytes(obj)
+    return dumps(obj)
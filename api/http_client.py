@@ -0,0 +1,100 @@
+"""
+上游 HTTP 连接池
+"""
+import asyncio
+import os
+from typing import Optional, Dict, Any
+
+import aiohttp
+from loguru import logger
+
+
+class HttpClient:
+    """进程级共享的 aiohttp 会话，所有 Copilot / GitHub 请求复用同一个连接池"""
+
+    def __init__(self):
+        self.limit = int(os.getenv("UPSTREAM_LIMIT", 100))
+        self.limit_per_host = int(os.getenv("UPSTREAM_LIMIT_PER_HOST", 32))
+        self.keepalive_timeout = float(os.getenv("UPSTREAM_KEEPALIVE_TIMEOUT", 60))
+        self.dns_ttl = int(os.getenv("UPSTREAM_DNS_TTL", 300))
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._stats = {
+            "requests": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+        }
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        """统计请求数、新建连接数和复用连接数"""
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self._stats["requests"] += 1
+
+        async def on_connection_create_end(session, ctx, params):
+            self._stats["connections_created"] += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self._stats["connections_reused"] += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_ttl,
+            use_dns_cache=True,
+        )
+        logger.debug(
+            "Create upstream session: limit={}, limit_per_host={}, keepalive={}s",
+            self.limit, self.limit_per_host, self.keepalive_timeout,
+        )
+        return aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config()])
+
+    async def start(self):
+        """在应用启动时创建会话"""
+        self.get_session()
+
+    async def close(self):
+        """在应用关闭时释放所有连接"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def prewarm(self, url: str, count: int):
+        """并发发起 count 个 HEAD 请求，使连接池中保留 count 个已完成握手的空闲连接"""
+        session = self.get_session()
+
+        async def touch():
+            async with session.head(url, allow_redirects=False) as response:
+                await response.read()
+
+        await asyncio.gather(*(touch() for _ in range(count)))
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """获取共享会话，未启动时按需创建（需在事件循环中调用）"""
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+        return self._session
+
+    def get_stats(self) -> Dict[str, Any]:
+        """连接池统计信息"""
+        stats = dict(self._stats)
+        total = stats["connections_created"] + stats["connections_reused"]
+        stats["reuse_rate"] = round(stats["connections_reused"] / total, 4) if total else 0.0
+        stats["limit"] = self.limit
+        stats["limit_per_host"] = self.limit_per_host
+        session = self._session
+        if session is not None and not session.closed:
+            connector = session.connector
+            stats["idle_connections"] = sum(len(conns) for conns in connector._conns.values())
+            stats["active_connections"] = len(connector._acquired)
+        return stats
+
+
+http_client = HttpClient()
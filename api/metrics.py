@@ -0,0 +1,257 @@
+"""
+Prometheus 指标（文本格式 0.0.4），不依赖 prometheus_client
+"""
+import abc
+import bisect
+import time
+from typing import Dict, Tuple, List, Callable, Union, Sequence
+
+from api import request_log
+
+# 延迟类直方图的默认桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# 流式 chunk 间隔的桶（秒）
+GAP_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# 输出速度的桶（token/秒）
+RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+# 批大小的桶
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """创建一个子指标（单组标签值对应的取值）"""
+
+    def labels(self, *values):
+        """返回指定标签值的子指标；调用方可缓存返回值以避免重复查找"""
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    @abc.abstractmethod
+    def _samples(self) -> List[str]:
+        """渲染全部子指标的样本行"""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._children[()].inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+                for key, child in self._children.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1):
+        self._children[()].dec(amount)
+
+    def set(self, value: float):
+        self._children[()].set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class _CallbackGauge:
+    """渲染时才读取取值的 gauge，用于暴露各组件已有的统计"""
+
+    def __init__(self, name: str, documentation: str,
+                 fn: Callable[[], Union[float, Dict[Tuple[Tuple[str, str], ...], float]]]):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        value = self.fn()
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                names = [name for name, _ in labels]
+                values = [val for _, val in labels]
+                lines.append(f"{self.name}{_format_labels(names, values)} {_format_value(v)}")
+        else:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge_callback(self, name: str, documentation: str, fn):
+        self.register(_CallbackGauge(name, documentation, fn))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.counter(
+    "copilot_requests_total", "Chat completion requests", ("model", "status", "stream"))
+REQUEST_LATENCY = registry.histogram(
+    "copilot_request_duration_seconds", "Total chat completion latency", ("model", "stream"))
+INFLIGHT = registry.gauge(
+    "copilot_inflight_requests", "Chat completion requests in progress", ("stream",))
+UPSTREAM_FIRST_BYTE = registry.histogram(
+    "copilot_upstream_first_byte_seconds", "Time until upstream response headers arrive", ("model", "stream"))
+FIRST_CHUNK = registry.histogram(
+    "copilot_first_chunk_seconds", "Time until the first streamed chunk is emitted", ("model",))
+INTER_CHUNK = registry.histogram(
+    "copilot_inter_chunk_seconds", "Gap between consecutive streamed chunks", ("model",), GAP_BUCKETS)
+OUTPUT_RATE = registry.histogram(
+    "copilot_output_tokens_per_second", "Output tokens per second (chunks for streams)", ("model", "stream"),
+    RATE_BUCKETS)
+TOKEN_FETCH = registry.histogram(
+    "copilot_token_fetch_seconds", "Copilot token fetch latency")
+AUTH_RESOLUTION = registry.histogram(
+    "copilot_auth_resolution_seconds", "Time to resolve credentials (account) or the Copilot token for a request",
+    ("stage",))
+STREAM_CANCELLATIONS = registry.counter(
+    "copilot_stream_cancellations_total", "Streams cancelled because the client disconnected", ("model",))
+EMBEDDING_INPUTS = registry.counter(
+    "copilot_embedding_inputs_total", "Embedding inputs by how they were resolved", ("model", "result"))
+UPSTREAM_RETRIES = registry.counter(
+    "copilot_upstream_retries_total", "Upstream attempts retried before the first byte")
+EMBEDDING_BATCH_SIZE = registry.histogram(
+    "copilot_embedding_batch_size", "Inputs per upstream embeddings request", ("model",), BATCH_BUCKETS)
+
+
+class RequestTracker:
+    """记录单个聊天请求的生命周期：在途数、请求计数、总延迟，结束时输出一条请求汇总日志"""
+
+    __slots__ = ("request_id", "model", "stream", "start", "finished")
+
+    def __init__(self, request_id: str, model: str, stream: bool):
+        self.request_id = request_id
+        self.model = model
+        self.stream = "true" if stream else "false"
+        self.start = time.perf_counter()
+        self.finished = False
+        INFLIGHT.labels(self.stream).inc()
+
+    def finish(self, status: int, **extra):
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.perf_counter() - self.start
+        INFLIGHT.labels(self.stream).dec()
+        REQUESTS.labels(self.model, status, self.stream).inc()
+        REQUEST_LATENCY.labels(self.model, self.stream).observe(duration)
+        request_log.log_summary(self.request_id, self.model, self.stream, status, duration, **extra)
@@ -0,0 +1,162 @@
+"""
+模型目录：从 Copilot 获取可用模型并缓存（TTL + 后台刷新），解析别名，在本地拒绝未知模型
+"""
+import asyncio
+import os
+import time
+from typing import Dict, Any, List, Optional
+
+from loguru import logger
+
+from api.chat_api import ChatAPI
+from auth.credential_provider import credential_provider
+
+# 无法获取上游目录时使用的模型列表
+FALLBACK_MODELS = ("gpt-4", "o3-mini", "o1", "gemini-2.0-flash-001", "claude-3.5-sonnet", "claude-3.7-sonnet")
+
+
+class UnknownModelError(ValueError):
+    """请求的模型不在上游目录中"""
+
+    def __init__(self, model: str):
+        super().__init__(f"The model `{model}` does not exist or you do not have access to it.")
+        self.model = model
+
+
+def _parse_aliases(value: str) -> Dict[str, str]:
+    """解析 "别名=模型,别名=模型" 格式的别名表"""
+    aliases = {}
+    for pair in value.split(","):
+        alias, sep, target = pair.partition("=")
+        if sep and alias.strip() and target.strip():
+            aliases[alias.strip()] = target.strip()
+    return aliases
+
+
+def _capabilities(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """从上游条目中提取客户端关心的能力信息"""
+    capabilities = entry.get("capabilities") or {}
+    limits = capabilities.get("limits") or {}
+    supports = capabilities.get("supports") or {}
+    return {
+        "type": capabilities.get("type", "chat"),
+        "context_window": limits.get("max_context_window_tokens"),
+        "max_prompt_tokens": limits.get("max_prompt_tokens"),
+        "max_output_tokens": limits.get("max_output_tokens"),
+        "streaming": supports.get("streaming"),
+        "tool_calls": supports.get("tool_calls"),
+        "vision": supports.get("vision"),
+    }
+
+
+class ModelCatalog:
+    def __init__(self):
+        self.ttl = float(os.getenv("MODELS_CACHE_TTL", 3600))
+        self.validate = os.getenv("MODEL_VALIDATION", "true").lower() in ("1", "true", "yes")
+        self.aliases = _parse_aliases(os.getenv("MODEL_ALIASES", "gpt-4o-mini=claude-3.5-sonnet"))
+        # 是否为上游返回的权威目录；使用内置列表时不拒绝未知模型
+        self._authoritative = False
+        self._fetched_at = float("-inf")
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._stats = {"refreshes": 0, "refresh_errors": 0, "rejected": 0}
+        self._models = {model: {"id": model} for model in FALLBACK_MODELS}
+
+    async def start(self):
+        """启动时在后台拉取目录，不阻塞启动"""
+        self.refresh()
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    def refresh(self):
+        """在后台刷新目录，已有刷新在进行时直接返回"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+        return self._refresh_task
+
+    async def _refresh(self):
+        token = await credential_provider.get_token()
+        if not token:
+            self._retry_soon()
+            return
+        try:
+            entries = await ChatAPI(token).list_models()
+        except Exception as e:
+            self._stats["refresh_errors"] += 1
+            self._retry_soon()
+            logger.warning("Failed to fetch Copilot model catalog: {}", e)
+            return
+        models = {entry["id"]: entry for entry in entries if entry.get("id")}
+        if not models:
+            return
+        self._models = models
+        self._authoritative = True
+        self._fetched_at = time.monotonic()
+        self._stats["refreshes"] += 1
+        logger.info("Copilot model catalog updated: {} models", len(models))
+
+    def _retry_soon(self):
+        """获取失败或尚未认证时，最多 60 秒后再尝试，避免每个请求都触发刷新"""
+        self._fetched_at = time.monotonic() - self.ttl + min(self.ttl, 60)
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self._fetched_at > self.ttl:
+            self._fetched_at = time.monotonic()
+            self.refresh()
+
+    async def ensure_loaded(self):
+        """首次使用时等待目录加载完成（请求 /v1/models 时使用）"""
+        if self._refresh_task is None:
+            self.refresh()
+        if not self._refresh_task.done():
+            await asyncio.shield(self._refresh_task)
+
+    def resolve(self, model: str) -> str:
+        """解析别名；目录来自上游且开启校验时，未知模型抛出 UnknownModelError"""
+        self._maybe_refresh()
+        model = self.aliases.get(model, model)
+        if self.validate and self._authoritative and model not in self._models:
+            self._stats["rejected"] += 1
+            raise UnknownModelError(model)
+        return model
+
+    def get_capabilities(self, model: str) -> Optional[Dict[str, Any]]:
+        entry = self._models.get(self.aliases.get(model, model))
+        return _capabilities(entry) if entry is not None else None
+
+    def list_models(self) -> List[Dict[str, Any]]:
+        """OpenAI 格式的模型列表，附带能力信息；别名作为单独条目列出"""
+        self._maybe_refresh()
+        data = []
+        for model, entry in self._models.items():
+            data.append({
+                "id": model,
+                "object": "model",
+                "created": 0,
+                "owned_by": entry.get("vendor", "github-copilot"),
+                "name": entry.get("name", model),
+                "capabilities": _capabilities(entry),
+            })
+        for alias, target in self.aliases.items():
+            if target in self._models and alias not in self._models:
+                data.append({
+                    "id": alias,
+                    "object": "model",
+                    "created": 0,
+                    "owned_by": self._models[target].get("vendor", "github-copilot"),
+                    "alias_for": target,
+                    "capabilities": _capabilities(self._models[target]),
+                })
+        return data
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["models"] = len(self._models)
+        stats["source"] = "upstream" if self._authoritative else "fallback"
+        stats["age"] = round(time.monotonic() - self._fetched_at, 1) if self._authoritative else None
+        return stats
+
+
+model_catalog = ModelCatalog()
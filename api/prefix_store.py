@@ -0,0 +1,100 @@
+"""
+对话前缀缓存：多轮对话每次都会重发相同的 system prompt 和历史消息。按消息列表的滚动哈希缓存
+已规范化、已校验、已计数的前缀，新请求只处理前缀之后新增的消息
+"""
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Any, List, Callable, Tuple
+
+from api import fast_json
+
+
+@dataclass
+class PreparedMessages:
+    # 与原始消息一一对应的处理结果（共享的缓存对象，调用方不可修改）
+    items: List[Any]
+    # 从缓存复用的前缀消息数
+    reused: int
+
+
+class PrefixStore:
+    def __init__(self):
+        self.max_bytes = int(float(os.getenv("PREFIX_CACHE_MAX_MB", 32)) * 1024 * 1024)
+        self._entries: "OrderedDict[bytes, Tuple[List[Any], int]]" = OrderedDict()
+        self._bytes = 0
+        self._stats = {"requests": 0, "hits": 0, "reused_messages": 0, "processed_messages": 0, "evictions": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def prepare(self, namespace: str, messages: List[Dict[str, Any]],
+                process: Callable[[Dict[str, Any]], Any]) -> PreparedMessages:
+        """对每条消息调用 process（可抛出 ValueError），已缓存的最长前缀直接复用。
+        namespace 区分结果依赖的上下文（如分词编码），不同 namespace 的前缀互不复用"""
+        if not self.enabled:
+            return PreparedMessages([process(m) for m in messages], 0)
+
+        # 滚动哈希：第 i 个键覆盖前 i 条消息，长度前缀保证消息边界不会产生歧义
+        hasher = hashlib.blake2b(namespace.encode(), digest_size=16)
+        keys = []
+        sizes = []
+        for message in messages:
+            raw = fast_json.dumps(message)
+            hasher.update(len(raw).to_bytes(4, "little"))
+            hasher.update(raw)
+            keys.append(hasher.copy().digest())
+            sizes.append(len(raw))
+
+        self._stats["requests"] += 1
+        reused = 0
+        prefix: List[Any] = []
+        for i in range(len(keys) - 1, -1, -1):
+            entry = self._entries.get(keys[i])
+            if entry is not None:
+                self._entries.move_to_end(keys[i])
+                prefix = entry[0]
+                reused = i + 1
+                break
+
+        if reused == len(messages):
+            items = prefix
+        else:
+            items = prefix + [process(m) for m in messages[reused:]]
+            size = sum(sizes)
+            # 单个对话超过上限时不缓存，避免把其他对话全部挤出
+            if size <= self.max_bytes:
+                self._store(keys[-1], items, size)
+
+        if reused:
+            self._stats["hits"] += 1
+        self._stats["reused_messages"] += reused
+        self._stats["processed_messages"] += len(messages) - reused
+        return PreparedMessages(items, reused)
+
+    def _store(self, key: bytes, items: List[Any], size: int):
+        # 各前缀条目共享消息对象，按原始字节数计算是对占用的保守估计
+        self._entries[key] = (items, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= evicted
+            self._stats["evictions"] += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        total = stats["reused_messages"] + stats["processed_messages"]
+        # 按消息计的命中率，即节省的单条消息处理比例
+        stats["hit_rate"] = round(stats["reused_messages"] / total, 4) if total else 0.0
+        stats["entries"] = len(self._entries)
+        stats["bytes"] = self._bytes
+        return stats
+
+
+prefix_store = PrefixStore()
@@ -0,0 +1,65 @@
+"""
+请求日志：按级别控制的负载日志（采样 + 截断）、队列化异步输出、每个请求一条汇总记录
+"""
+import os
+import random
+import sys
+import uuid
+from typing import Any
+
+from loguru import logger
+
+from api import fast_json
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# 负载日志（请求体、响应体）的采样率，0~1
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 1))
+# 单条负载日志的最大字符数
+LOG_MAX_PAYLOAD = int(os.getenv("LOG_MAX_PAYLOAD", 2000))
+
+_payload_enabled = False
+
+
+def setup():
+    """配置 loguru：日志经队列由后台线程写出，不阻塞事件循环"""
+    global _payload_enabled
+    level = LOG_LEVEL
+    try:
+        logger.level(level)
+    except ValueError:
+        level = "INFO"
+    logger.remove()
+    logger.add(sys.stderr, level=level, enqueue=True)
+    if level != LOG_LEVEL:
+        logger.warning("Unknown LOG_LEVEL {!r}, falling back to INFO", LOG_LEVEL)
+    _payload_enabled = logger.level(level).no <= logger.level("DEBUG").no
+
+
+def new_request_id(value: str = "") -> str:
+    return value or uuid.uuid4().hex
+
+
+def payload_enabled() -> bool:
+    """是否需要记录负载；未开启时调用方不应序列化任何负载"""
+    return _payload_enabled and (LOG_SAMPLE_RATE >= 1 or random.random() < LOG_SAMPLE_RATE)
+
+
+def log_payload(kind: str, request_id: str, payload: Any):
+    """以 DEBUG 级别记录负载，超过 LOG_MAX_PAYLOAD 时截断"""
+    if isinstance(payload, (bytes, bytearray)):
+        text = bytes(payload[:LOG_MAX_PAYLOAD]).decode("utf-8", errors="replace")
+        size = len(payload)
+    else:
+        text = fast_json.dumps(payload).decode("utf-8", errors="replace")
+        size = len(text)
+        text = text[:LOG_MAX_PAYLOAD]
+    if size > LOG_MAX_PAYLOAD:
+        text += f"...(truncated, {size} bytes)"
+    logger.debug("[{}] {}: {}", request_id, kind, text)
+
+
+def log_summary(request_id: str, model: str, stream: bool, status: int, duration: float, **extra):
+    """每个请求结束时输出一条汇总"""
+    fields = " ".join(f"{k}={v}" for k, v in extra.items() if v is not None)
+    logger.info("[{}] model={} stream={} status={} duration={:.3f}s {}",
+                request_id, model, stream, status, duration, fields)
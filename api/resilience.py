@@ -0,0 +1,168 @@
+"""
+上游调用的容错策略：超时、带抖动的指数退避重试、按模型的熔断器、非流式请求的对冲
+"""
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Dict, Any, Optional, Deque
+
+from loguru import logger
+
+from api import metrics
+from api.errors import UpstreamError, AccountsExhaustedError
+
+# 连接超时
+CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 10))
+# 发出请求到收到响应头的超时
+FIRST_BYTE_TIMEOUT = float(os.getenv("UPSTREAM_FIRST_BYTE_TIMEOUT", 60))
+# 两次读取之间的空闲超时（流式 chunk 间隔、非流式响应体读取）
+IDLE_TIMEOUT = float(os.getenv("UPSTREAM_IDLE_TIMEOUT", 60))
+
+RETRYABLE_STATUS = (401, 429, 500, 502, 503, 504)
+
+
+class RetryPolicy:
+    """首字节之前的重试策略"""
+
+    def __init__(self):
+        self.max_attempts = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", os.getenv("ACCOUNT_MAX_ATTEMPTS", 3)))
+        self.backoff_base = float(os.getenv("UPSTREAM_RETRY_BACKOFF", 0.25))
+        self.backoff_max = float(os.getenv("UPSTREAM_RETRY_BACKOFF_MAX", 4))
+        self.retries = 0
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        if attempt >= self.max_attempts - 1:
+            return False
+        if isinstance(error, AccountsExhaustedError):
+            return False
+        return isinstance(error, UpstreamError) and error.status in RETRYABLE_STATUS
+
+    def backoff(self, error: UpstreamError, attempt: int) -> float:
+        """429 / 401 换账号后立即重试；5xx 和连接错误按带抖动的指数退避等待"""
+        if error.status in (401, 429):
+            return 0.0
+        delay = min(self.backoff_base * (2 ** attempt), self.backoff_max)
+        return random.uniform(0, delay)
+
+
+class CircuitBreaker:
+    """单个模型的熔断器：连续失败达到阈值后打开，冷却后放行一次试探请求"""
+
+    def __init__(self, model: str, failure_threshold: int, reset_timeout: float):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self.state = "closed"
+        self.trips = 0
+        self.rejected = 0
+
+    def check(self):
+        """熔断打开时直接失败"""
+        if self.state == "closed" or self.failure_threshold <= 0:
+            return
+        now = time.monotonic()
+        remaining = self.opened_at + self.reset_timeout - now
+        if remaining <= 0:
+            # 进入半开状态，放行本次请求作为试探；试探请求迟迟没有结果时，冷却结束后再放行一次
+            self.state = "half_open"
+            self.opened_at = now
+            return
+        self.rejected += 1
+        raise UpstreamError(503, f"upstream for model {self.model} is degraded, circuit open",
+                            retry_after=max(remaining, 1.0))
+
+    def record_success(self):
+        self.failures = 0
+        self.state = "closed"
+
+    def record_failure(self, error: BaseException):
+        # 只统计上游故障，客户端错误、限流、认证问题不触发熔断
+        if not isinstance(error, UpstreamError) or isinstance(error, AccountsExhaustedError):
+            return
+        if error.status < 500:
+            if self.state == "half_open":
+                # 上游有响应，说明已经恢复
+                self.record_success()
+            return
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold > 0:
+            if self.state != "open":
+                self.trips += 1
+                logger.warning("Circuit open for model {} after {} failures", self.model, self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class CircuitBreakers:
+    def __init__(self):
+        self.failure_threshold = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+        self.reset_timeout = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(model, self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            model: {"state": b.state, "failures": b.failures, "trips": b.trips, "rejected": b.rejected}
+            for model, b in self._breakers.items()
+        }
+
+
+class LatencyTracker:
+    """记录每个模型最近的非流式请求耗时，用于计算对冲延迟"""
+
+    def __init__(self):
+        self.enabled = os.getenv("UPSTREAM_HEDGE", "false").lower() in ("1", "true", "yes")
+        self.quantile = float(os.getenv("UPSTREAM_HEDGE_QUANTILE", 0.95))
+        self.min_samples = int(os.getenv("UPSTREAM_HEDGE_MIN_SAMPLES", 20))
+        self._samples: Dict[str, Deque[float]] = {}
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def observe(self, model: str, duration: float):
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=200)
+        samples.append(duration)
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        """超过该延迟仍未完成时发起对冲请求；样本不足或未开启时返回 None"""
+        if not self.enabled:
+            return None
+        samples = self._samples.get(model)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * self.quantile), len(ordered) - 1)]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "hedged": self.hedged, "hedge_wins": self.hedge_wins}
+
+
+retry_policy = RetryPolicy()
+circuit_breakers = CircuitBreakers()
+latency_tracker = LatencyTracker()
+
+
+def get_stats() -> Dict[str, Any]:
+    return {
+        "retries": retry_policy.retries,
+        "hedging": latency_tracker.get_stats(),
+        "circuit_breakers": circuit_breakers.get_stats(),
+    }
+
+
+async def sleep_backoff(error: UpstreamError, attempt: int):
+    retry_policy.retries += 1
+    metrics.UPSTREAM_RETRIES.inc()
+    delay = retry_policy.backoff(error, attempt)
+    if delay > 0:
+        await asyncio.sleep(delay)
@@ -0,0 +1,256 @@
+"""
+非流式补全的响应缓存与请求合并
+"""
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Callable, Awaitable, Tuple, Union
+
+from loguru import logger
+
+from api import fast_json
+from api.chat_stream import normalize_messages, PASSTHROUGH
+
+# 参与缓存键计算的采样参数
+SAMPLING_PARAMS = (
+    "temperature", "top_p", "n", "max_tokens", "stop", "presence_penalty",
+    "frequency_penalty", "seed", "tools", "tool_choice", "response_format",
+)
+
+
+class _LeaderCancelled(Exception):
+    """合并请求时发起上游调用的请求被取消，等待者需要重新发起"""
+
+
+class MemoryBackend:
+    """进程内 LRU 缓存，按 TTL 过期，按序列化后的字节数限制内存"""
+
+    def __init__(self, ttl: float, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._size = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.time():
+            self._remove(key)
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        self._remove(key)
+        self._items[key] = (time.time() + self.ttl, value)
+        self._size += len(value)
+        while self._size > self.max_bytes:
+            oldest = next(iter(self._items))
+            self._remove(oldest)
+
+    def _remove(self, key: str):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= len(item[1])
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._items), "bytes": self._size}
+
+
+class DiskBackend:
+    """本地磁盘缓存，每个响应一个文件，文件读写在线程池中执行"""
+
+    def __init__(self, directory: str, ttl: float, max_bytes: int):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # key -> 文件大小，按写入顺序排列，用于淘汰
+        self._index: Optional["OrderedDict[str, int]"] = None
+        self._size = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def _load_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            entries.append((st.st_mtime, name[:-5], st.st_size))
+        entries.sort()
+        self._index = OrderedDict((key, size) for _, key, size in entries)
+        self._size = sum(self._index.values())
+
+    async def _ensure_index(self):
+        if self._index is None:
+            await asyncio.to_thread(self._load_index)
+
+    def _read(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            if os.stat(path).st_mtime + self.ttl < time.time():
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, key: str, value: bytes, evict: list):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+        for old in evict:
+            try:
+                os.remove(self._path(old))
+            except OSError:
+                pass
+
+    async def get(self, key: str) -> Optional[bytes]:
+        await self._ensure_index()
+        if key not in self._index:
+            return None
+        value = await asyncio.to_thread(self._read, key)
+        if value is None:
+            self._size -= self._index.pop(key, 0)
+        return value
+
+    async def set(self, key: str, value: bytes):
+        await self._ensure_index()
+        if len(value) > self.max_bytes:
+            return
+        self._size -= self._index.pop(key, 0)
+        self._index[key] = len(value)
+        self._size += len(value)
+        evict = []
+        while self._size > self.max_bytes:
+            old, size = self._index.popitem(last=False)
+            self._size -= size
+            evict.append(old)
+        await asyncio.to_thread(self._write, key, value, evict)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._index or ()), "bytes": self._size, "directory": self.directory}
+
+
+class ResponseCache:
+    """按规范化请求的哈希缓存非流式响应；相同请求并发到达时只发起一次上游调用"""
+
+    def __init__(self):
+        self.backend_name = os.getenv("RESPONSE_CACHE", "").lower()
+        ttl = float(os.getenv("RESPONSE_CACHE_TTL", 600))
+        max_bytes = int(float(os.getenv("RESPONSE_CACHE_MAX_MB", 64)) * 1024 * 1024)
+        if self.backend_name == "memory":
+            self.backend = MemoryBackend(ttl, max_bytes)
+        elif self.backend_name == "disk":
+            directory = os.getenv("RESPONSE_CACHE_DIR", os.path.join(".cache", "responses"))
+            self.backend = DiskBackend(directory, ttl, max_bytes)
+        else:
+            self.backend = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0, "bypassed": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    @staticmethod
+    def cache_key(data: dict, normalized: Optional[List[Dict[str, str]]] = None) -> Optional[str]:
+        """请求的规范化哈希；只有 temperature 为 0 的确定性请求可以缓存。normalized 为已规范化的消息"""
+        if data.get("temperature", 0.7) != 0:
+            return None
+        messages = data.get("messages", [])
+        if not PASSTHROUGH and normalized is None:
+            normalized = normalize_messages(messages)
+        canonical = {
+            "model": data.get("model", "gpt-4"),
+            # 透传模式下上游收到的是原始消息（可能包含图片、工具调用），不能按规范化结果合并
+            "messages": messages if PASSTHROUGH else normalized,
+        }
+        for name in SAMPLING_PARAMS:
+            if data.get(name) is not None:
+                canonical[name] = data[name]
+        payload = fast_json.dumps(_sort_keys(canonical))
+        return hashlib.sha256(payload).hexdigest()
+
+    async def fetch(
+            self,
+            data: dict,
+            run: Callable[[dict], Awaitable[Union[Dict[str, Any], bytes]]],
+            bypass: bool = False,
+            normalized: Optional[List[Dict[str, str]]] = None,
+    ) -> Tuple[bytes, str]:
+        """返回序列化后的响应以及缓存状态（HIT / MISS / COALESCED / BYPASS）"""
+        key = None if bypass else self.cache_key(data, normalized)
+        if key is None:
+            self._stats["bypassed"] += 1
+            return fast_json.ensure_bytes(await run(data)), "BYPASS"
+
+        while True:
+            value = await self.backend.get(key)
+            if value is not None:
+                self._stats["hits"] += 1
+                return value, "HIT"
+
+            future = self._inflight.get(key)
+            if future is None:
+                break
+            try:
+                value = await asyncio.shield(future)
+            except _LeaderCancelled:
+                # 发起上游调用的请求被取消（客户端断开），重新检查，由第一个醒来的等待者接替发起
+                continue
+            self._stats["coalesced"] += 1
+            return value, "COALESCED"
+
+        self._stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = fast_json.ensure_bytes(await run(data))
+            try:
+                await self.backend.set(key, value)
+            except Exception as e:
+                logger.warning("Write response cache failed: {}", e)
+            future.set_result(value)
+        except asyncio.CancelledError:
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 避免无人等待时出现 "exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        return value, "MISS"
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["backend"] = self.backend_name or "disabled"
+        if self.backend is not None:
+            stats.update(self.backend.get_stats())
+        return stats
+
+
+def _sort_keys(obj: Any) -> Any:
+    """递归排序字典键，保证相同请求得到相同的序列化结果"""
+    if isinstance(obj, dict):
+        return {k: _sort_keys(obj[k]) for k in sorted(obj)}
+    if isinstance(obj, list):
+        return [_sort_keys(v) for v in obj]
+    return obj
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,181 @@
+"""
+准入控制：全局并发上限、按 API key 的令牌桶限流、带超时的优先级队列
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Tuple
+
+from loguru import logger
+
+from api.shared_state import shared_store, hash_key, SharedStateLockTimeout
+
+
+class OverloadedError(Exception):
+    """请求被拒绝，客户端应在 retry_after 秒后重试"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """令牌桶，rate 为每秒补充的令牌数，burst 为桶容量"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self) -> float:
+        """尝试取出一个令牌，成功返回 0，否则返回需要等待的秒数"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+def _consume_shared(state: Dict[str, Any], key: str, rate: float, burst: float) -> float:
+    """在共享状态上执行令牌桶扣减，时间使用墙上时钟以便跨进程比较"""
+    now = time.time()
+    tokens, updated = state.get(key, (burst, now))
+    tokens = min(burst, tokens + (now - updated) * rate)
+    wait = 0.0
+    if tokens >= 1:
+        tokens -= 1
+    else:
+        wait = (1 - tokens) / rate
+    state[key] = (tokens, now)
+    if len(state) > 1000:
+        # 清理早已补满的桶，避免共享文件无限增长
+        for k in [k for k, (t, u) in state.items() if t + (now - u) * rate >= burst]:
+            del state[k]
+    return wait
+
+
+class Scheduler:
+    """位于接口与上游调用之间的调度器"""
+
+    def __init__(self):
+        # 全局在途请求上限，0 表示不限制
+        self.max_inflight = int(os.getenv("MAX_INFLIGHT", 0))
+        self.max_queue = int(os.getenv("MAX_QUEUE", 100))
+        self.queue_timeout = float(os.getenv("QUEUE_TIMEOUT", 30))
+        # 每个 API key 每秒请求数，0 表示不限制
+        self.rate_limit = float(os.getenv("RATE_LIMIT_RPS", 0))
+        self.rate_burst = float(os.getenv("RATE_LIMIT_BURST", max(self.rate_limit, 1)))
+        self.inflight = 0
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._stats = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_rate_limit": 0,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+
+    async def _check_rate_limit(self, key: str):
+        if self.rate_limit <= 0:
+            return
+        if shared_store.enabled:
+            # 多 worker 模式：令牌桶状态保存在共享存储中
+            try:
+                wait = await shared_store.update(
+                    "rate_limits",
+                    lambda state: _consume_shared(state, hash_key(key), self.rate_limit, self.rate_burst))
+            except SharedStateLockTimeout as e:
+                # 共享存储长时间不可用时放行，不因限流状态阻塞请求
+                logger.warning("Shared rate limit unavailable: {}", e)
+                wait = 0
+        else:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate_limit, self.rate_burst)
+            wait = bucket.consume()
+        if wait > 0:
+            self._stats["rejected_rate_limit"] += 1
+            raise OverloadedError("Rate limit reached for this API key", retry_after=wait)
+
+    async def acquire(self, key: str = "", priority: int = 0):
+        """获取一个执行名额，priority 越大越先出队"""
+        await self._check_rate_limit(key)
+        if self.max_inflight <= 0 or (self.inflight < self.max_inflight and not self._queue):
+            self.inflight += 1
+            self._stats["admitted"] += 1
+            return
+
+        if len(self._queue) >= self.max_queue:
+            self._stats["rejected_queue_full"] += 1
+            raise OverloadedError("Server is overloaded, please retry later", retry_after=1.0)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (-priority, next(self._seq), future))
+        self._stats["queued"] += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._remove(future)
+            self._stats["rejected_timeout"] += 1
+            raise OverloadedError("Request timed out waiting in queue", retry_after=1.0)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额已经交接给本请求，需要归还
+                self.release()
+            else:
+                self._remove(future)
+            raise
+        wait = time.monotonic() - start
+        self._stats["admitted"] += 1
+        self._stats["wait_time_total"] += wait
+        self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait)
+
+    def _remove(self, future: asyncio.Future):
+        self._queue = [item for item in self._queue if item[2] is not future]
+        heapq.heapify(self._queue)
+
+    def release(self):
+        """归还名额，优先直接交给队列中的下一个请求"""
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.inflight -= 1
+
+    @asynccontextmanager
+    async def slot(self, key: str = "", priority: int = 0):
+        await self.acquire(key, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["inflight"] = self.inflight
+        stats["queue_depth"] = self.queue_depth
+        stats["max_inflight"] = self.max_inflight
+        queued = stats["queued"] - stats["rejected_timeout"]
+        stats["wait_time_avg"] = round(stats["wait_time_total"] / queued, 4) if queued > 0 else 0.0
+        stats["wait_time_total"] = round(stats["wait_time_total"], 4)
+        stats["wait_time_max"] = round(stats["wait_time_max"], 4)
+        return stats
+
+
+scheduler = Scheduler()
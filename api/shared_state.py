@@ -0,0 +1,103 @@
+"""
+多进程共享状态：基于文件锁的 JSON 存储，供多个 worker 共享 Copilot token 和限流状态
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, Callable, Dict
+
+try:
+    import fcntl
+except ImportError:  # Windows 下不支持，退回进程内状态
+    fcntl = None
+
+# 等待文件锁的最长秒数
+LOCK_TIMEOUT = float(os.getenv("SHARED_STATE_LOCK_TIMEOUT", 5))
+
+
+class SharedStateLockTimeout(TimeoutError):
+    """在 SHARED_STATE_LOCK_TIMEOUT 内没有拿到文件锁"""
+
+
+def hash_key(value: str) -> str:
+    """避免把 OAuth token、API key 原文写入磁盘"""
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]
+
+
+class SharedStore:
+    """每个名字对应目录下的一个 JSON 文件，读写均在独占文件锁内完成"""
+
+    def __init__(self):
+        self.directory = os.getenv("SHARED_STATE_DIR", "")
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and fcntl is not None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name + ".json")
+
+    async def _lock(self, name: str) -> int:
+        """非阻塞地尝试加锁，失败时在事件循环中退避重试，不占用线程池线程等待"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, name + ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        delay = 0.001
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    pass
+                if time.monotonic() >= deadline:
+                    raise SharedStateLockTimeout(f"could not lock shared state {name!r} in {LOCK_TIMEOUT}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.01)
+        except BaseException:
+            os.close(fd)
+            raise
+
+    @staticmethod
+    def _unlock(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _read(self, name: str) -> Dict[str, Any]:
+        try:
+            with open(self._path(name), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, name: str, state: Dict[str, Any]):
+        path = self._path(name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    def _update(self, name: str, fn: Callable[[Dict[str, Any]], Any]) -> Any:
+        state = self._read(name)
+        result = fn(state)
+        self._write(name, state)
+        return result
+
+    async def update(self, name: str, fn: Callable[[Dict[str, Any]], Any]) -> Any:
+        """在文件锁内读取状态、调用 fn 原地修改并写回，返回 fn 的结果；锁只在这次文件读写期间持有"""
+        fd = await self._lock(name)
+        try:
+            return await asyncio.to_thread(self._update, name, fn)
+        finally:
+            self._unlock(fd)
+
+    async def read(self, name: str) -> Dict[str, Any]:
+        """读取无需加锁：写入通过 os.replace 原子替换"""
+        return await asyncio.to_thread(self._read, name)
+
+
+shared_store = SharedStore()
+
@@ -0,0 +1,210 @@
+"""
+上游 SSE 到 OpenAI chat.completion.chunk 的转发，以及把 SSE 聚合为完整的 chat.completion
+"""
+import time
+from dataclasses import dataclass
+from typing import Optional, List, Dict, Any
+
+from api import fast_json
+from api.errors import UpstreamError
+
+DONE = b"data: [DONE]\n\n"
+
+
+@dataclass
+class StreamUsage:
+    """流式响应结束（或中断）时写入上游返回的 usage 和已转发的输出文本，供调用方计量"""
+    usage: Optional[dict] = None
+    completion_text: str = ""
+
+
+class SSERelay:
+    """单次补全的 SSE 转发器：id/created/model 等不变字段只序列化一次，逐行只解析并转发 choices"""
+
+    def __init__(self, model: str, track_usage: bool = False):
+        self.completion_id = f"chatcmpl-{int(time.time() * 1000)}"
+        self.created = int(time.time())
+        self.model = model
+        self.done = False
+        # track_usage 时记录上游返回的 usage 和输出文本，用于在上游未返回 usage 时估算
+        self.usage: Optional[dict] = None
+        self._parts: Optional[List[str]] = [] if track_usage else None
+        self._prefix = (
+                b'data: {"id":' + fast_json.dumps(self.completion_id)
+                + b',"object":"chat.completion.chunk","created":' + str(self.created).encode()
+                + b',"model":' + fast_json.dumps(model)
+                + b',"choices":'
+        )
+
+    def feed(self, line: bytes) -> Optional[bytes]:
+        """处理一行上游数据，返回可直接写给客户端的 SSE 事件，无需转发时返回 None"""
+        if not line.startswith(b"data:"):
+            return None
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            self.done = True
+            return None
+
+        chunk = fast_json.loads(data)
+        choices = chunk.get("choices")
+        usage = chunk.get("usage")
+        if not choices and not usage:
+            return None
+        if self._parts is not None:
+            if usage:
+                self.usage = usage
+            for choice in choices or ():
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    self._parts.append(content)
+        return self.build(choices or [], usage)
+
+    @property
+    def completion_text(self) -> str:
+        return "".join(self._parts or ())
+
+    def build(self, choices: list, usage: Optional[dict] = None) -> bytes:
+        """用预构造的信封包装 choices（以及可选的 usage）"""
+        if usage:
+            return self._prefix + fast_json.dumps(choices) + b',"usage":' + fast_json.dumps(usage) + b"}\n\n"
+        return self._prefix + fast_json.dumps(choices) + b"}\n\n"
+
+
+class PassthroughRelay:
+    """透传模式：上游 data 行原样转发；track_usage 时额外解析每一行，记录 usage 和输出文本"""
+
+    def __init__(self, track_usage: bool = False):
+        self.done = False
+        self.usage: Optional[dict] = None
+        self._parts: Optional[List[str]] = [] if track_usage else None
+
+    def feed(self, line: bytes) -> Optional[bytes]:
+        if not line.startswith(b"data:"):
+            return None
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            self.done = True
+            return None
+        if self._parts is not None and data:
+            self._track(data)
+        return line.rstrip(b"\r\n") + b"\n\n"
+
+    def _track(self, data: bytes):
+        try:
+            chunk = fast_json.loads(data)
+        except ValueError:
+            return
+        if not isinstance(chunk, dict):
+            return
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        for choice in chunk.get("choices") or ():
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                self._parts.append(content)
+
+    @property
+    def completion_text(self) -> str:
+        return "".join(self._parts or ())
+
+
+def _new_choice() -> Dict[str, Any]:
+    return {"role": "assistant", "content": [], "tool_calls": {}, "finish_reason": None}
+
+
+class CompletionAggregator:
+    """把上游 SSE 事件逐个合并为完整的 chat.completion：文本按片段暂存、结束时一次拼接，
+    tool_calls 按 index 合并（arguments 同样分片累积），不需要缓冲或解析整个响应体"""
+
+    def __init__(self, model: str, keep_upstream_fields: bool = False):
+        self.model = model
+        self.done = False
+        self.usage: Optional[dict] = None
+        # 透传模式下沿用上游的 id / created / model / system_fingerprint
+        self._keep_upstream_fields = keep_upstream_fields
+        self._envelope: Dict[str, Any] = {}
+        self._choices: Dict[int, Dict[str, Any]] = {}
+
+    def feed(self, line: bytes):
+        """处理一行上游数据，无法解析时抛出 ValueError，上游在流中返回错误时抛出 UpstreamError"""
+        if not line.startswith(b"data:"):
+            return
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            self.done = True
+            return
+
+        chunk = fast_json.loads(data)
+        if chunk.get("error"):
+            error = chunk["error"]
+            raise UpstreamError(502, error.get("message", str(error)) if isinstance(error, dict) else str(error))
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        choices = chunk.get("choices")
+        if not choices:
+            return
+        if self._keep_upstream_fields:
+            for key in ("id", "created", "model", "system_fingerprint"):
+                if chunk.get(key):
+                    self._envelope[key] = chunk[key]
+        for choice in choices:
+            self._merge(choice)
+
+    def _merge(self, choice: Dict[str, Any]):
+        state = self._choices.setdefault(choice.get("index", 0), _new_choice())
+        delta = choice.get("delta") or {}
+        if delta.get("role"):
+            state["role"] = delta["role"]
+        if delta.get("content"):
+            state["content"].append(delta["content"])
+        for call in delta.get("tool_calls") or ():
+            merged = state["tool_calls"].setdefault(
+                call.get("index", 0), {"id": None, "type": "function", "name": "", "arguments": []})
+            if call.get("id"):
+                merged["id"] = call["id"]
+            if call.get("type"):
+                merged["type"] = call["type"]
+            function = call.get("function") or {}
+            if function.get("name"):
+                merged["name"] += function["name"]
+            if function.get("arguments"):
+                merged["arguments"].append(function["arguments"])
+        if choice.get("finish_reason"):
+            state["finish_reason"] = choice["finish_reason"]
+
+    @property
+    def finished(self) -> bool:
+        """上游是否已经给出结束标记（[DONE] 或 finish_reason），用于区分正常结束与中途断开"""
+        return self.done or any(c["finish_reason"] for c in self._choices.values())
+
+    @property
+    def completion_text(self) -> str:
+        return "".join(self._choices[0]["content"]) if 0 in self._choices else ""
+
+    def result(self, usage: Optional[dict] = None) -> Dict[str, Any]:
+        """构造 chat.completion，usage 为上游未返回 usage 时使用的替代值"""
+        choices = []
+        for index in sorted(self._choices) or [0]:
+            state = self._choices.get(index) or _new_choice()
+            message: Dict[str, Any] = {"role": state["role"], "content": "".join(state["content"])}
+            if state["tool_calls"]:
+                if not state["content"]:
+                    message["content"] = None
+                message["tool_calls"] = [
+                    {"id": call["id"], "type": call["type"],
+                     "function": {"name": call["name"], "arguments": "".join(call["arguments"])}}
+                    for _, call in sorted(state["tool_calls"].items())
+                ]
+            finish_reason = state["finish_reason"] or ("tool_calls" if state["tool_calls"] else "stop")
+            choices.append({"index": index, "message": message, "finish_reason": finish_reason})
+        response = {
+            "id": self._envelope.get("id") or f"chatcmpl-{int(time.time() * 1000)}",
+            "object": "chat.completion",
+            "created": self._envelope.get("created") or int(time.time()),
+            "model": self._envelope.get("model") or self.model,
+            "choices": choices,
+            "usage": self.usage or usage or {},
+        }
+        if self._envelope.get("system_fingerprint"):
+            response["system_fingerprint"] = self._envelope["system_fingerprint"]
+        return response
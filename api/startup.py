@@ -0,0 +1,120 @@
+"""
+启动预热与就绪状态：接收流量前解析凭据、获取 Copilot token、加载模型目录并建立上游连接，
+避免第一个请求承担这些开销
+"""
+import asyncio
+import os
+import time
+from typing import Dict, Any, Optional
+
+from loguru import logger
+
+from api.chat_api import COPILOT_API_BASE
+from api.http_client import http_client
+from api.model_catalog import model_catalog
+from api.token_counter import token_counter
+from api.token_manager import copilot_tokens
+from auth.credential_provider import credential_provider
+
+STARTUP_PREWARM = os.getenv("STARTUP_PREWARM", "true").lower() in ("1", "true", "yes")
+# 预热的最长耗时（秒），超时后本次预热视为失败
+PREWARM_TIMEOUT = float(os.getenv("PREWARM_TIMEOUT", 15))
+# 预先建立的 Copilot API 连接数
+PREWARM_CONNECTIONS = int(os.getenv("PREWARM_CONNECTIONS", 2))
+
+
+class Readiness:
+    """预热在后台执行，不阻塞进程开始监听（/healthz 立即可用）；预热成功后 /readyz 才返回就绪。
+    预热失败（尚未认证、GitHub 不可用）时由下一次就绪探针触发重试"""
+
+    def __init__(self):
+        self.ready = False
+        self.checks: Dict[str, str] = {}
+        self.prewarm_seconds: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if not STARTUP_PREWARM:
+            self.ready = True
+            return
+        self._task = asyncio.create_task(self._prewarm())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def check(self) -> bool:
+        """就绪探针调用：返回是否就绪，上一次预热失败时在后台重新预热"""
+        if self.ready:
+            return True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._prewarm())
+        return False
+
+    async def _prewarm(self):
+        start = time.perf_counter()
+        self.checks = {}
+        try:
+            await asyncio.wait_for(self._run(), PREWARM_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.checks["timeout"] = f"prewarm did not finish in {PREWARM_TIMEOUT}s"
+        except Exception as e:
+            self.checks["error"] = str(e)
+        self.prewarm_seconds = round(time.perf_counter() - start, 3)
+        self.ready = all(result == "ok" for result in self.checks.values())
+        if self.ready:
+            logger.info("Prewarm finished in {}s", self.prewarm_seconds)
+        else:
+            logger.warning("Prewarm incomplete after {}s: {}", self.prewarm_seconds, self.checks)
+
+    async def _run(self):
+        # 分词器在后台线程中加载，与下面的网络请求并行
+        tokenizer = asyncio.create_task(self._step("tokenizer", token_counter.wait_loaded()))
+        try:
+            await self._run_upstream()
+        finally:
+            await tokenizer
+
+    async def _run_upstream(self):
+        pool = await credential_provider.get_pool()
+        tokens = pool.tokens()
+        if not tokens:
+            self.checks["credentials"] = "no GitHub token configured, visit /auth/device"
+            return
+        self.checks["credentials"] = "ok"
+
+        # 所有账号的 Copilot token 并行获取，同时建立到 GitHub API 的连接
+        results = await asyncio.gather(*(copilot_tokens.get_token(t) for t in tokens), return_exceptions=True)
+        failed = [r for r in results if isinstance(r, BaseException)]
+        if len(failed) == len(results):
+            self.checks["copilot_token"] = str(failed[0])
+            return
+        self.checks["copilot_token"] = "ok"
+
+        # 模型目录的获取会建立第一条 Copilot API 连接，其余连接并行建立
+        await asyncio.gather(
+            self._step("model_catalog", model_catalog.ensure_loaded()),
+            self._step("connections", http_client.prewarm(COPILOT_API_BASE, max(PREWARM_CONNECTIONS - 1, 0))),
+        )
+
+    async def _step(self, name: str, awaitable):
+        try:
+            await awaitable
+            self.checks[name] = "ok"
+        except Exception as e:
+            self.checks[name] = str(e) or type(e).__name__
+
+    def degraded(self) -> Dict[str, str]:
+        """不影响就绪、但服务能力降级的项；上游模型目录获取失败时使用内置列表，目录会在后台自行重试"""
+        degraded = {}
+        if model_catalog.get_stats()["source"] != "upstream":
+            degraded["model_catalog"] = "using the built-in model list"
+        return degraded
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "prewarm": STARTUP_PREWARM, "prewarm_seconds": self.prewarm_seconds,
+                "checks": self.checks, "degraded": self.degraded()}
+
+
+readiness = Readiness()
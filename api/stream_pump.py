@@ -0,0 +1,66 @@
+"""
+上游流与客户端之间的有界缓冲：客户端读得慢时暂停读取上游，客户端断开时立即取消上游请求
+"""
+import asyncio
+import os
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable
+
+# 上游与客户端之间最多缓冲的事件数，缓冲满时暂停读取上游
+STREAM_BUFFER_CHUNKS = int(os.getenv("STREAM_BUFFER_CHUNKS", 64))
+# 检测客户端断开的间隔（秒）
+STREAM_DISCONNECT_POLL = float(os.getenv("STREAM_DISCONNECT_POLL", 0.5))
+
+_END = object()
+
+
+class ClientDisconnected(Exception):
+    """客户端在流式响应结束前断开"""
+
+
+async def pump(source: AsyncIterator[bytes],
+               is_disconnected: Callable[[], Awaitable[bool]]) -> AsyncGenerator[bytes, None]:
+    """在后台任务中读取 source 并写入有界队列，逐个产出；检测到客户端断开时取消读取任务
+    （上游响应随之关闭，连接不再复用）并抛出 ClientDisconnected"""
+    queue: asyncio.Queue = asyncio.Queue(STREAM_BUFFER_CHUNKS)
+    disconnected = asyncio.Event()
+
+    async def produce():
+        try:
+            async for chunk in source:
+                await queue.put(chunk)
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(_END)
+
+    producer = asyncio.create_task(produce())
+
+    async def watch():
+        # 读取任务结束后不再需要检测，剩余数据已在队列中
+        while not producer.done():
+            if await is_disconnected():
+                disconnected.set()
+                producer.cancel()
+                if queue.empty():
+                    # 唤醒正在等待数据的消费方；队列非空时消费方会在取下一项前检查断开标志
+                    queue.put_nowait(_END)
+                return
+            await asyncio.sleep(STREAM_DISCONNECT_POLL)
+
+    watcher = asyncio.create_task(watch())
+    try:
+        while True:
+            if disconnected.is_set():
+                raise ClientDisconnected()
+            item = await queue.get()
+            if item is _END:
+                if disconnected.is_set():
+                    raise ClientDisconnected()
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+        watcher.cancel()
+        await asyncio.gather(producer, watcher, return_exceptions=True)
@@ -0,0 +1,188 @@
+"""
+本地 token 计数：优先使用 tiktoken，未安装时按字节数估算；按消息内容哈希缓存计数结果，
+并按模型上下文上限校验或截断对话
+"""
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+from loguru import logger
+
+from api import fast_json
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 每条消息的格式开销，以及回复前缀的开销（与 OpenAI 的计数方式一致）
+MESSAGE_OVERHEAD = 3
+REPLY_OVERHEAD = 3
+# 图片按固定 token 数估算
+IMAGE_TOKENS = 85
+# 使用 o200k_base 编码的模型前缀，其余模型（包括非 OpenAI 模型）按 cl100k_base 近似
+_O200K_PREFIXES = ("gpt-4o", "gpt-4.1", "gpt-5", "o1", "o3", "o4")
+ENCODINGS = ("cl100k_base", "o200k_base")
+
+
+class ContextLengthError(ValueError):
+    """对话超过模型的上下文上限"""
+
+    def __init__(self, model: str, limit: int, tokens: int):
+        super().__init__(f"This model's maximum context length is {limit} tokens, "
+                         f"however your messages resulted in about {tokens} tokens ({model}).")
+        self.limit = limit
+        self.tokens = tokens
+
+
+def _estimate(text: str) -> int:
+    """没有分词器时的估算：约 4 个 UTF-8 字节一个 token，中文等多字节字符约一字一个 token"""
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+class TokenCounter:
+    def __init__(self):
+        self.cache_size = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", 10000))
+        self._encodings: Dict[str, Any] = {}
+        self._load_task: Optional[asyncio.Task] = None
+        self._memo: "OrderedDict[bytes, int]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "truncated": 0, "dropped_messages": 0, "rejected": 0}
+
+    @property
+    def backend(self) -> str:
+        return "tiktoken" if self._encodings else "heuristic"
+
+    async def start(self):
+        """在后台线程中加载编码（首次使用时 tiktoken 可能需要下载编码文件），不阻塞事件循环"""
+        if tiktoken is not None and self._load_task is None:
+            self._load_task = asyncio.create_task(asyncio.to_thread(self._load_encodings))
+
+    async def wait_loaded(self):
+        if self._load_task is not None:
+            await asyncio.shield(self._load_task)
+
+    def _load_encodings(self):
+        for name in ENCODINGS:
+            try:
+                self._encodings[name] = tiktoken.get_encoding(name)
+            except Exception as e:
+                # 离线环境下可能无法下载编码文件
+                logger.warning("Failed to load tokenizer {}, falling back to estimation: {}", name, e)
+
+    def _encoding(self, model: str):
+        """请求路径上只使用已加载的编码，加载完成前（或加载失败时）按字节数估算"""
+        return self._encodings.get("o200k_base" if model.startswith(_O200K_PREFIXES) else "cl100k_base")
+
+    def encoding_name(self, model: str) -> str:
+        encoding = self._encoding(model)
+        return encoding.name if encoding is not None else "heuristic"
+
+    def count_text(self, model: str, text: str) -> int:
+        if not text:
+            return 0
+        encoding = self._encoding(model)
+        if encoding is None:
+            return _estimate(text)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def _count_message(self, model: str, message: Dict[str, Any]) -> int:
+        tokens = MESSAGE_OVERHEAD + self.count_text(model, str(message.get("role", "")))
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += self.count_text(model, content)
+        elif isinstance(content, list):
+            for part in content:
+                if not isinstance(part, dict):
+                    continue
+                if part.get("type") == "image_url" or "image_url" in part:
+                    tokens += IMAGE_TOKENS
+                else:
+                    tokens += self.count_text(model, part.get("text") or "")
+        for field in ("name", "tool_call_id"):
+            if message.get(field):
+                tokens += self.count_text(model, str(message[field]))
+        if message.get("tool_calls"):
+            tokens += self.count_text(model, fast_json.dumps(message["tool_calls"]).decode("utf-8"))
+        return tokens
+
+    def count_message(self, model: str, message: Dict[str, Any]) -> int:
+        """单条消息的 token 数，按 (编码, 消息内容) 的哈希缓存，重复的历史消息不会重新分词"""
+        digest = hashlib.blake2b(fast_json.dumps(message), digest_size=16)
+        digest.update(self.encoding_name(model).encode())
+        key = digest.digest()
+        tokens = self._memo.get(key)
+        if tokens is not None:
+            self._stats["hits"] += 1
+            self._memo.move_to_end(key)
+            return tokens
+        self._stats["misses"] += 1
+        tokens = self._count_message(model, message)
+        self._memo[key] = tokens
+        if len(self._memo) > self.cache_size:
+            self._memo.popitem(last=False)
+        return tokens
+
+    def count_messages(self, model: str, messages: List[Dict[str, Any]]) -> int:
+        return sum(self.count_message(model, m) for m in messages) + REPLY_OVERHEAD
+
+    def fit(self, model: str, messages: List[Dict[str, Any]], limit: Optional[int],
+            truncate: bool = False, extra_tokens: int = 0,
+            counts: Optional[List[int]] = None) -> Tuple[Optional[List[int]], int]:
+        """返回 (保留的消息下标，全部保留时为 None, 估算的 prompt token 数)。counts 为已知的单条消息
+        token 数。超出 limit 时：truncate 为 True 则从最早的非 system 消息开始丢弃（保留最后一条消息），
+        否则抛出 ContextLengthError"""
+        if counts is None:
+            counts = [self.count_message(model, m) for m in messages]
+        total = sum(counts) + REPLY_OVERHEAD + extra_tokens
+        if not limit or total <= limit:
+            return None, total
+        if not truncate:
+            self._stats["rejected"] += 1
+            raise ContextLengthError(model, limit, total)
+
+        keep = [True] * len(messages)
+        last = len(messages) - 1
+        for i, message in enumerate(messages[:-1]):
+            if total <= limit:
+                break
+            if message.get("role") in ("system", "developer"):
+                continue
+            keep[i] = False
+            total -= counts[i]
+        # 工具调用被丢弃后，对应的 tool 结果消息也要一并丢弃
+        for i in range(1, len(messages)):
+            if keep[i] and not keep[i - 1] and messages[i].get("role") == "tool":
+                if i == last:
+                    total = limit + 1
+                    break
+                keep[i] = False
+                total -= counts[i]
+        if total > limit:
+            self._stats["rejected"] += 1
+            raise ContextLengthError(model, limit, total)
+
+        kept = [i for i, k in enumerate(keep) if k]
+        self._stats["truncated"] += 1
+        self._stats["dropped_messages"] += len(messages) - len(kept)
+        return kept, total
+
+    def estimate_usage(self, model: str, prompt_tokens: int, completion: str) -> Dict[str, int]:
+        completion_tokens = self.count_text(model, completion)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["backend"] = self.backend
+        stats["cached_messages"] = len(self._memo)
+        return stats
+
+
+token_counter = TokenCounter()
@@ -0,0 +1,194 @@
+"""
+Copilot token 缓存与后台刷新
+"""
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Any
+
+from loguru import logger
+
+from api import metrics
+from api.errors import CopilotTokenError
+from api.http_client import http_client
+from api.shared_state import shared_store, hash_key, SharedStateLockTimeout
+
+GITHUB_API_BASE = os.getenv("GITHUB_API_BASE", "https://api.github.com").rstrip("/")
+
+
+@dataclass
+class CopilotToken:
+    """单个 OAuth token 对应的 Copilot token"""
+    token: str
+    expires_at: float
+    refresh_at: float
+    last_used: float
+
+
+async def fetch_copilot_token(oauth_token: str) -> Dict[str, Any]:
+    """向 GitHub 请求 Copilot token，返回原始响应"""
+    session = http_client.get_session()
+    async with session.get(
+            url=f"{GITHUB_API_BASE}/copilot_internal/v2/token",
+            headers={
+                "Authorization": f"Bearer {oauth_token}",
+                "Accept": "application/json",
+                "User-Agent": "Mozilla/5.0",
+            }
+    ) as response:
+        if response.status != 200:
+            error_text = await response.text()
+            raise CopilotTokenError(response.status, f"Get Copilot token error: {error_text}",
+                                    CopilotTokenError.parse_retry_after(response.headers.get("retry-after")))
+
+        data = await response.json()
+        if not data.get("token"):
+            raise ValueError("No token")
+        return data
+
+
+class CopilotTokenManager:
+    """按 OAuth token 缓存 Copilot token，过期前在后台刷新，并发请求共享同一次获取"""
+
+    def __init__(self):
+        # 距离过期不足该秒数时视为失效
+        self.expiry_margin = float(os.getenv("COPILOT_TOKEN_EXPIRY_MARGIN", 60))
+        # 超过该秒数未使用的 token 不再后台刷新
+        self.idle_timeout = float(os.getenv("COPILOT_TOKEN_IDLE_TIMEOUT", 3600))
+        self._tokens: Dict[str, CopilotToken] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._refresh_tasks: Dict[str, asyncio.Task] = {}
+        # 被上游拒绝的 Copilot token：多 worker 模式下共享存储中可能仍缓存着它，下次获取时跳过
+        self._rejected: Dict[str, str] = {}
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "fetches": 0,
+            "shared_hits": 0,
+            "refreshes": 0,
+            "refresh_errors": 0,
+        }
+
+    async def get_token(self, oauth_token: str) -> str:
+        """获取可用的 Copilot token"""
+        now = time.time()
+        entry = self._tokens.get(oauth_token)
+        if entry is not None and entry.expires_at - now > self.expiry_margin:
+            entry.last_used = now
+            self._stats["hits"] += 1
+            return entry.token
+
+        self._stats["misses"] += 1
+        entry = await self._fetch(oauth_token)
+        entry.last_used = time.time()
+        return entry.token
+
+    def invalidate(self, oauth_token: str):
+        """丢弃缓存的 Copilot token（例如上游返回 401 时）"""
+        entry = self._tokens.pop(oauth_token, None)
+        if entry is not None:
+            self._rejected[oauth_token] = entry.token
+        task = self._refresh_tasks.pop(oauth_token, None)
+        if task is not None:
+            task.cancel()
+
+    async def _fetch(self, oauth_token: str) -> CopilotToken:
+        """同一 OAuth token 同时只发起一次获取"""
+        task = self._inflight.get(oauth_token)
+        if task is None:
+            task = asyncio.create_task(self._do_fetch(oauth_token))
+            self._inflight[oauth_token] = task
+            task.add_done_callback(lambda t: self._inflight.pop(oauth_token) if self._inflight.get(oauth_token) is t else None)
+        # shield: 单个调用方被取消时不影响其他等待者
+        return await asyncio.shield(task)
+
+    async def _do_fetch(self, oauth_token: str) -> CopilotToken:
+        if shared_store.enabled:
+            # 多 worker 模式：先查看其他 worker 是否已经获取过；上游请求期间不持有文件锁
+            key = hash_key(oauth_token)
+            cached = (await shared_store.read("copilot_tokens")).get(key)
+            if cached and cached["refresh_at"] > time.time() \
+                    and cached["token"] != self._rejected.get(oauth_token):
+                self._stats["shared_hits"] += 1
+                return self._store(oauth_token, cached["token"], cached["expires_at"], cached["refresh_at"])
+            # 共享的 token 已被拒绝时重新获取并覆盖，其他 worker 遇到 401 后会读到新 token
+            entry = await self._fetch_upstream(oauth_token)
+            shared = {"token": entry.token, "expires_at": entry.expires_at, "refresh_at": entry.refresh_at}
+            try:
+                await shared_store.update("copilot_tokens", lambda state: state.__setitem__(key, shared))
+            except SharedStateLockTimeout as e:
+                logger.warning("Share Copilot token failed: {}", e)
+            return entry
+        return await self._fetch_upstream(oauth_token)
+
+    async def _fetch_upstream(self, oauth_token: str) -> CopilotToken:
+        self._stats["fetches"] += 1
+        start = time.perf_counter()
+        data = await fetch_copilot_token(oauth_token)
+        metrics.TOKEN_FETCH.observe(time.perf_counter() - start)
+        now = time.time()
+        expires_at = float(data.get("expires_at") or now + 30 * 60)
+        refresh_in = data.get("refresh_in")
+        if refresh_in:
+            refresh_at = now + float(refresh_in)
+        else:
+            refresh_at = expires_at - 5 * 60
+        refresh_at = min(refresh_at, expires_at - self.expiry_margin)
+        logger.info("Get Copilot token, expires in {}s", int(expires_at - now))
+        return self._store(oauth_token, data["token"], expires_at, refresh_at)
+
+    def _store(self, oauth_token: str, token: str, expires_at: float, refresh_at: float) -> CopilotToken:
+        if self._rejected.get(oauth_token) != token:
+            self._rejected.pop(oauth_token, None)
+        previous = self._tokens.get(oauth_token)
+        entry = CopilotToken(
+            token=token,
+            expires_at=expires_at,
+            refresh_at=refresh_at,
+            last_used=previous.last_used if previous else time.time(),
+        )
+        self._tokens[oauth_token] = entry
+        self._schedule_refresh(oauth_token, entry)
+        return entry
+
+    def _schedule_refresh(self, oauth_token: str, entry: CopilotToken):
+        old = self._refresh_tasks.pop(oauth_token, None)
+        if old is not None:
+            old.cancel()
+        delay = max(entry.refresh_at - time.time(), 1.0)
+        self._refresh_tasks[oauth_token] = asyncio.create_task(self._refresh_later(oauth_token, delay))
+
+    async def _refresh_later(self, oauth_token: str, delay: float):
+        await asyncio.sleep(delay)
+        if self._refresh_tasks.get(oauth_token) is asyncio.current_task():
+            self._refresh_tasks.pop(oauth_token)
+        entry = self._tokens.get(oauth_token)
+        if entry is None:
+            return
+        if time.time() - entry.last_used > self.idle_timeout:
+            # 长时间未使用，不再续期，等其自然过期
+            return
+        try:
+            await self._fetch(oauth_token)
+            self._stats["refreshes"] += 1
+        except Exception as e:
+            self._stats["refresh_errors"] += 1
+            logger.warning("Refresh Copilot token failed: {}", e)
+
+    async def close(self):
+        """取消所有后台刷新任务"""
+        for task in list(self._refresh_tasks.values()) + list(self._inflight.values()):
+            task.cancel()
+        self._refresh_tasks.clear()
+        self._inflight.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["cached_tokens"] = len(self._tokens)
+        return stats
+
+
+copilot_tokens = CopilotTokenManager()
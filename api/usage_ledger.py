@@ -0,0 +1,348 @@
+"""
+代理 API key 与用量账本：按 key 统计请求数、prompt/completion token 和流式字节数。计数只在内存中累加，
+后台任务定期批量写入 SQLite，请求路径不等待磁盘；配额按内存中的计数校验
+"""
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List, Tuple
+
+from loguru import logger
+
+from api import fast_json
+
+# key 存储文件，格式见 README；文件修改后自动重新加载
+API_KEYS_FILE = os.getenv("API_KEYS_FILE", "api_keys.json")
+USAGE_DB = os.getenv("USAGE_DB", ".cache/usage.db")
+# 内存计数写入 SQLite 的间隔（秒），多 worker 时也是各进程之间同步配额用量的间隔
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", 5))
+# 未配置任何 key 时，用量记在这个名称下
+ANONYMOUS = "anonymous"
+
+COUNTERS = ("requests", "prompt_tokens", "completion_tokens", "stream_bytes")
+QUOTA_PERIODS = ("day", "month", "total")
+_PROMPT_TOKENS = re.compile(rb'"prompt_tokens"\s*:\s*(\d+)')
+_COMPLETION_TOKENS = re.compile(rb'"completion_tokens"\s*:\s*(\d+)')
+
+
+class QuotaExceededError(Exception):
+    """key 在当前周期内的用量已达到配额"""
+
+
+@dataclass
+class ApiKey:
+    name: str
+    # key 的 sha256，存储文件中可以只写摘要
+    digest: str
+    token_quota: Optional[int] = None
+    request_quota: Optional[int] = None
+    # 配额周期：day / month / total（按 UTC 自然日、自然月）
+    quota_period: str = "month"
+    # 管理员 key 可以查询所有 key 的用量
+    admin: bool = False
+
+
+def _digest(key: str) -> str:
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _buckets(now: float) -> Dict[str, str]:
+    """当前时间所在的日、月（UTC），total 周期只有一个桶"""
+    day = time.strftime("%Y-%m-%d", time.gmtime(now))
+    return {"day": day, "month": day[:7], "total": ""}
+
+
+def parse_usage(body: bytes) -> Tuple[Optional[int], Optional[int]]:
+    """从响应体中取出 usage 的 prompt_tokens / completion_tokens，不解析整个 JSON"""
+    prompt = _PROMPT_TOKENS.search(body)
+    completion = _COMPLETION_TOKENS.search(body)
+    return (int(prompt.group(1)) if prompt else None,
+            int(completion.group(1)) if completion else None)
+
+
+class ApiKeyStore:
+    """从 API_KEYS_FILE 加载 key，兼容单个 API_KEY 环境变量（名称为 default）"""
+
+    def __init__(self, path: str = API_KEYS_FILE):
+        self.path = path
+        self._keys: Dict[str, ApiKey] = {}
+        self._mtime: Optional[float] = None
+        env_key = os.getenv("API_KEY", "")
+        self._env_key = ApiKey("default", _digest(env_key), admin=True) if env_key else None
+        self.reload()
+
+    @property
+    def enabled(self) -> bool:
+        """是否要求客户端提供 key"""
+        return bool(self._keys) or self._env_key is not None
+
+    def reload(self) -> bool:
+        """文件有变化时重新加载，返回是否重新加载；格式错误时保留原有 key"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        keys = {}
+        if mtime is not None:
+            try:
+                with open(self.path, "rb") as f:
+                    entries = fast_json.loads(f.read()).get("keys", [])
+                for entry in entries:
+                    key = self._parse(entry)
+                    keys[key.digest] = key
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                logger.error("Failed to load API keys from {}: {}", self.path, e)
+                return False
+        if self._env_key is not None:
+            keys.setdefault(self._env_key.digest, self._env_key)
+        self._keys = keys
+        logger.info("Loaded {} API key(s)", len(keys))
+        return True
+
+    @staticmethod
+    def _parse(entry: Dict[str, Any]) -> ApiKey:
+        if not entry.get("name"):
+            raise ValueError("every API key needs a name")
+        digest = entry.get("key_sha256") or (_digest(entry["key"]) if entry.get("key") else None)
+        if not digest:
+            raise ValueError(f"API key {entry['name']} needs key or key_sha256")
+        quota = entry.get("quota") or {}
+        period = quota.get("period", "month")
+        if period not in QUOTA_PERIODS:
+            raise ValueError(f"quota period must be one of {', '.join(QUOTA_PERIODS)}")
+        return ApiKey(entry["name"], digest.lower(), quota.get("tokens"), quota.get("requests"), period,
+                      bool(entry.get("admin")))
+
+    def authenticate(self, authorization: Optional[str]) -> Optional[ApiKey]:
+        """校验 Authorization 头，未配置 key 时所有请求都视为匿名 key；校验失败返回 None"""
+        if not self.enabled:
+            return ApiKey(ANONYMOUS, "", admin=True)
+        if not authorization or not authorization.startswith("Bearer "):
+            return None
+        return self._keys.get(_digest(authorization[7:]))
+
+    def find(self, name: str) -> Optional[ApiKey]:
+        return next((key for key in self._keys.values() if key.name == name), None)
+
+    def names(self) -> List[str]:
+        return sorted({key.name for key in self._keys.values()})
+
+
+class UsageLedger:
+    """record 只修改内存中的计数；flush 在线程中把增量写入 SQLite，再读回各 key 在当前日、月和累计的总量，
+    多个 worker 共用同一个数据库时配额也能看到其他进程的用量（最多滞后一个写入间隔）"""
+
+    def __init__(self, path: str = USAGE_DB):
+        self.path = path
+        self.keys = ApiKeyStore()
+        # 尚未写入数据库的增量：(key 名称, 日期) -> 计数
+        self._pending: Dict[Tuple[str, str], Dict[str, int]] = {}
+        # 配额用的当前周期用量：key 名称 -> 周期 -> (桶, 计数)
+        self._live: Dict[str, Dict[str, Tuple[str, Dict[str, int]]]] = {}
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        # 当前的日、月桶，到下一个 UTC 零点前不变
+        self._buckets: Dict[str, str] = {}
+        self._buckets_until = 0.0
+        self._stats = {"recorded": 0, "flushes": 0, "flushed_rows": 0, "flush_errors": 0, "quota_rejections": 0,
+                       "last_flush_ms": 0.0}
+
+    async def start(self):
+        await asyncio.to_thread(self._open)
+        await self._sync({})
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS usage (key_name TEXT NOT NULL, day TEXT NOT NULL, "
+            "requests INTEGER NOT NULL DEFAULT 0, prompt_tokens INTEGER NOT NULL DEFAULT 0, "
+            "completion_tokens INTEGER NOT NULL DEFAULT 0, stream_bytes INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (key_name, day))")
+        db.commit()
+        self._db = db
+
+    def _current_buckets(self) -> Dict[str, str]:
+        now = time.time()
+        if now >= self._buckets_until:
+            self._buckets = _buckets(now)
+            self._buckets_until = (now // 86400 + 1) * 86400
+        return self._buckets
+
+    def record(self, key_name: str, prompt_tokens: int = 0, completion_tokens: int = 0, stream_bytes: int = 0,
+               requests: int = 1):
+        buckets = self._current_buckets()
+        delta = {"requests": requests, "prompt_tokens": prompt_tokens or 0,
+                 "completion_tokens": completion_tokens or 0, "stream_bytes": stream_bytes}
+        pending = self._pending.get((key_name, buckets["day"]))
+        if pending is None:
+            pending = self._pending[(key_name, buckets["day"])] = dict.fromkeys(COUNTERS, 0)
+        for name, value in delta.items():
+            pending[name] += value
+        for period, counts in self._current(key_name, buckets).items():
+            for name, value in delta.items():
+                counts[name] += value
+        self._stats["recorded"] += 1
+
+    def _current(self, key_name: str, buckets: Dict[str, str]) -> Dict[str, Dict[str, int]]:
+        """key 在各周期当前桶中的计数，跨日、跨月时从零开始"""
+        live = self._live.setdefault(key_name, {})
+        current = {}
+        for period, bucket in buckets.items():
+            entry = live.get(period)
+            if entry is None or entry[0] != bucket:
+                entry = live[period] = (bucket, dict.fromkeys(COUNTERS, 0))
+            current[period] = entry[1]
+        return current
+
+    def check_quota(self, key: ApiKey):
+        """按内存中的计数校验配额，已用完时抛出 QuotaExceededError"""
+        if key.token_quota is None and key.request_quota is None:
+            return
+        counts = self._current(key.name, self._current_buckets())[key.quota_period]
+        if key.request_quota is not None and counts["requests"] >= key.request_quota:
+            self._stats["quota_rejections"] += 1
+            raise QuotaExceededError(f"API key {key.name} has used its {key.quota_period} request quota")
+        if key.token_quota is not None and counts["prompt_tokens"] + counts["completion_tokens"] >= key.token_quota:
+            self._stats["quota_rejections"] += 1
+            raise QuotaExceededError(f"API key {key.name} has used its {key.quota_period} token quota")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+            try:
+                await asyncio.to_thread(self.keys.reload)
+                await self.flush()
+            except Exception as e:
+                logger.warning("Usage flush failed: {}", e)
+
+    async def flush(self):
+        """把内存中的增量写入数据库；写入失败时增量放回内存，下次重试"""
+        if self._db is None:
+            return
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            try:
+                await self._sync(pending)
+            except Exception:
+                self._stats["flush_errors"] += 1
+                for (key_name, day), counts in pending.items():
+                    merged = self._pending.setdefault((key_name, day), dict.fromkeys(COUNTERS, 0))
+                    for name, value in counts.items():
+                        merged[name] += value
+                raise
+
+    async def _sync(self, pending: Dict[Tuple[str, str], Dict[str, int]]):
+        start = time.perf_counter()
+        buckets = self._current_buckets()
+        totals = await asyncio.to_thread(self._write_and_read, pending, buckets)
+        self._stats["last_flush_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        if pending:
+            self._stats["flushes"] += 1
+            self._stats["flushed_rows"] += len(pending)
+        # 数据库中的总量加上写入期间新产生的增量
+        live = {}
+        for key_name, periods in totals.items():
+            live[key_name] = {period: (buckets[period], counts) for period, counts in periods.items()}
+        for (key_name, day), counts in self._pending.items():
+            periods = live.setdefault(key_name, {})
+            for period, bucket in buckets.items():
+                if (period == "day" and day != bucket) or (period == "month" and day[:7] != bucket):
+                    continue
+                entry = periods.setdefault(period, (bucket, dict.fromkeys(COUNTERS, 0)))
+                for name, value in counts.items():
+                    entry[1][name] += value
+        self._live = live
+
+    def _write_and_read(self, pending: Dict[Tuple[str, str], Dict[str, int]],
+                        buckets: Dict[str, str]) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """在线程中执行：写入增量，返回各 key 在当前日、月和累计的总量"""
+        columns = ", ".join(f"SUM({name})" for name in COUNTERS)
+        totals: Dict[str, Dict[str, Dict[str, int]]] = {}
+        with self._db_lock:
+            if pending:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT INTO usage (key_name, day, requests, prompt_tokens, completion_tokens, stream_bytes) "
+                        "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key_name, day) DO UPDATE SET "
+                        + ", ".join(f"{name} = {name} + excluded.{name}" for name in COUNTERS),
+                        [(key_name, day, *(counts[name] for name in COUNTERS))
+                         for (key_name, day), counts in pending.items()])
+            for period, since in (("day", buckets["day"]), ("month", buckets["month"] + "-01"), ("total", "")):
+                rows = self._db.execute(
+                    f"SELECT key_name, {columns} FROM usage WHERE day >= ? GROUP BY key_name", (since,))
+                for key_name, *values in rows:
+                    totals.setdefault(key_name, {})[period] = dict(zip(COUNTERS, values))
+        return totals
+
+    async def query(self, key_name: Optional[str] = None, start_date: str = "",
+                    end_date: str = "9999-12-31") -> List[Dict[str, Any]]:
+        """按 key 汇总 [start_date, end_date] 内的用量（日期为 UTC 的 YYYY-MM-DD），包含逐日明细"""
+        await self.flush()
+        rows = await asyncio.to_thread(self._read_rows, key_name, start_date, end_date)
+        usage: Dict[str, Dict[str, Any]] = {}
+        for row_key, day, *values in rows:
+            counts = dict(zip(COUNTERS, values))
+            item = usage.setdefault(row_key, {"key": row_key, **dict.fromkeys(COUNTERS, 0), "days": []})
+            for name, value in counts.items():
+                item[name] += value
+            item["days"].append({"date": day, **counts})
+        names = [key_name] if key_name else sorted(set(usage) | set(self.keys.names()))
+        result = []
+        for name in names:
+            item = usage.get(name) or {"key": name, **dict.fromkeys(COUNTERS, 0), "days": []}
+            item["total_tokens"] = item["prompt_tokens"] + item["completion_tokens"]
+            result.append(item)
+        return result
+
+    def _read_rows(self, key_name: Optional[str], start_date: str, end_date: str) -> List[tuple]:
+        if self._db is None:
+            return []
+        sql = f"SELECT key_name, day, {', '.join(COUNTERS)} FROM usage WHERE day >= ? AND day <= ?"
+        params: list = [start_date, end_date]
+        if key_name:
+            sql += " AND key_name = ?"
+            params.append(key_name)
+        with self._db_lock:
+            return self._db.execute(sql + " ORDER BY key_name, day", params).fetchall()
+
+    def quota_status(self, key: ApiKey) -> Dict[str, Any]:
+        """key 的配额和当前周期的用量"""
+        counts = self._current(key.name, self._current_buckets())[key.quota_period]
+        return {"period": key.quota_period, "tokens": key.token_quota, "requests": key.request_quota,
+                "used_tokens": counts["prompt_tokens"] + counts["completion_tokens"],
+                "used_requests": counts["requests"]}
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["keys"] = len(self.keys.names())
+        stats["pending_rows"] = len(self._pending)
+        return stats
+
+
+usage_ledger = UsageLedger()
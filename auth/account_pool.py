@@ -0,0 +1,155 @@
+"""
+多账号池：按最少在途请求分配账号，429 冷却，401 故障转移
+"""
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Tuple, Optional, Iterable, Any
+
+from loguru import logger
+
+from api.errors import UpstreamError, CopilotTokenError, AccountsExhaustedError
+from api.shared_state import shared_store, hash_key, SharedStateLockTimeout
+
+
+@dataclass
+class Account:
+    """单个 GitHub OAuth token 及其运行状态"""
+    oauth_token: str
+    source: str
+    inflight: int = 0
+    cooldown_until: float = 0.0
+    requests: int = 0
+    completed: int = 0
+    errors: int = 0
+    rate_limited: int = 0
+    unauthorized: int = 0
+
+    @property
+    def name(self) -> str:
+        """脱敏后的账号标识"""
+        return f"{self.oauth_token[:4]}...{self.oauth_token[-4:]}"
+
+
+class AccountPool:
+    """GitHub 账号池"""
+
+    def __init__(self):
+        # 429 未携带 retry-after 时的冷却秒数
+        self.rate_limit_cooldown = float(os.getenv("ACCOUNT_RATE_LIMIT_COOLDOWN", 30))
+        # OAuth token 换取 Copilot token 失败后的冷却秒数
+        self.unauthorized_cooldown = float(os.getenv("ACCOUNT_UNAUTHORIZED_COOLDOWN", 300))
+        self._accounts: Dict[str, Account] = {}
+        self._pending = set()
+
+    def __len__(self) -> int:
+        return len(self._accounts)
+
+    def sync(self, tokens: List[Tuple[str, str]]):
+        """用 (token, 来源) 列表更新账号池，保留已有账号的状态"""
+        accounts = {}
+        for token, source in tokens:
+            if token in accounts:
+                continue
+            accounts[token] = self._accounts.get(token) or Account(oauth_token=token, source=source)
+        added = accounts.keys() - self._accounts.keys()
+        removed = self._accounts.keys() - accounts.keys()
+        if added or removed:
+            logger.info("Account pool updated: {} accounts (+{} -{})", len(accounts), len(added), len(removed))
+        self._accounts = accounts
+
+    def first_token(self) -> Optional[str]:
+        return next(iter(self._accounts), None)
+
+    def tokens(self) -> List[str]:
+        return list(self._accounts)
+
+    def acquire(self, exclude: Iterable[str] = ()) -> Account:
+        """选择在途请求最少且未冷却的账号"""
+        if not self._accounts:
+            raise ValueError("未能获取有效的认证令牌，请先访问 /auth/device 完成认证")
+        now = time.time()
+        best = None
+        for account in self._accounts.values():
+            if account.oauth_token in exclude or account.cooldown_until > now:
+                continue
+            if best is None or account.inflight < best.inflight:
+                best = account
+        if best is None:
+            waits = [a.cooldown_until - now for a in self._accounts.values() if a.cooldown_until > now]
+            retry_after = min(waits) if waits else self.rate_limit_cooldown
+            raise AccountsExhaustedError(429, "all Copilot accounts are rate limited", retry_after=retry_after)
+        best.inflight += 1
+        best.requests += 1
+        return best
+
+    def release(self, account: Account, error: Optional[BaseException] = None):
+        """归还账号并根据错误更新状态"""
+        account.inflight -= 1
+        if error is None:
+            account.completed += 1
+            return
+        account.errors += 1
+        if not isinstance(error, UpstreamError):
+            return
+        if error.status == 429:
+            account.rate_limited += 1
+            cooldown = error.retry_after if error.retry_after is not None else self.rate_limit_cooldown
+            account.cooldown_until = max(account.cooldown_until, time.time() + cooldown)
+            logger.warning("Account {} rate limited, cooldown {}s", account.name, cooldown)
+            self._share_cooldown(account)
+        elif error.status in (401, 403) and isinstance(error, CopilotTokenError):
+            account.unauthorized += 1
+            account.cooldown_until = time.time() + self.unauthorized_cooldown
+            logger.warning("Account {} unauthorized, cooldown {}s", account.name, self.unauthorized_cooldown)
+            self._share_cooldown(account)
+        elif error.status == 401:
+            account.unauthorized += 1
+
+    def _share_cooldown(self, account: Account):
+        """多 worker 模式下把冷却状态写入共享存储，其他 worker 在下次同步时生效"""
+        if not shared_store.enabled:
+            return
+        key = hash_key(account.oauth_token)
+        until = account.cooldown_until
+
+        def update(state):
+            state[key] = max(state.get(key, 0), until)
+
+        async def share():
+            try:
+                await shared_store.update("cooldowns", update)
+            except SharedStateLockTimeout as e:
+                logger.warning("Share account cooldown failed: {}", e)
+
+        task = asyncio.get_running_loop().create_task(share())
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def sync_shared_cooldowns(self):
+        """从共享存储同步其他 worker 记录的冷却状态"""
+        if not shared_store.enabled:
+            return
+        state = await shared_store.read("cooldowns")
+        for account in self._accounts.values():
+            until = state.get(hash_key(account.oauth_token), 0)
+            if until > account.cooldown_until:
+                account.cooldown_until = until
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        return [
+            {
+                "account": account.name,
+                "source": account.source,
+                "inflight": account.inflight,
+                "requests": account.requests,
+                "completed": account.completed,
+                "errors": account.errors,
+                "rate_limited": account.rate_limited,
+                "unauthorized": account.unauthorized,
+                "cooldown": round(max(account.cooldown_until - now, 0.0), 1),
+            }
+            for account in self._accounts.values()
+        ]
@@ -0,0 +1,132 @@
+"""
+进程级凭据提供者
+"""
+import asyncio
+import json
+import os
+from typing import Optional, Dict, Any, List
+
+from loguru import logger
+
+from . import Auth
+from auth.account_pool import AccountPool
+from auth.envs_auth import EnvsAuth
+from auth.hosts_auth import HostsAuth
+
+
+def _get_mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _load_tokens_file(path: str) -> List[str]:
+    """读取令牌配置文件：JSON 数组，或每行一个令牌（# 开头为注释）"""
+    try:
+        with open(path, 'r') as f:
+            content = f.read()
+    except OSError:
+        return []
+    if content.lstrip().startswith("["):
+        return [token for token in json.loads(content) if token]
+    return [line.strip() for line in content.splitlines() if line.strip() and not line.strip().startswith("#")]
+
+
+class CredentialProvider(Auth):
+    """启动时解析一次认证来源（环境变量、hosts.json、令牌文件）并组成账号池，后台按修改时间监听文件变化；
+    请求路径上不做文件 I/O，也不做交互式认证"""
+
+    def __init__(self):
+        self.envs_auth = EnvsAuth()
+        self.hosts_auth = HostsAuth()
+        self.tokens_file = os.getenv("GH_COPILOT_TOKENS_FILE", "")
+        self.watch_interval = float(os.getenv("HOSTS_WATCH_INTERVAL", 5))
+        self.pool = AccountPool()
+        self._hosts_tokens: List[str] = []
+        self._file_tokens: List[str] = []
+        self._mtimes: Dict[str, Optional[float]] = {}
+        self._watch_task: Optional[asyncio.Task] = None
+        self._started = False
+        self._reloads = 0
+
+    async def start(self):
+        """加载所有认证来源并启动后台监听"""
+        if self._started:
+            return
+        self._started = True
+        await self._reload()
+        self._watch_task = asyncio.create_task(self._watch())
+
+    async def close(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+        self._started = False
+
+    async def get_token(self) -> Optional[str]:
+        """获取第一个可用的认证令牌"""
+        if not self._started:
+            await self.start()
+        return self.pool.first_token()
+
+    async def get_pool(self) -> AccountPool:
+        """获取账号池"""
+        if not self._started:
+            await self.start()
+        return self.pool
+
+    def set_hosts_token(self, oauth_token: str):
+        """设备认证成功后直接加入账号池，无需等待文件监听"""
+        if oauth_token not in self._hosts_tokens:
+            self._hosts_tokens.append(oauth_token)
+        self._sync_pool()
+
+    def _sync_pool(self):
+        tokens = [(token, "env") for token in self.envs_auth.get_tokens()]
+        tokens += [(token, "hosts") for token in self._hosts_tokens]
+        tokens += [(token, "file") for token in self._file_tokens]
+        self.pool.sync(tokens)
+
+    async def _reload_if_changed(self, path: str, loader) -> Optional[List[str]]:
+        mtime = await asyncio.to_thread(_get_mtime, path)
+        if path in self._mtimes and mtime == self._mtimes[path]:
+            return None
+        self._mtimes[path] = mtime
+        self._reloads += 1
+        return await asyncio.to_thread(loader) if mtime is not None else []
+
+    async def _reload(self):
+        changed = False
+        tokens = await self._reload_if_changed(self.hosts_auth.hosts_file, self.hosts_auth.load_tokens)
+        if tokens is not None:
+            self._hosts_tokens = tokens
+            changed = True
+        if self.tokens_file:
+            tokens = await self._reload_if_changed(self.tokens_file, lambda: _load_tokens_file(self.tokens_file))
+            if tokens is not None:
+                self._file_tokens = tokens
+                changed = True
+        if changed:
+            self._sync_pool()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                await self._reload()
+                await self.pool.sync_shared_cooldowns()
+            except Exception as e:
+                logger.warning("Watch credential files failed: {}", e)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "env_tokens": len(self.envs_auth.get_tokens()),
+            "hosts_tokens": len(self._hosts_tokens),
+            "file_tokens": len(self._file_tokens),
+            "reloads": self._reloads,
+            "accounts": self.pool.get_stats(),
+        }
+
+
+credential_provider = CredentialProvider()
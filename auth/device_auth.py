@@ -1,9 +1,27 @@
-from typing import Optional, Dict
+import asyncio
+import os
+import secrets
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any
 
 import aiohttp
+from loguru import logger
+
+from api.http_client import http_client
+from api.shared_state import shared_store, SharedStateLockTimeout
+from auth.credential_provider import credential_provider
 from auth.hosts_auth import HostsAuth
 from . import Auth
 
+GITHUB_BASE = os.getenv("GITHUB_BASE", "https://github.com").rstrip("/")
+# 同时等待授权的设备码上限，超出时放弃最早的
+DEVICE_FLOW_MAX_PENDING = int(os.getenv("DEVICE_FLOW_MAX_PENDING", 20))
+# 轮询出错时退避的最长间隔（秒）
+MAX_POLL_INTERVAL = 60
+# 结束的认证流程保留多久，供页面读取最终状态
+FINISHED_RETENTION = 300
+
 
 class DeviceAuth(Auth):
     """GitHub 设备认证"""
@@ -13,9 +31,9 @@ class DeviceAuth(Auth):
         self.scope = "read:user"
 
     async def get_token(self) -> Optional[str]:
-        """获取认证令牌"""
+        """命令行下的交互式认证"""
         # 1. 获取设备码
-        device_code_resp = await self._get_device_code()
+        device_code_resp = await self.request_device_code()
         if not device_code_resp:
             return None
 
@@ -27,72 +45,253 @@ class DeviceAuth(Auth):
             return None
 
         # 3. 轮询获取访问令牌
-        return await self._poll_token(device_code_resp['device_code'])
-        
-    async def new_get_token(self) -> Dict:
-        """获取设备认证信息，用于Web界面认证流程"""
-        # 获取设备码
-        device_code_resp = await self._get_device_code()
-        if not device_code_resp:
-            return {"error": "获取设备码失败"}
-            
+        return await self._poll_token(device_code_resp['device_code'], device_code_resp.get('interval', 5),
+                                      device_code_resp.get('expires_in', 900))
+
+    async def request_device_code(self) -> Optional[Dict]:
+        """获取设备码"""
+        session = http_client.get_session()
+        async with session.post(
+                f"{GITHUB_BASE}/login/device/code",
+                headers={
+                    "Accept": "application/json",
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "client_id": self.client_id,
+                    "scope": self.scope,
+                },
+        ) as resp:
+            if resp.status != 200:
+                return None
+            return await resp.json()
+
+    async def poll_once(self, device_code: str) -> Dict:
+        """请求一次访问令牌，返回 GitHub 的响应（成功时含 access_token，否则含 error）"""
+        session = http_client.get_session()
+        async with session.post(
+                f"{GITHUB_BASE}/login/oauth/access_token",
+                headers={
+                    "Accept": "application/json",
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "client_id": self.client_id,
+                    "device_code": device_code,
+                    "grant_type": "urn:ietf:params:oauth:grant-type:device_code",
+                },
+        ) as resp:
+            if resp.status != 200:
+                return {"error": "http_error", "error_description": f"status code {resp.status}"}
+            return await resp.json()
+
+    async def _poll_token(self, device_code: str, interval: float, expires_in: float) -> Optional[str]:
+        """按服务端要求的间隔轮询，直到授权、拒绝或设备码过期"""
+        deadline = time.monotonic() + expires_in
+        while time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+            data = await self.poll_once(device_code)
+            if data.get("access_token"):
+                await asyncio.to_thread(HostsAuth().save_token, data["access_token"])
+                return data["access_token"]
+            if data.get("error") == "slow_down":
+                interval = data.get("interval", interval + 5)
+            elif data.get("error") != "authorization_pending":
+                return None
+        return None
+
+
+@dataclass
+class DeviceFlow:
+    """一次网页发起的设备认证"""
+    id: str
+    device_code: str
+    user_code: str
+    verification_uri: str
+    interval: float
+    expires_at: float
+    # pending / authorized / expired / denied / error
+    status: str = "pending"
+    error: Optional[str] = None
+    finished_at: Optional[float] = None
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """返回给页面的状态，不包含设备码"""
         return {
-            "device_code": device_code_resp['device_code'],
-            "user_code": device_code_resp['user_code'],
-            "verification_uri": device_code_resp['verification_uri'],
-            "expires_in": device_code_resp.get('expires_in', 900),
-            "interval": device_code_resp.get('interval', 5)
+            "status": self.status,
+            "user_code": self.user_code,
+            "verification_uri": self.verification_uri,
+            "expires_in": max(int(self.expires_at - time.monotonic()), 0),
+            "interval": self.interval,
+            "error": self.error,
         }
-        
-    async def confirm_token(self, device_code: str) -> Dict:
-        """确认并获取访问令牌，用于Web界面认证确认后的处理"""
-        token = await self._poll_token(device_code)
-        if token:
-            return {"success": True, "token": token}
-        return {"success": False, "error": "认证失败，请重试"}
-
-    async def _get_device_code(self) -> Optional[Dict]:
-        """获取设备码"""
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    "https://github.com/login/device/code",
-                    headers={
-                        "Accept": "application/json",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "client_id": self.client_id,
-                        "scope": self.scope,
-                    },
-            ) as resp:
-                if resp.status != 200:
-                    return None
-                return await resp.json()
-
-    async def _poll_token(self, device_code: str) -> Optional[str]:
-        """轮询获取访问令牌"""
-        async with aiohttp.ClientSession() as session:
-            while True:
-                async with session.post(
-                        "https://github.com/login/oauth/access_token",
-                        headers={
-                            "Accept": "application/json",
-                            "Content-Type": "application/json",
-                        },
-                        json={
-                            "client_id": self.client_id,
-                            "device_code": device_code,
-                            "grant_type": "urn:ietf:params:oauth:grant-type:device_code",
-                        },
-                ) as resp:
-                    if resp.status != 200:
-                        return None
-
-                    data = await resp.json()
-                    if "error" in data:
-                        if data["error"] == "authorization_pending":
-                            continue
-                        return None
-                    # 保存到 hosts 文件
-                    HostsAuth().save_token(data["access_token"])
-                    return data.get("access_token")
+
+    def to_shared(self) -> Dict[str, Any]:
+        """写入共享存储的状态，时间换算为墙上时间，供其他 worker 返回给页面"""
+        now = time.time()
+        return {
+            "status": self.status,
+            "user_code": self.user_code,
+            "verification_uri": self.verification_uri,
+            "expires_at": now + self.expires_at - time.monotonic(),
+            "interval": self.interval,
+            "error": self.error,
+            "finished_at": now if self.finished_at is not None else None,
+        }
+
+
+def _shared_to_dict(entry: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "status": entry["status"],
+        "user_code": entry["user_code"],
+        "verification_uri": entry["verification_uri"],
+        "expires_in": max(int(entry["expires_at"] - time.time()), 0),
+        "interval": entry["interval"],
+        "error": entry["error"],
+    }
+
+
+class DeviceFlowManager:
+    """在后台轮询等待授权的设备码，页面通过状态接口查询进度；授权成功后原子写入 hosts.json
+    并直接加入账号池，无需重启。多 worker 模式下流程状态同时写入共享存储，
+    页面的状态查询落到其他 worker 时也能读到（轮询仍由发起的 worker 执行）"""
+
+    def __init__(self):
+        self.auth = DeviceAuth()
+        self.hosts_auth = HostsAuth()
+        self._flows: Dict[str, DeviceFlow] = {}
+        self._stats = {"started": 0, "authorized": 0, "expired": 0, "denied": 0, "errors": 0, "polls": 0,
+                       "slow_downs": 0}
+
+    async def start(self) -> Optional[DeviceFlow]:
+        """申请新的设备码并开始后台轮询，获取设备码失败时返回 None"""
+        self._purge()
+        info = await self.auth.request_device_code()
+        if not info or "device_code" not in info:
+            return None
+        flow = DeviceFlow(
+            id=secrets.token_urlsafe(16),
+            device_code=info["device_code"],
+            user_code=info["user_code"],
+            verification_uri=info["verification_uri"],
+            interval=float(info.get("interval", 5)),
+            expires_at=time.monotonic() + float(info.get("expires_in", 900)),
+        )
+        pending = [f for f in self._flows.values() if f.status == "pending"]
+        superseded = pending[:max(len(pending) - DEVICE_FLOW_MAX_PENDING + 1, 0)]
+        for old in superseded:
+            self._finish(old, "expired", "superseded by a newer device code")
+            old.task.cancel()
+        self._flows[flow.id] = flow
+        flow.task = asyncio.create_task(self._poll(flow))
+        self._stats["started"] += 1
+        for shared in superseded + [flow]:
+            await self._share(shared)
+        return flow
+
+    async def status(self, flow_id: str) -> Optional[Dict[str, Any]]:
+        """返回给页面的流程状态；本进程没有该流程时查询共享存储"""
+        flow = self._flows.get(flow_id)
+        if flow is not None:
+            return flow.to_dict()
+        if not shared_store.enabled:
+            return None
+        entry = (await shared_store.read("device_flows")).get(flow_id)
+        return _shared_to_dict(entry) if entry is not None else None
+
+    async def _share(self, flow: DeviceFlow):
+        """多 worker 模式下写入流程状态，并清理已过保留期的流程"""
+        if not shared_store.enabled:
+            return
+        entry = flow.to_shared()
+
+        def update(state):
+            now = time.time()
+            for flow_id in [k for k, v in state.items()
+                            if (v["finished_at"] or v["expires_at"]) + FINISHED_RETENTION < now]:
+                del state[flow_id]
+            state[flow.id] = entry
+
+        try:
+            await shared_store.update("device_flows", update)
+        except SharedStateLockTimeout as e:
+            logger.warning("Share device authorization state failed: {}", e)
+
+    async def close(self):
+        for flow in self._flows.values():
+            if flow.task is not None:
+                flow.task.cancel()
+        await asyncio.gather(*(f.task for f in self._flows.values() if f.task is not None), return_exceptions=True)
+        self._flows.clear()
+
+    def _purge(self):
+        now = time.monotonic()
+        for flow_id in [k for k, f in self._flows.items()
+                        if f.finished_at is not None and now - f.finished_at > FINISHED_RETENTION]:
+            del self._flows[flow_id]
+
+    def _finish(self, flow: DeviceFlow, status: str, error: Optional[str] = None):
+        flow.status = status
+        flow.error = error
+        flow.finished_at = time.monotonic()
+        self._stats["errors" if status == "error" else status] += 1
+
+    async def _poll(self, flow: DeviceFlow):
+        await self._wait_for_authorization(flow)
+        await self._share(flow)
+
+    async def _wait_for_authorization(self, flow: DeviceFlow):
+        """按服务端给出的 interval 轮询；slow_down 时按要求加大间隔，网络错误时指数退避"""
+        interval = flow.interval
+        while True:
+            remaining = flow.expires_at - time.monotonic()
+            if remaining <= 0:
+                self._finish(flow, "expired", "device code expired")
+                return
+            await asyncio.sleep(min(interval, remaining))
+            self._stats["polls"] += 1
+            try:
+                data = await self.auth.poll_once(flow.device_code)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                data = {"error": "http_error", "error_description": str(e)}
+
+            token = data.get("access_token")
+            error = data.get("error")
+            if token:
+                try:
+                    await asyncio.to_thread(self.hosts_auth.save_token, token)
+                except OSError as e:
+                    # 写文件失败不影响本进程使用该令牌
+                    logger.warning("Failed to save GitHub token: {}", e)
+                credential_provider.set_hosts_token(token)
+                self._finish(flow, "authorized")
+                logger.info("Device authorization completed")
+                return
+            if error == "authorization_pending":
+                interval = flow.interval
+            elif error == "slow_down":
+                self._stats["slow_downs"] += 1
+                flow.interval = float(data.get("interval", flow.interval + 5))
+                interval = flow.interval
+            elif error == "expired_token":
+                self._finish(flow, "expired", "device code expired")
+                return
+            elif error == "access_denied":
+                self._finish(flow, "denied", "authorization was denied")
+                return
+            elif error == "http_error":
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+                logger.warning("Device authorization poll failed, retrying in {}s: {}",
+                               interval, data.get("error_description"))
+            else:
+                self._finish(flow, "error", data.get("error_description") or error or "unknown error")
+                return
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["pending"] = sum(1 for f in self._flows.values() if f.status == "pending")
+        return stats
+
+
+device_flows = DeviceFlowManager()
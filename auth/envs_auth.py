@@ -1,5 +1,5 @@
 import os
-from typing import Optional
+from typing import Optional, List
 from . import Auth
 
 
@@ -11,4 +11,9 @@ class EnvsAuth(Auth):
 
     async def get_token(self) -> Optional[str]:
         """获取认证令牌"""
-        return os.environ.get(self.token_env)
+        return next(iter(self.get_tokens()), None)
+
+    def get_tokens(self) -> List[str]:
+        """获取全部认证令牌，多个令牌以逗号分隔"""
+        value = os.environ.get(self.token_env, "")
+        return [token.strip() for token in value.split(",") if token.strip()]
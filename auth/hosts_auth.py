@@ -1,6 +1,7 @@
 import os
 import json
-from typing import Optional
+import tempfile
+from typing import Optional, List
 from . import Auth
 
 
@@ -13,32 +14,63 @@ class HostsAuth(Auth):
 
     async def get_token(self) -> Optional[str]:
         """获取认证令牌"""
-        if not os.path.exists(self.hosts_file):
-            return None
         if self.token is not None:
             return self.token
+        self.token = self.load_token()
+        return self.token
 
+    def load_token(self) -> Optional[str]:
+        """同步读取 hosts.json 中的令牌（会阻塞，不要在事件循环中直接调用）"""
+        if not os.path.exists(self.hosts_file):
+            return None
         try:
             with open(self.hosts_file, 'r') as f:
                 data = json.load(f)
-                self.token = data.get("github.com", {}).get("oauth_token")
-                return self.token
+                return data.get("github.com", {}).get("oauth_token")
         except Exception:
             return None
 
+    def load_tokens(self) -> List[str]:
+        """同步读取 hosts.json 中所有条目的令牌"""
+        if not os.path.exists(self.hosts_file):
+            return []
+        try:
+            with open(self.hosts_file, 'r') as f:
+                data = json.load(f)
+        except Exception:
+            return []
+        tokens = []
+        for host in data.values():
+            if isinstance(host, dict) and host.get("oauth_token"):
+                tokens.append(host["oauth_token"])
+        return tokens
+
     def _get_hosts_file_path(self) -> str:
         """获取 hosts.json 文件路径"""
         if os.name == 'nt':  # Windows
-            if not os.path.exists(os.path.expandvars("%LOCALAPPDATA%\\Local\\github-copilot")):
-                os.makedirs(os.path.expandvars("%LOCALAPPDATA%\\Local\\github-copilot"), exist_ok=True)
             return os.path.expandvars(r"%APPDATA%\Local\github-copilot\hosts.json")
         else:  # Unix-like
-            if not os.path.exists(os.path.expanduser("~/.config/github-copilot")):
-                os.makedirs(os.path.expanduser("~/.config/github-copilot"), exist_ok=True)
             return os.path.expanduser("~/.config/github-copilot/hosts.json")
 
     def save_token(self, oauth_token: str):
-        """保存认证令牌到 hosts.json 文件"""
-        data = {"github.com": {"oauth_token": oauth_token}}
-        with open(self.hosts_file, 'w') as f:
-            f.write(json.dumps(data, indent=2, ensure_ascii=False))
+        """保存认证令牌到 hosts.json 文件（同步写文件，在事件循环中请通过 asyncio.to_thread 调用）。
+        先写临时文件再替换，读取方不会读到写了一半的文件；保留其他 host 的条目"""
+        directory = os.path.dirname(self.hosts_file)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.hosts_file, 'r') as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                data = {}
+        except (OSError, ValueError):
+            data = {}
+        data["github.com"] = {"oauth_token": oauth_token}
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".hosts.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps(data, indent=2, ensure_ascii=False))
+            os.replace(tmp_path, self.hosts_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.token = oauth_token
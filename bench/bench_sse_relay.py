@@ -0,0 +1,118 @@
+"""
+SSE 转发微基准：对比旧的逐块 decode/json.loads/json.dumps 实现与 SSERelay
+
+用法: python bench/bench_sse_relay.py [--chunks 2000] [--streams 50]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api import fast_json  # noqa: E402
+from api.sse import SSERelay  # noqa: E402
+
+
+def make_upstream_lines(chunks: int) -> list:
+    """构造与 Copilot 上游格式一致的 SSE 行"""
+    lines = [b'data: {"choices":[],"created":0,"id":"","prompt_filter_results":[]}\n', b"\n"]
+    for i in range(chunks):
+        chunk = {
+            "choices": [{
+                "index": 0,
+                "content_filter_results": {},
+                "delta": {"content": f"token{i} ", "role": "assistant" if i == 0 else None},
+                "finish_reason": "stop" if i == chunks - 1 else None,
+            }],
+            "created": 1742000000,
+            "id": "chatcmpl-upstream",
+            "model": "gpt-4o-2024-11-20",
+        }
+        lines.append(b"data: " + json.dumps(chunk).encode() + b"\n")
+        lines.append(b"\n")
+    lines.append(b"data: [DONE]\n")
+    return lines
+
+
+def legacy_relay(lines: list, model: str) -> int:
+    """旧实现（引入 SSERelay 之前 ChatAPI.stream_chat 的逐行逻辑）"""
+    emitted = 0
+    for line in lines:
+        try:
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            if not line.startswith('data: '):
+                continue
+            data = line[6:].strip()
+            if data == '[DONE]':
+                break
+            chunk = json.loads(data)
+            if not chunk.get('choices'):
+                continue
+            content = chunk['choices'][0].get('delta', {}).get('content', '')
+            if not content:
+                continue
+            response_chunk = {
+                'id': f"chatcmpl-{int(time.time() * 1000)}",
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': content}, 'finish_reason': None}]
+            }
+            f"data: {json.dumps(response_chunk)}\n\n".encode("utf-8")
+            emitted += 1
+        except Exception:
+            continue
+    return emitted
+
+
+def new_relay(lines: list, model: str) -> int:
+    relay = SSERelay(model)
+    emitted = 0
+    for line in lines:
+        try:
+            event = relay.feed(line)
+        except ValueError:
+            continue
+        if relay.done:
+            break
+        if event is not None:
+            emitted += 1
+    return emitted
+
+
+def measure(name: str, fn, lines: list, streams: int) -> dict:
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    emitted = 0
+    for _ in range(streams):
+        emitted += fn(lines, "gpt-4o")
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    return {
+        "name": name,
+        "chunks": emitted,
+        "chunks_per_sec": round(emitted / wall),
+        "cpu_ms_per_stream": round(cpu * 1000 / streams, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=2000, help="每个流的上游 chunk 数")
+    parser.add_argument("--streams", type=int, default=50, help="重复的流数量")
+    args = parser.parse_args()
+
+    lines = make_upstream_lines(args.chunks)
+    results = [
+        measure("legacy", legacy_relay, lines, args.streams),
+        measure("relay", new_relay, lines, args.streams),
+    ]
+    print(json.dumps({"json_backend": fast_json.BACKEND, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
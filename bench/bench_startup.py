@@ -0,0 +1,145 @@
+"""
+启动基准：测量 `import server` 的耗时，以及从启动进程到 /healthz、/readyz 可用和第一个补全请求成功的时间，
+对比开启与关闭启动预热（STARTUP_PREWARM）。上游使用 bench/mock_upstream.py，通过 --control-latency-ms 模拟访问 GitHub API 的往返延迟。
+
+用法:
+    python bench/bench_startup.py --runs 5 --control-latency-ms 300 --output bench/startup.json
+    python bench/bench_startup.py --env PREWARM_CONNECTIONS=4
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Any, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import ROOT, start_server, _free_port  # noqa: E402
+from mock_upstream import create_app, add_arguments, config_from_args  # noqa: E402
+
+PAYLOAD = {
+    "model": "gpt-4o",
+    "stream": False,
+    "messages": [{"role": "user", "content": "hello"}],
+}
+
+
+def measure_import(runs: int) -> Dict[str, Any]:
+    """在新进程中导入 server 模块，返回多次运行的耗时中位数（秒），不含解释器自身的启动时间"""
+    code = "import time; s = time.perf_counter(); import server; print(time.perf_counter() - s)"
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True,
+                             check=True)
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return {"median": round(statistics.median(samples), 4), "min": round(min(samples), 4)}
+
+
+async def _wait_status(session: aiohttp.ClientSession, url: str, process: subprocess.Popen,
+                       start: float, timeout: float) -> Optional[float]:
+    """轮询直到 url 返回 200，返回自进程启动起的秒数"""
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                if response.status == 200:
+                    return time.perf_counter() - start
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.01)
+    return None
+
+
+async def cold_start(upstream: str, extra_env: Dict[str, str], timeout: float) -> Dict[str, Any]:
+    """启动一个服务端进程，依次等待 /healthz、/readyz，再发送第一个补全请求"""
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as home, open(os.path.join(home, "server.log"), "w+") as log:
+        start = time.perf_counter()
+        process = start_server(port, upstream, extra_env, home, log)
+        try:
+            async with aiohttp.ClientSession() as session:
+                healthy = await _wait_status(session, f"{base_url}/healthz", process, start, timeout)
+                ready = await _wait_status(session, f"{base_url}/readyz", process, start, timeout)
+                # 请求前的时间点，区分就绪后首个请求自身的耗时
+                sent = time.perf_counter()
+                async with session.post(f"{base_url}/v1/chat/completions", json=PAYLOAD) as response:
+                    await response.read()
+                    status = response.status
+                done = time.perf_counter()
+        except RuntimeError:
+            log.seek(0)
+            print(log.read()[-4000:], file=sys.stderr)
+            raise
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+    return {
+        "healthz": healthy,
+        "readyz": ready,
+        "first_completion": done - start if status == 200 else None,
+        "first_request_latency": done - sent if status == 200 else None,
+    }
+
+
+def _summarize(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    summary = {}
+    for key in runs[0]:
+        values = [r[key] for r in runs if r[key] is not None]
+        summary[key] = round(statistics.median(values), 4) if values else None
+    return summary
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    config = config_from_args(args)
+    upstream_port = _free_port()
+    runner = web.AppRunner(create_app(config), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", upstream_port).start()
+    upstream = f"http://127.0.0.1:{upstream_port}"
+
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    results = {}
+    try:
+        for prewarm in ("true", "false"):
+            runs = [await cold_start(upstream, {**extra_env, "STARTUP_PREWARM": prewarm}, args.timeout)
+                    for _ in range(args.runs)]
+            results[f"prewarm={prewarm}"] = _summarize(runs)
+    finally:
+        await runner.cleanup()
+    return {"upstream": vars(config), "env": extra_env, "cold_start": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure import time and time to first successful completion")
+    parser.add_argument("--runs", type=int, default=5, help="每项测量的次数，取中位数")
+    parser.add_argument("--timeout", type=float, default=60, help="单次启动等待的最长秒数")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="传给服务端的环境变量")
+    parser.add_argument("--output", default="", help="结果 JSON 文件路径")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    imports = measure_import(args.runs)
+    print(f"import server: median {imports['median'] * 1000:.1f} ms, min {imports['min'] * 1000:.1f} ms")
+    report = asyncio.run(main(args))
+    report["import_seconds"] = imports
+    fmt = lambda v: "-" if v is None else f"{v * 1000:.0f}"
+    print(f"{'mode':<15} {'healthz ms':>10} {'readyz ms':>10} {'first ok ms':>12} {'first req ms':>13}")
+    for mode, r in report["cold_start"].items():
+        print(f"{mode:<15} {fmt(r['healthz']):>10} {fmt(r['readyz']):>10} {fmt(r['first_completion']):>12} "
+              f"{fmt(r['first_request_latency']):>13}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.output}")
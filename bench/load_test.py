@@ -0,0 +1,321 @@
+"""
+端到端压测：启动本地模拟上游（bench/mock_upstream.py）和真实的服务端进程，按不同并发度发送流式 / 非流式请求，
+统计吞吐、p50/p99 延迟、首字延迟、每个请求的 CPU 时间和 RSS，并给出最大可持续并发度。结果写入 JSON 便于对比。
+
+用法:
+    python bench/load_test.py --concurrency 1,8,32,128 --duration 10 --output bench/results.json
+    python bench/load_test.py --baseline bench/results.json   # 与上次结果对比
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from typing import Dict, Any, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_upstream import MockConfig, create_app, add_arguments, config_from_args  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(int(len(ordered) * q), len(ordered) - 1)], 4)
+
+
+class ProcessSampler:
+    """通过 /proc 读取服务端进程的 CPU 时间和 RSS（仅 Linux）"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def cpu_seconds(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self._ticks
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def rss_mb(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            pass
+        return None
+
+
+async def _one_request(session: aiohttp.ClientSession, url: str, stream: bool, result: Dict[str, list]):
+    payload = {
+        "model": "gpt-4o",
+        "stream": stream,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "Write a short story about a benchmark."},
+        ],
+    }
+    start = time.perf_counter()
+    try:
+        async with session.post(url, json=payload) as response:
+            if response.status != 200:
+                await response.read()
+                result["errors"].append(response.status)
+                return
+            if stream:
+                first = None
+                async for line in response.content:
+                    if first is None and line.startswith(b"data: {"):
+                        first = time.perf_counter() - start
+                    if b"stream_error" in line:
+                        result["errors"].append("stream_error")
+                        return
+                if first is not None:
+                    result["ttft"].append(first)
+            else:
+                await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        result["errors"].append(type(e).__name__)
+        return
+    result["latency"].append(time.perf_counter() - start)
+
+
+async def run_level(base_url: str, concurrency: int, duration: float, stream: bool,
+                    sampler: ProcessSampler) -> Dict[str, Any]:
+    """以固定并发度持续发送请求 duration 秒（闭环：每个 worker 收到响应后立即发下一个）"""
+    url = f"{base_url}/v1/chat/completions"
+    result: Dict[str, list] = {"latency": [], "ttft": [], "errors": []}
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=120)
+    rss_peak = 0.0
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                await _one_request(session, url, stream, result)
+
+        async def sample_rss():
+            nonlocal rss_peak
+            while True:
+                rss_peak = max(rss_peak, sampler.rss_mb() or 0.0)
+                await asyncio.sleep(0.2)
+
+        cpu_start = sampler.cpu_seconds()
+        wall_start = time.perf_counter()
+        sampler_task = asyncio.create_task(sample_rss())
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        sampler_task.cancel()
+        elapsed = time.perf_counter() - wall_start
+        cpu_end = sampler.cpu_seconds()
+
+    completed = len(result["latency"])
+    total = completed + len(result["errors"])
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    errors: Dict[str, int] = {}
+    for error in result["errors"]:
+        errors[str(error)] = errors.get(str(error), 0) + 1
+    return {
+        "concurrency": concurrency,
+        "stream": stream,
+        "requests": total,
+        "completed": completed,
+        "error_rate": round(len(result["errors"]) / total, 4) if total else 0.0,
+        "errors": errors,
+        "throughput_rps": round(completed / elapsed, 2),
+        "latency_p50": _percentile(result["latency"], 0.5),
+        "latency_p99": _percentile(result["latency"], 0.99),
+        "ttft_p50": _percentile(result["ttft"], 0.5),
+        "ttft_p99": _percentile(result["ttft"], 0.99),
+        "server_cpu_seconds": round(cpu, 3) if cpu is not None else None,
+        "server_cpu_ms_per_request": round(cpu * 1000 / completed, 3) if cpu is not None and completed else None,
+        "server_cpu_utilization": round(cpu / elapsed, 3) if cpu is not None else None,
+        "server_rss_peak_mb": rss_peak or None,
+    }
+
+
+def max_sustainable(levels: List[Dict[str, Any]], max_error_rate: float, slo: Optional[float]) -> Dict[str, Any]:
+    """错误率不超过 max_error_rate 且 p99 延迟不超过 SLO（默认取最低并发度 p99 的 2 倍）的最大并发度"""
+    if not levels:
+        return {"concurrency": None, "slo_seconds": slo}
+    if slo is None and levels[0]["latency_p99"] is not None:
+        slo = round(levels[0]["latency_p99"] * 2, 4)
+    best = None
+    for level in levels:
+        p99 = level["latency_p99"]
+        if level["error_rate"] <= max_error_rate and p99 is not None and (slo is None or p99 <= slo):
+            best = level["concurrency"]
+    return {"concurrency": best, "slo_seconds": slo, "max_error_rate": max_error_rate}
+
+
+def start_server(port: int, upstream: str, extra_env: Dict[str, str], home: str, log) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "HOST": "127.0.0.1",
+        "PORT": str(port),
+        "COPILOT_API_BASE": upstream,
+        "GITHUB_API_BASE": upstream,
+        "GH_COPILOT_TOKEN": "mock-oauth-token",
+        "LOG_LEVEL": "WARNING",
+        # 避免读取本机真实的 hosts.json
+        "HOME": home,
+        "PYTHONPATH": ROOT,
+    })
+    env.update(extra_env)
+    # 服务端日志（包括 uvicorn 访问日志）写入文件，避免干扰结果输出
+    return subprocess.Popen([sys.executable, "server.py"], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(base_url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"server exited with code {process.returncode}")
+            try:
+                async with session.get(f"{base_url}/stats") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]):
+    """打印与基线结果的差异（按模式和并发度对齐）"""
+    keys = ("throughput_rps", "latency_p50", "latency_p99", "ttft_p50", "server_cpu_ms_per_request")
+    previous = {(r["stream"], r["concurrency"]): r for r in baseline.get("results", [])}
+    print("\ncompared with baseline:")
+    for result in current["results"]:
+        old = previous.get((result["stream"], result["concurrency"]))
+        if old is None:
+            continue
+        changes = []
+        for key in keys:
+            if result.get(key) is not None and old.get(key):
+                changes.append(f"{key} {(result[key] - old[key]) / old[key] * 100:+.1f}%")
+        mode = "stream" if result["stream"] else "non-stream"
+        print(f"  {mode:<10} c={result['concurrency']:<4} " + ", ".join(changes))
+
+
+def print_header():
+    print(f"{'mode':<10} {'conc':>5} {'rps':>9} {'p50':>8} {'p99':>8} {'ttft50':>8} {'ttft99':>8} "
+          f"{'cpu ms/req':>10} {'rss MB':>7} {'err%':>6}")
+
+
+def print_row(r: Dict[str, Any]):
+    fmt = lambda v: "-" if v is None else f"{v:.3f}"
+    print(f"{'stream' if r['stream'] else 'non-stream':<10} {r['concurrency']:>5} {r['throughput_rps']:>9.1f} "
+          f"{fmt(r['latency_p50']):>8} {fmt(r['latency_p99']):>8} {fmt(r['ttft_p50']):>8} "
+          f"{fmt(r['ttft_p99']):>8} {fmt(r['server_cpu_ms_per_request']):>10} "
+          f"{fmt(r['server_rss_peak_mb']):>7} {r['error_rate'] * 100:>6.2f}")
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    config: MockConfig = config_from_args(args)
+    upstream_port = _free_port()
+    runner = web.AppRunner(create_app(config), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", upstream_port).start()
+    upstream = f"http://127.0.0.1:{upstream_port}"
+
+    server_port = _free_port()
+    base_url = f"http://127.0.0.1:{server_port}"
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    modes = {"stream": [True], "non-stream": [False], "both": [True, False]}[args.mode]
+    levels = [int(c) for c in args.concurrency.split(",")]
+
+    with tempfile.TemporaryDirectory() as home, open(os.path.join(home, "server.log"), "w+") as log:
+        process = start_server(server_port, upstream, extra_env, home, log)
+        try:
+            try:
+                await wait_ready(base_url, process)
+            except RuntimeError:
+                log.seek(0)
+                print(log.read()[-4000:], file=sys.stderr)
+                raise
+            sampler = ProcessSampler(process.pid)
+            results = []
+            print_header()
+            for stream in modes:
+                # 预热：建立连接、获取 Copilot token、加载模型目录
+                await run_level(base_url, 2, 1, stream, sampler)
+                for concurrency in levels:
+                    result = await run_level(base_url, concurrency, args.duration, stream, sampler)
+                    results.append(result)
+                    print_row(result)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+    await runner.cleanup()
+
+    sustainable = {}
+    for stream in modes:
+        mode_results = [r for r in results if r["stream"] == stream]
+        sustainable["stream" if stream else "non-stream"] = max_sustainable(mode_results, args.max_error_rate, args.slo)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mock": asdict(config),
+        "server_env": extra_env,
+        "duration": args.duration,
+        "results": results,
+        "max_sustainable_concurrency": sustainable,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the server against a mock Copilot upstream")
+    parser.add_argument("--concurrency", default="1,8,32,128", help="逗号分隔的并发度列表")
+    parser.add_argument("--duration", type=float, default=10, help="每个并发度持续的秒数")
+    parser.add_argument("--mode", choices=("stream", "non-stream", "both"), default="both")
+    parser.add_argument("--slo", type=float, default=None, help="p99 延迟上限（秒），默认取最低并发度 p99 的 2 倍")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="传给服务端的环境变量")
+    parser.add_argument("--output", default="", help="结果 JSON 文件路径")
+    parser.add_argument("--baseline", default="", help="用于对比的历史结果 JSON")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    print("\nmax sustainable concurrency:", json.dumps(report["max_sustainable_concurrency"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
@@ -0,0 +1,183 @@
+"""
+本地模拟的 Copilot 上游：token 接口、模型目录、chat/completions（流式与非流式）、embeddings
+
+可配置首字节延迟、chunk 数量与大小、输出速度和错误注入，供 bench/load_test.py 使用，也可单独运行：
+    python bench/mock_upstream.py --port 9100 --latency-ms 200 --token-rate 50
+
+服务端通过 COPILOT_API_BASE=http://127.0.0.1:9100 GITHUB_API_BASE=http://127.0.0.1:9100 指向该模拟上游
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+from aiohttp import web
+
+
+@dataclass
+class MockConfig:
+    # 收到请求到返回响应头的延迟（毫秒）
+    latency_ms: float = 50
+    # token 和模型列表接口的延迟（毫秒），模拟访问 GitHub API 的往返
+    control_latency_ms: float = 0
+    # 每个响应的 chunk 数
+    chunks: int = 50
+    # 每个 chunk 的字符数
+    chunk_chars: int = 16
+    # 每秒输出的 chunk 数，0 表示不限速
+    token_rate: float = 200
+    # 返回错误的概率（0~1）
+    error_rate: float = 0.0
+    # 注入的错误状态码
+    error_status: int = 500
+    # 流式响应中途断开的概率（0~1）
+    stream_abort_rate: float = 0.0
+
+
+def _chunk(i: int, text: str, last: bool) -> bytes:
+    return b"data: " + json.dumps({
+        "choices": [{
+            "index": 0,
+            "content_filter_results": {},
+            "delta": {"content": text, "role": "assistant" if i == 0 else None},
+            "finish_reason": "stop" if last else None,
+        }],
+        "created": int(time.time()),
+        "id": "chatcmpl-mock",
+        "model": "gpt-4o-mock",
+    }).encode() + b"\n\n"
+
+
+def create_app(config: MockConfig) -> web.Application:
+    stats = {"token": 0, "models": 0, "chat": 0, "stream": 0, "embeddings": 0, "errors": 0, "client_aborts": 0}
+
+    async def token(request: web.Request) -> web.Response:
+        stats["token"] += 1
+        if config.control_latency_ms > 0:
+            await asyncio.sleep(config.control_latency_ms / 1000)
+        now = int(time.time())
+        return web.json_response({"token": "mock-copilot-token", "expires_at": now + 1800, "refresh_in": 1500})
+
+    async def models(request: web.Request) -> web.Response:
+        stats["models"] += 1
+        if config.control_latency_ms > 0:
+            await asyncio.sleep(config.control_latency_ms / 1000)
+        limits = {"max_context_window_tokens": 128000, "max_prompt_tokens": 64000, "max_output_tokens": 4096}
+        return web.json_response({"data": [
+            {"id": model, "name": model, "vendor": "mock",
+             "capabilities": {"type": "chat", "limits": limits, "supports": {"streaming": True, "tool_calls": True}}}
+            for model in ("gpt-4", "gpt-4o", "claude-3.5-sonnet", "o3-mini")
+        ] + [{"id": "text-embedding-3-small", "capabilities": {"type": "embeddings"}}]})
+
+    def inject_error() -> Optional[web.Response]:
+        if config.error_rate > 0 and random.random() < config.error_rate:
+            stats["errors"] += 1
+            headers = {"retry-after": "1"} if config.error_status == 429 else None
+            return web.Response(status=config.error_status, text="injected error", headers=headers)
+        return None
+
+    async def chat(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if config.latency_ms > 0:
+            await asyncio.sleep(config.latency_ms / 1000)
+        error = inject_error()
+        if error is not None:
+            return error
+        text = "x" * (config.chunk_chars - 1) + " "
+        interval = 1 / config.token_rate if config.token_rate > 0 else 0
+
+        if not body.get("stream"):
+            stats["chat"] += 1
+            if interval:
+                await asyncio.sleep(interval * config.chunks)
+            return web.json_response({
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text * config.chunks},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": config.chunks, "total_tokens": 10 + config.chunks},
+            })
+
+        stats["stream"] += 1
+        response = web.StreamResponse(headers={"content-type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(b'data: {"choices":[],"created":0,"id":"","prompt_filter_results":[]}\n\n')
+        abort_at = random.randrange(config.chunks) if random.random() < config.stream_abort_rate else -1
+        try:
+            for i in range(config.chunks):
+                if i == abort_at:
+                    request.transport.close()
+                    return response
+                await response.write(_chunk(i, text, i == config.chunks - 1))
+                if interval:
+                    await asyncio.sleep(interval)
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # 下游（被测服务端）提前关闭了连接
+            stats["client_aborts"] += 1
+        except asyncio.CancelledError:
+            stats["client_aborts"] += 1
+            raise
+        return response
+
+    async def embeddings(request: web.Request) -> web.Response:
+        body = await request.json()
+        if config.latency_ms > 0:
+            await asyncio.sleep(config.latency_ms / 1000)
+        error = inject_error()
+        if error is not None:
+            return error
+        stats["embeddings"] += 1
+        inputs = body.get("input") or []
+        return web.json_response({
+            "data": [{"index": i, "embedding": [random.random() for _ in range(256)]} for i in range(len(inputs))],
+            "usage": {"prompt_tokens": sum(len(t) // 4 + 1 for t in inputs)},
+        })
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response({"config": asdict(config), "requests": stats})
+
+    app = web.Application()
+    app.router.add_get("/copilot_internal/v2/token", token)
+    app.router.add_get("/models", models)
+    app.router.add_post("/chat/completions", chat)
+    app.router.add_post("/embeddings", embeddings)
+    app.router.add_get("/_stats", get_stats)
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = MockConfig()
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms, help="首字节延迟（毫秒）")
+    parser.add_argument("--control-latency-ms", type=float, default=defaults.control_latency_ms,
+                        help="token 和模型列表接口的延迟（毫秒）")
+    parser.add_argument("--chunks", type=int, default=defaults.chunks, help="每个响应的 chunk 数")
+    parser.add_argument("--chunk-chars", type=int, default=defaults.chunk_chars, help="每个 chunk 的字符数")
+    parser.add_argument("--token-rate", type=float, default=defaults.token_rate, help="每秒 chunk 数，0 为不限速")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="错误注入概率")
+    parser.add_argument("--error-status", type=int, default=defaults.error_status, help="注入的错误状态码")
+    parser.add_argument("--stream-abort-rate", type=float, default=defaults.stream_abort_rate,
+                        help="流式响应中途断开的概率")
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(
+        latency_ms=args.latency_ms,
+        control_latency_ms=args.control_latency_ms,
+        chunks=args.chunks,
+        chunk_chars=args.chunk_chars,
+        token_rate=args.token_rate,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        stream_abort_rate=args.stream_abort_rate,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Copilot upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(create_app(config_from_args(args)), host=args.host, port=args.port)
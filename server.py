@@ -1,27 +1,119 @@
-import json
+import asyncio
 import os
+import re
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple
 
-import uvicorn
 from fastapi import FastAPI
 from loguru import logger
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import Request
-from starlette.responses import StreamingResponse, HTMLResponse, RedirectResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
+from starlette.responses import StreamingResponse, HTMLResponse, RedirectResponse, JSONResponse, Response, \
+    PlainTextResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 
-from api.chat_stream import run_stream, run
-from auth.device_auth import DeviceAuth
+from api import fast_json, metrics, request_log, resilience
+from api.batches import batch_manager, parse_multipart, FILES_MAX_BYTES
+from api.chat_stream import run_stream, run, prepare_prompt
+from api.embeddings import embedding_batcher, parse_request as parse_embeddings_request, \
+    build_response as build_embeddings_response
+from api.errors import UpstreamError, upstream_error_body
+from api.http_client import http_client
+from api.model_catalog import model_catalog, UnknownModelError
+from api.prefix_store import prefix_store
+from api.response_cache import response_cache
+from api.scheduler import scheduler, OverloadedError
+from api.shared_state import hash_key
+from api.sse import DONE, StreamUsage
+from api.startup import readiness
+from api.stream_pump import pump, ClientDisconnected
+from api.token_counter import token_counter, ContextLengthError
+from api.token_manager import copilot_tokens
+from api.usage_ledger import usage_ledger, ApiKey, QuotaExceededError, parse_usage
+from auth.credential_provider import credential_provider
+from auth.device_auth import device_flows
 
-app = FastAPI(title="GitHub Copilot API")
 
-DEFAULT_API_KEY = ""
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：统一管理上游连接池、凭据和 Copilot token 刷新"""
+    await http_client.start()
+    await token_counter.start()
+    await credential_provider.start()
+    await model_catalog.start()
+    await batch_manager.start()
+    await usage_ledger.start()
+    await readiness.start()
+    yield
+    await readiness.close()
+    await device_flows.close()
+    await batch_manager.close()
+    await usage_ledger.close()
+    await model_catalog.close()
+    await credential_provider.close()
+    await copilot_tokens.close()
+    await http_client.close()
+    await logger.complete()
 
-# 设置模板
-templates = Jinja2Templates(directory="templates")
 
-# 静态文件
-app.mount("/static", StaticFiles(directory="static"), name="static")
+request_log.setup()
+
+app = FastAPI(title="GitHub Copilot API", lifespan=lifespan)
+
+metrics.registry.gauge_callback(
+    "copilot_ready", "1 once startup prewarm has completed", lambda: int(readiness.ready))
+metrics.registry.gauge_callback(
+    "copilot_queue_depth", "Requests waiting for admission", lambda: scheduler.queue_depth)
+metrics.registry.gauge_callback(
+    "copilot_scheduler_inflight", "Requests holding an admission slot", lambda: scheduler.inflight)
+metrics.registry.gauge_callback(
+    "copilot_queue_wait_seconds_total", "Total time requests waited for admission",
+    lambda: scheduler.get_stats()["wait_time_total"])
+metrics.registry.gauge_callback(
+    "copilot_token_cache", "Copilot token cache counters",
+    lambda: {(("result", k),): v for k, v in copilot_tokens.get_stats().items() if k != "hit_rate"})
+metrics.registry.gauge_callback(
+    "copilot_upstream_connections", "Upstream connection pool counters",
+    lambda: {(("kind", k),): v for k, v in http_client.get_stats().items()})
+metrics.registry.gauge_callback(
+    "copilot_circuit_open", "Whether the per-model circuit breaker is open (1) or half open (0.5)",
+    lambda: {(("model", model),): {"closed": 0, "half_open": 0.5, "open": 1}[b["state"]]
+             for model, b in resilience.circuit_breakers.get_stats().items()})
+metrics.registry.gauge_callback(
+    "copilot_prefix_cache", "Conversation prefix cache counters",
+    lambda: {(("kind", k),): v for k, v in prefix_store.get_stats().items() if k != "hit_rate"})
+metrics.registry.gauge_callback(
+    "copilot_prefix_cache_hit_ratio", "Share of messages served from the conversation prefix cache",
+    lambda: prefix_store.get_stats()["hit_rate"])
+metrics.registry.gauge_callback(
+    "copilot_batches", "Batch API counters",
+    lambda: {(("kind", k),): v for k, v in batch_manager.get_stats().items() if k != "active"})
+metrics.registry.gauge_callback(
+    "copilot_usage_ledger", "API key usage ledger counters",
+    lambda: {(("kind", k),): v for k, v in usage_ledger.get_stats().items()})
+metrics.registry.gauge_callback(
+    "copilot_account_requests", "Per Copilot account request counters",
+    lambda: {(("account", a["account"]), ("kind", k)): v
+             for a in credential_provider.pool.get_stats()
+             for k, v in a.items() if k not in ("account", "source")})
+
+_templates = None
+
+
+def get_templates():
+    """模板引擎只有设备认证页面使用，首次访问时再导入 jinja2，缩短启动时间"""
+    global _templates
+    if _templates is None:
+        from fastapi.templating import Jinja2Templates
+        _templates = Jinja2Templates(directory="templates")
+    return _templates
+
+
+# 静态文件（目录不在版本库中，存在时才挂载）
+if os.path.isdir("static"):
+    app.mount("/static", StaticFiles(directory="static"), name="static")
 
 app.add_middleware(
     CORSMiddleware,
@@ -40,50 +132,131 @@ async def root():
 
 @app.get("/auth/device", response_class=HTMLResponse)
 async def device_auth(request: Request):
-    """设备认证页面"""
-    auth = DeviceAuth()
-    auth_info = await auth.new_get_token()
-
-    if "error" in auth_info:
-        return HTMLResponse(content=f"<h1>错误</h1><p>{auth_info['error']}</p>")
+    """设备认证页面：申请设备码后立即返回，授权结果由后台轮询，页面通过 /auth/status 查询"""
+    try:
+        flow = await device_flows.start()
+    except Exception as e:
+        logger.warning("Request device code failed: {}", e)
+        flow = None
+    if flow is None:
+        return HTMLResponse(content="<h1>错误</h1><p>获取设备码失败</p>")
 
-    return templates.TemplateResponse(
+    return get_templates().TemplateResponse(
+        request,
         "auth.html",
         {
-            "request": request,
-            "user_code": auth_info["user_code"],
-            "verification_uri": auth_info["verification_uri"],
-            "device_code": auth_info["device_code"]
+            "user_code": flow.user_code,
+            "verification_uri": flow.verification_uri,
+            "flow_id": flow.id,
         }
     )
 
 
-@app.post("/auth/confirm/{device_code}")
-async def confirm_auth(device_code: str):
-    """确认认证"""
-    auth = DeviceAuth()
-    result = await auth.confirm_token(device_code)
-    return JSONResponse(content=result)
+@app.get("/auth/status/{flow_id}")
+async def device_auth_status(flow_id: str):
+    """设备认证状态：pending / authorized / expired / denied / error"""
+    status = await device_flows.status(flow_id)
+    if status is None:
+        return _not_found("No such device authorization")
+    return status
+
+
+@app.post("/auth/confirm/{flow_id}")
+async def confirm_auth(flow_id: str):
+    """用户点击"已完成验证"：不阻塞等待，直接返回后台轮询的当前状态"""
+    return await device_auth_status(flow_id)
+
+
+def _model_not_found(error: UnknownModelError) -> JSONResponse:
+    return JSONResponse(
+        status_code=404,
+        content={"error": {"message": str(error), "type": "invalid_request_error", "param": "model",
+                           "code": "model_not_found"}}
+    )
+
+
+def _not_found(message: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=404,
+        content={"error": {"message": message, "type": "invalid_request_error", "code": "not_found"}}
+    )
+
+
+def _authenticate(headers) -> Tuple[Optional[ApiKey], Optional[JSONResponse]]:
+    """按 key 存储（或 API_KEY）校验 Authorization 头，返回 (key, None)，未通过时返回 (None, 401 响应)"""
+    key = usage_ledger.keys.authenticate(headers.get("Authorization"))
+    if key is None:
+        return None, JSONResponse(
+            status_code=401,
+            content={"error": {"message": "invalid token", "type": "invalid_request_error"}}
+        )
+    return key, None
+
+
+def _limit_key(request: Request, key: ApiKey) -> str:
+    """并发和限流按调用方计算：配置了 key 时为 key 的摘要，否则为 Authorization 头或客户端地址的摘要；
+    批次保存该值，批量请求计入创建者的限额"""
+    return key.digest or hash_key(request.headers.get("Authorization") or request.client.host)
+
+
+def _owner(key: ApiKey) -> Optional[str]:
+    """文件和批次按创建的 key 隔离，管理员 key 可以访问全部（返回 None）"""
+    return None if key.admin else key.name
+
+
+def _check_quota(key: ApiKey) -> Optional[JSONResponse]:
+    """key 的配额已用完时返回 429 响应"""
+    try:
+        usage_ledger.check_quota(key)
+    except QuotaExceededError as e:
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"message": str(e), "type": "insufficient_quota", "code": "insufficient_quota"}}
+        )
+    return None
+
+
+def _upstream_error_response(e: UpstreamError) -> JSONResponse:
+    status, body = upstream_error_body(e)
+    if status == 429:
+        headers = {"Retry-After": str(int(e.retry_after or 0) or 1)}
+    else:
+        headers = {"Retry-After": str(int(e.retry_after))} if e.retry_after else None
+    return JSONResponse(status_code=status, content=body, headers=headers)
+
+
+def _get_priority(headers) -> int:
+    """请求优先级，取自 X-Priority 头，越大越优先"""
+    try:
+        return int(headers.get("X-Priority", 0))
+    except ValueError:
+        return 0
 
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
     """处理聊天完成请求，支持 OpenAI API 兼容的流式输出"""
     try:
-        logger.debug("Received request: {}", str(await request.body(), encoding="utf-8"))
         # 校验header
         headers = request.headers
-        api_key = headers.get("Authorization")
-        server_auth_key = os.getenv("API_KEY", DEFAULT_API_KEY)
-        if server_auth_key:
-            if not api_key:
-                return {"error": {"message": "invalid token", "type": "invalid_request_error"}}, 401
-            if api_key != 'Bearer ' + server_auth_key:
-                return {"error": {"message": "invalid token", "type": "invalid_request_error"}}, 401
-
-        data = await request.json()
-        if data.get("model", '') == 'gpt-4o-mini':
-            data["model"] = 'claude-3.5-sonnet'
+        key, error = _authenticate(headers)
+        if error is None:
+            error = _check_quota(key)
+        if error is not None:
+            return error
+
+        # 请求体只解析一次；负载日志仅在 DEBUG 级别且命中采样时才输出
+        body = await request.body()
+        request_id = request_log.new_request_id(headers.get("X-Request-ID", ""))
+        log_payloads = request_log.payload_enabled()
+        if log_payloads:
+            request_log.log_payload("request", request_id, body)
+        data = fast_json.loads(body)
+        # 解析别名，未知模型在本地直接拒绝
+        try:
+            data["model"] = model_catalog.resolve(data.get("model", "gpt-4"))
+        except UnknownModelError as e:
+            return _model_not_found(e)
 
         messages = data.get("messages", [])
         stream = data.get("stream", False)
@@ -91,6 +264,35 @@ async def chat_completions(request: Request):
             logger.debug("No messages received")
             return {"error": {"message": "no messages found", "type": "invalid_request_error"}}, 400
 
+        # 校验、规范化消息并本地估算 prompt token 数（复用已见过的对话前缀），
+        # 超出模型上下文上限时在上传前拒绝（或按配置截断）
+        try:
+            prompt = prepare_prompt(data)
+        except ContextLengthError as e:
+            return JSONResponse(
+                status_code=400,
+                content={"error": {"message": str(e), "type": "invalid_request_error", "param": "messages",
+                                   "code": "context_length_exceeded"}}
+            )
+        except ValueError as e:
+            return JSONResponse(
+                status_code=400,
+                content={"error": {"message": str(e), "type": "invalid_request_error", "param": "messages"}}
+            )
+
+        tracker = metrics.RequestTracker(request_id, data.get("model", "gpt-4"), stream)
+
+        # 准入控制：超出并发或限流时返回 429
+        try:
+            await scheduler.acquire(_limit_key(request, key), _get_priority(headers))
+        except OverloadedError as e:
+            tracker.finish(429)
+            return JSONResponse(
+                status_code=429,
+                content={"error": {"message": str(e), "type": "rate_limit_error", "code": "rate_limit_exceeded"}},
+                headers={"Retry-After": str(max(int(e.retry_after + 0.999), 1)), "X-Request-ID": request_id}
+            )
+
         if stream:
             # 处理流式请求
             # 设置 SSE 响应头
@@ -99,19 +301,46 @@ async def chat_completions(request: Request):
                 "Cache-Control": "no-cache",
                 "Connection": "keep-alive",
                 "Access-Control-Allow-Origin": "*",
-                "X-Accel-Buffering": "no"
+                "X-Accel-Buffering": "no",
+                "X-Request-ID": request_id,
             }
 
             async def event_generator():
+                status = 200
+                chunks = 0
+                sent = 0
+                ttft = None
+                stream_usage = StreamUsage()
                 try:
-                    async for chunk in run_stream(data):
-                        logger.debug(chunk)
+                    # 有界缓冲 + 断开检测：客户端断开后立即取消上游请求
+                    async for chunk in pump(run_stream(data, prompt, stream_usage), request.is_disconnected):
+                        if not chunks:
+                            ttft = round(time.perf_counter() - tracker.start, 3)
+                        chunks += 1
+                        sent += len(chunk)
                         yield chunk
+                except (ClientDisconnected, asyncio.CancelledError, GeneratorExit) as e:
+                    # 499：客户端在响应完成前关闭了连接
+                    status = 499
+                    metrics.STREAM_CANCELLATIONS.labels(tracker.model).inc()
+                    if isinstance(e, ClientDisconnected):
+                        return
+                    raise
                 except Exception as e:
+                    status = 500
                     logger.exception("Exception occurred: {}", e)
-                    error_response = json.dumps({"error": {"message": str(e), "type": "stream_error"}})
-                    yield f"data: {error_response}\n\n"
-                yield "data: [DONE]\n\n"
+                    error_response = fast_json.dumps({"error": {"message": str(e), "type": "stream_error"}})
+                    yield b"data: " + error_response + b"\n\n"
+                finally:
+                    scheduler.release()
+                    tracker.finish(status, chunks=chunks, bytes=sent, ttft=ttft, prompt_tokens=prompt.tokens)
+                    if chunks:
+                        # 上游没有返回 usage 时，按已转发的输出文本估算
+                        usage = stream_usage.usage or token_counter.estimate_usage(
+                            tracker.model, prompt.tokens or 0, stream_usage.completion_text)
+                        usage_ledger.record(key.name, usage.get("prompt_tokens"), usage.get("completion_tokens"),
+                                            stream_bytes=sent)
+                yield DONE
 
             return StreamingResponse(
                 event_generator(),
@@ -120,16 +349,38 @@ async def chat_completions(request: Request):
             )
         else:
             # 处理非流式请求
+            status = 500
+            cache_status = None
+            response_headers = {"X-Request-ID": request_id}
             try:
-                response = await run(data)
-                logger.debug(f"Non-streaming response: {response}")
-                return JSONResponse(content=response)
+                if response_cache.enabled:
+                    bypass = "no-cache" in headers.get("Cache-Control", "").lower()
+                    content, cache_status = await response_cache.fetch(
+                        data, lambda d: run(d, prompt), bypass=bypass, normalized=prompt.normalized)
+                    response_headers["X-Cache"] = cache_status
+                else:
+                    content = fast_json.ensure_bytes(await run(data, prompt))
+                status = 200
+                prompt_tokens, completion_tokens = parse_usage(content)
+                usage_ledger.record(key.name, prompt_tokens if prompt_tokens is not None else prompt.tokens,
+                                    completion_tokens)
+                if log_payloads:
+                    request_log.log_payload("response", request_id, content)
+                return Response(content=content, media_type="application/json", headers=response_headers)
+            except UpstreamError as e:
+                logger.exception("Exception occurred: {}", e)
+                response = _upstream_error_response(e)
+                status = response.status_code
+                return response
             except Exception as e:
                 logger.exception("Exception occurred: {}", e)
                 return JSONResponse(
                     status_code=500,
                     content={"error": {"message": str(e), "type": "server_error"}}
                 )
+            finally:
+                scheduler.release()
+                tracker.finish(status, cache=cache_status, prompt_tokens=prompt.tokens)
     except ValueError as e:
         logger.exception("Exception occurred: {}", e)
         return JSONResponse(
@@ -144,24 +395,269 @@ async def chat_completions(request: Request):
         )
 
 
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    """向量化接口，并发请求会合并为上游批量请求；encoding_format=base64 时返回 float32 字节"""
+    headers = request.headers
+    key, error = _authenticate(headers)
+    if error is None:
+        error = _check_quota(key)
+    if error is not None:
+        return error
+
+    request_id = request_log.new_request_id(headers.get("X-Request-ID", ""))
+    try:
+        texts, model, dimensions, encoding_format = parse_embeddings_request(fast_json.loads(await request.body()))
+        model = model_catalog.resolve(model)
+    except UnknownModelError as e:
+        return _model_not_found(e)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"error": {"message": str(e), "type": "invalid_request_error"}}
+        )
+
+    try:
+        await scheduler.acquire(_limit_key(request, key), _get_priority(headers))
+    except OverloadedError as e:
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"message": str(e), "type": "rate_limit_error", "code": "rate_limit_exceeded"}},
+            headers={"Retry-After": str(max(int(e.retry_after + 0.999), 1)), "X-Request-ID": request_id}
+        )
+    try:
+        vectors, prompt_tokens = await embedding_batcher.embed(texts, model, dimensions)
+        usage_ledger.record(key.name, prompt_tokens)
+        content = build_embeddings_response(vectors, model, prompt_tokens, encoding_format)
+        return Response(content=content, media_type="application/json", headers={"X-Request-ID": request_id})
+    except UpstreamError as e:
+        logger.exception("Exception occurred: {}", e)
+        return _upstream_error_response(e)
+    except Exception as e:
+        logger.exception("Exception occurred: {}", e)
+        return JSONResponse(
+            status_code=500,
+            content={"error": {"message": str(e), "type": "server_error"}}
+        )
+    finally:
+        scheduler.release()
+
+
+@app.post("/v1/files")
+async def upload_file(request: Request):
+    """上传批量请求文件：multipart/form-data（file、purpose 字段），
+    或者请求体即文件内容、purpose 和 filename 通过查询参数传入"""
+    key, error = _authenticate(request.headers)
+    if error is not None:
+        return error
+    content_type = request.headers.get("Content-Type", "")
+    try:
+        if int(request.headers.get("Content-Length") or 0) > FILES_MAX_BYTES:
+            raise ValueError(f"file exceeds the {FILES_MAX_BYTES // (1024 * 1024)} MB limit")
+        if content_type.startswith("multipart/form-data"):
+            fields = parse_multipart(await request.body(), content_type)
+            if "file" not in fields:
+                raise ValueError("file is required")
+            filename, content = fields["file"]
+            purpose = fields.get("purpose", (None, b""))[1].decode("utf-8")
+        else:
+            filename = request.query_params.get("filename")
+            purpose = request.query_params.get("purpose", "")
+            content = request.stream()
+        if purpose != "batch":
+            raise ValueError("purpose must be batch")
+        return await batch_manager.files.create(filename or "input.jsonl", purpose, content, owner=key.name)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"error": {"message": str(e), "type": "invalid_request_error"}}
+        )
+
+
+@app.get("/v1/files")
+async def list_files(request: Request):
+    key, error = _authenticate(request.headers)
+    if error is not None:
+        return error
+    files = await batch_manager.files.list(request.query_params.get("purpose"), owner=_owner(key))
+    return {"object": "list", "data": files}
+
+
+@app.get("/v1/files/{file_id}")
+async def get_file(file_id: str, request: Request):
+    key, error = _authenticate(request.headers)
+    if error is not None:
+        return error
+    meta = await batch_manager.files.get(file_id, owner=_owner(key))
+    return meta if meta is not None else _not_found(f"No such File object: {file_id}")
+
+
+@app.get("/v1/files/{file_id}/content")
+async def get_file_content(file_id: str, request: Request):
+    key, error = _authenticate(request.headers)
+    if error is not None:
+        return error
+    if await batch_manager.files.get(file_id, owner=_owner(key)) is None:
+        return _not_found(f"No such File object: {file_id}")
+    return FileResponse(batch_manager.files.content_path(file_id), media_type="application/jsonl")
+
+
+@app.delete("/v1/files/{file_id}")
+async def delete_file(file_id: str, request: Request):
+    key, error = _authenticate(request.headers)
+    if error is not None:
+        return error
+    if not await batch_manager.files.delete(file_id, owner=_owner(key)):
+        return _not_found(f"No such File object: {file_id}")
+    return {"id": file_id, "object": "file", "deleted": True}
+
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    """创建批次，后台按 BATCH_CONCURRENCY 并发处理，结果写入 output_file_id / error_file_id，用量计入创建批次的 key"""
+    key, error = _authenticate(request.headers)
+    if error is None:
+        error = _check_quota(key)
+    if error is not None:
+        return error
+    try:
+        data = fast_json.loads(await request.body())
+        if not isinstance(data, dict):
+            raise ValueError("request body must be a JSON object")
+        return await batch_manager.create(data.get("input_file_id", ""), data.get("endpoint", ""),
+                                          data.get("completion_window", "24h"), data.get("metadata"),
+                                          owner=key.name, admin=key.admin, limit_key=_limit_key(request, key))
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"error": {"message": str(e), "type": "invalid_request_error"}}
+        )
+
+
+@app.get("/v1/batches")
+async def list_batches(request: Request):
+    key, error = _authenticate(request.headers)
+    if error is not None:
+        return error
+    try:
+        limit = min(max(int(request.query_params.get("limit", 20)), 1), 100)
+    except ValueError:
+        limit = 20
+    batches, has_more = await batch_manager.list(limit, request.query_params.get("after"), owner=_owner(key))
+    return {
+        "object": "list",
+        "data": batches,
+        "first_id": batches[0]["id"] if batches else None,
+        "last_id": batches[-1]["id"] if batches else None,
+        "has_more": has_more,
+    }
+
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str, request: Request):
+    key, error = _authenticate(request.headers)
+    if error is not None:
+        return error
+    batch = await batch_manager.get(batch_id, owner=_owner(key))
+    return batch if batch is not None else _not_found(f"No such Batch object: {batch_id}")
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, request: Request):
+    key, error = _authenticate(request.headers)
+    if error is not None:
+        return error
+    batch = await batch_manager.cancel(batch_id, owner=_owner(key))
+    return batch if batch is not None else _not_found(f"No such Batch object: {batch_id}")
+
+
+@app.get("/v1/usage")
+async def usage(request: Request):
+    """按 key 查询用量：start_date / end_date 为 UTC 日期（YYYY-MM-DD，含两端）；
+    普通 key 只能查询自己，管理员 key 可以查询全部或用 key 参数指定名称"""
+    key, error = _authenticate(request.headers)
+    if error is not None:
+        return error
+    params = request.query_params
+    start_date = params.get("start_date", "")
+    end_date = params.get("end_date", "9999-12-31")
+    for value in (start_date, end_date):
+        if value and not re.fullmatch(r"\d{4}-\d{2}-\d{2}", value):
+            return JSONResponse(
+                status_code=400,
+                content={"error": {"message": "dates must be YYYY-MM-DD", "type": "invalid_request_error"}}
+            )
+    name = params.get("key") if key.admin else key.name
+    data = await usage_ledger.query(name, start_date, end_date)
+    for item in data:
+        configured = usage_ledger.keys.find(item["key"])
+        if configured is not None and (configured.token_quota is not None or configured.request_quota is not None):
+            item["quota"] = usage_ledger.quota_status(configured)
+    return {"object": "list", "data": data}
+
+
 @app.get("/v1/models")
 async def models():
-    """返回支持的模型列表"""
+    """返回上游目录中的模型列表（含上下文窗口、最大输出等能力信息）"""
+    await model_catalog.ensure_loaded()
+    return {"object": "list", "data": model_catalog.list_models()}
+
+
+@app.get("/healthz")
+async def healthz():
+    """存活探针：进程能处理请求即返回 200"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """就绪探针：启动预热（凭据、Copilot token、模型列表、上游连接）完成前返回 503"""
+    ready = await readiness.check()
+    return JSONResponse(status_code=200 if ready else 503,
+                        content={"status": "ready" if ready else "starting", **readiness.get_stats()})
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 指标"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats")
+async def stats():
+    """返回运行时统计信息"""
     return {
-        "object": "list",
-        "data": [
-            {"id": "gpt-4", "object": "model"},
-            {"id": "o3-mini", "object": "model"},
-            {"id": "o1", "object": "model"},
-            {"id": "gemini-2.0-flash-001", "object": "model"},
-            {"id": "claude-3.5-sonnet", "object": "model"},
-            {"id": "claude-3.7-sonnet", "object": "model"},
-        ]
+        "pid": os.getpid(),
+        "http_pool": http_client.get_stats(),
+        "copilot_tokens": copilot_tokens.get_stats(),
+        "credentials": credential_provider.get_stats(),
+        "response_cache": response_cache.get_stats(),
+        "scheduler": scheduler.get_stats(),
+        "resilience": resilience.get_stats(),
+        "embeddings": embedding_batcher.get_stats(),
+        "models": model_catalog.get_stats(),
+        "token_counter": token_counter.get_stats(),
+        "prefix_cache": prefix_store.get_stats(),
+        "batches": batch_manager.get_stats(),
+        "device_auth": device_flows.get_stats(),
+        "startup": readiness.get_stats(),
+        "usage": usage_ledger.get_stats(),
     }
 
 
 if __name__ == "__main__":
+    import uvicorn
+
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", 8000))
-    logger.debug(f"Starting server on http://{host}:{port}")
-    uvicorn.run(app, host=host, port=port)
+    workers = int(os.getenv("WORKERS", 1))
+    # 停止时等待在途请求（包括流式响应）结束的最长秒数
+    graceful_timeout = int(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", 30))
+    logger.info(f"Starting server on http://{host}:{port} with {workers} worker(s)")
+    if workers > 1:
+        # 多 worker 通过共享目录共享 Copilot token 和限流状态，子进程继承该环境变量
+        os.environ.setdefault("SHARED_STATE_DIR", os.path.join(tempfile.gettempdir(), "github-copilot-openai-api"))
+        uvicorn.run("server:app", host=host, port=port, workers=workers,
+                    timeout_graceful_shutdown=graceful_timeout)
+    else:
+        uvicorn.run(app, host=host, port=port, timeout_graceful_shutdown=graceful_timeout)